@@ -0,0 +1,68 @@
+#!/usr/bin/python
+
+# Measures how long unbox.py takes to start and finish trivial commands, and which Unbox modules they import
+# Usage: bench_startup.py [runs] [max milliseconds]
+
+import os
+import subprocess
+import sys
+import time
+
+# Commands to time, each run as its own process
+_COMMANDS = (["help"], ["no-such-command"])
+
+# Default number of runs per command, and default budget for a command's median run
+_DEFAULT_RUNS = 20
+_DEFAULT_MAX_MILLISECONDS = 50.0
+
+# Runs a command in-process, then prints the Unbox modules it imported
+_IMPORT_PROBE = """
+import sys
+import unbox
+unbox.main(["unbox.py"] + sys.argv[1:])
+sys.stderr.write(" ".join(sorted([name for name in sys.modules if name.startswith("unbox_") or name.endswith("_module")])))
+"""
+
+"""
+Times runs of a command in fresh interpreters
+- argv: arguments to run the interpreter with
+- runs: number of runs
+- RETURN: sorted list of run durations in milliseconds
+"""
+def time_runs(argv, runs):
+    devnull = open(os.devnull, "w")
+    durations = []
+    for _ in range(runs):
+        start_time = time.time()
+        subprocess.call([sys.executable] + argv, stdout=devnull, stderr=devnull)
+        durations.append((time.time() - start_time) * 1000)
+    devnull.close()
+    return sorted(durations)
+
+"""
+Lists the Unbox modules a command imports
+- command: command arguments
+- RETURN: space-separated module names
+"""
+def imported_modules(command):
+    devnull = open(os.devnull, "w")
+    probe = subprocess.Popen([sys.executable, "-c", _IMPORT_PROBE] + command, stdout=devnull, stderr=subprocess.PIPE)
+    _, modules = probe.communicate()
+    devnull.close()
+    return modules.decode("utf-8").strip()
+
+if __name__ == "__main__":
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else _DEFAULT_RUNS
+    max_milliseconds = float(sys.argv[2]) if len(sys.argv) > 2 else _DEFAULT_MAX_MILLISECONDS
+
+    baseline_median = time_runs(["-c", "pass"], runs)[runs // 2]
+    print("interpreter\tmedian %.1fms" % baseline_median)
+    over_budget = False
+    for command in _COMMANDS:
+        durations = time_runs(["unbox.py"] + command, runs)
+        median = durations[runs // 2]
+        print(" ".join(command) + "\tmedian %.1fms, min %.1fms, max %.1fms, imports: %s"
+                % (median, durations[0], durations[-1], imported_modules(command) or "none"))
+        over_budget = over_budget or median > max_milliseconds
+    sys.exit(1 if over_budget else 0)
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+# Counts the syscalls Unbox operations make on an in-memory filesystem, per resource, as a regression metric
+# Usage: bench_syscalls.py [resources] [max syscalls per resource]
+
+import os
+import sys
+
+import dropbox_module
+import unbox_backend
+import unbox_filesystem
+
+# Default number of resources to run the operations on, and default budget for an operation's syscalls per resource
+_DEFAULT_RESOURCES = 200
+_DEFAULT_MAX_SYSCALLS_PER_RESOURCE = 40.0
+
+# Root of the in-memory filesystem the operations run in
+_ROOT = "/bench"
+
+"""
+Runs a function and counts the syscalls it makes
+- backend: MemoryBackend the function works through
+- function: function taking no arguments
+- RETURN: dict of syscall name -> number of calls
+"""
+def count_syscalls(backend, function):
+    backend.reset_syscalls()
+    function()
+    return dict(backend.syscalls)
+
+"""
+Builds an in-memory filesystem with resource files to add, and an Unbox filesystem working on it
+- num_resources: number of resource files to create
+- RETURN: tuple of (MemoryBackend, unbox_filesystem.Filesystem, list of resource file paths)
+"""
+def make_environment(num_resources):
+    backend = unbox_backend.MemoryBackend()
+    for dirname in ("Dropbox", "work", "home"):
+        backend.makedirs(os.path.join(_ROOT, dirname))
+    resource_paths = []
+    for idx in range(num_resources):
+        resource_path = os.path.join(_ROOT, "work", "resource" + str(idx))
+        resource_fp = backend.open(resource_path, "w")
+        resource_fp.write("contents of resource " + str(idx))
+        resource_fp.close()
+        resource_paths.append(resource_path)
+    filesystem = unbox_filesystem.Filesystem(os.path.join(_ROOT, "home", ".unbox"), os.path.join(_ROOT, "Dropbox"), "Unbox", backend=backend)
+    return (backend, filesystem, resource_paths)
+
+if __name__ == "__main__":
+    num_resources = int(sys.argv[1]) if len(sys.argv) > 1 else _DEFAULT_RESOURCES
+    max_syscalls_per_resource = float(sys.argv[2]) if len(sys.argv) > 2 else _DEFAULT_MAX_SYSCALLS_PER_RESOURCE
+
+    backend, filesystem, resource_paths = make_environment(num_resources)
+    dropbox = filesystem._dropbox_module
+    resource_names = [os.path.basename(resource_path) for resource_path in resource_paths]
+    operations = [
+        ("add resources", lambda: dropbox.add_resources([(resource_path, "1.0") for resource_path in resource_paths])),
+        ("copy versions", lambda: [dropbox.copy_version(resource_name, "1.0", "2.0") for resource_name in resource_names]),
+        ("add links", lambda: filesystem._local_module.add_links([(os.path.join(_ROOT, "home", resource_name), dropbox.resource_path(resource_name),
+                resource_name, "1.0", False) for resource_name in resource_names])),
+        ("change versions", lambda: filesystem.change_current_versions([(resource_name, "2.0") for resource_name in resource_names])),
+        ("status", filesystem.status),
+        ("load index", lambda: dropbox_module.DropboxModule(os.path.join(_ROOT, "Dropbox"), "Unbox", backend=backend))
+    ]
+
+    over_budget = False
+    for description, function in operations:
+        syscalls = count_syscalls(backend, function)
+        per_resource = sum(syscalls.values()) / float(num_resources)
+        print(description + "\t%.1f syscalls per resource: %s" % (per_resource,
+                ", ".join(["%s %d" % (name, count) for name, count in sorted(syscalls.items())])))
+        over_budget = over_budget or per_resource > max_syscalls_per_resource
+    sys.exit(1 if over_budget else 0)
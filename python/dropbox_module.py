@@ -1,8 +1,21 @@
+import hashlib
 import os
+import stat
 import shutil
-import pickle
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 import uuid
+from multiprocessing.pool import ThreadPool
+import unbox_backend
 import unbox_filesystem
+import unbox_search
+import unbox_records
+import unbox_metrics
+import unbox_estimate
+import unbox_oplog
+import unbox_links
 
 class DropboxModule:
     """Module for the Unbox filesystem to expose Dropbox-managing functionality
@@ -16,29 +29,46 @@ class DropboxModule:
     # Name of file to store Dropbox data in
     _INDEX_FILENAME = "index"
 
-    # Name of directory containing all versions of a resource
-    _RSRC_INFO_KEY_PARENT_DIRNAME = "parent_dirname"
+    # Name of directory holding each machine's operation log, used instead of rewriting the index file when machine ids are set
+    _OPLOG_DIRNAME = "oplog"
 
-    # Key to dict of resource versions mapped to info about the version
-    _RSRC_INFO_KEY_VERSIONS_INFO = "versions_info"
+    # Number of logged operations merged on top of the index file after which a machine folds them into a new index file
+    _OPLOG_COMPACT_OPS = 1000
 
-    # Version that the "current" symlink in the resource directory is pointing to
-    _RSRC_INFO_KEY_CURRENT_VERSION = "current_version"
+    # Marker stored in the header pickled ahead of the index contents, which holds the generation so writers can check it
+    # without loading the contents, and the last operation of each machine's log folded into the contents
+    _INDEX_FORMAT_MARKER = "unbox-index-v3"
 
-    # Key to version dependencies
-    _VERSION_INFO_KEY_DEPENDENCIES = "dependencies"
+    # Marker of the previous format, which pickled the generation and index contents as one tuple
+    _LEGACY_INDEX_FORMAT_MARKER = "unbox-index-v2"
+
+    # Pickle protocol the index is written with; the highest one both Python 2 and 3 read
+    _INDEX_PICKLE_PROTOCOL = 2
 
     # Pseudo version name to represent the current version
     _CURRENT_RSRC_VERSION_KEYWORD = "current"
 
+    # Number of resources to copy concurrently during bulk adds
+    _BULK_COPY_THREADS = 4
+
+    # Kinds of change between two versions of a resource reported by diff_versions
+    DIFF_ADDED = "added"            # Entry only exists in the newer version
+    DIFF_REMOVED = "removed"        # Entry only exists in the older version
+    DIFF_MODIFIED = "modified"      # Entry's type, content or symlink target differs
 
 
-    def __init__(self, dropbox_dirpath, unbox_dirname):
+
+    def __init__(self, dropbox_dirpath, unbox_dirname, machine_id=None, view_dirpath=None, backend=None):
         """Instantiates a new Dropbox filesystem module at the given location
 
         Keyword Args:
         dropbox_dirpath -- path to the user's Dropbox directory
         unbox_dirname -- name of Unbox directory in the Dropbox folder
+        machine_id -- name unique to this machine to log changes under instead of rewriting the shared index file, which then
+        only serves as the base the logs apply to; every machine sharing the directory should set one (default: None)
+        view_dirpath -- path to a directory on this machine, outside Dropbox, to cache the merged logs in (default: None,
+        to merge every log from the start on each load)
+        backend -- unbox_backend filesystem backend to perform every file operation through (default: the real filesystem)
         """
         # Ensure argument validity
         if dropbox_dirpath == None or unbox_dirname == None:
@@ -46,44 +76,263 @@ class DropboxModule:
         if len(dropbox_dirpath.strip()) == 0 or len(unbox_dirname.strip()) == 0:
             raise ValueError("Cannot have empty arguments")
         dropbox_dirpath = unbox_filesystem.abs_path(dropbox_dirpath)
+        self._backend = backend or unbox_backend.OS_BACKEND
 
         # Ensure valid Dropbox path
-        if not os.path.isdir(dropbox_dirpath):
+        if not self._backend.isdir(dropbox_dirpath):
             raise ValueError("Invalid Dropbox path")
 
         # Test if Dropbox Unbox directory exists and create if not
         unbox_dirpath = os.path.join(dropbox_dirpath, unbox_dirname)
-        if not os.path.isdir(unbox_dirpath):
+        if not self._backend.isdir(unbox_dirpath):
             try:
-                os.mkdir(unbox_dirpath)
+                self._backend.mkdir(unbox_dirpath)
             except OSError as e:
                 raise ValueError("Could not create Dropbox Unbox directory: " + str(e))
         self._unbox_dirpath = unbox_dirpath # Path to Dropbox Unbox directory
 
-        # Read Dropbox index file
-        dropbox_index_filepath = os.path.join(self._unbox_dirpath, self._INDEX_FILENAME)
-        if os.path.isfile(dropbox_index_filepath):
-            dropbox_index_fp = open(dropbox_index_filepath, "r")
-            self._dropbox_index = pickle.load(dropbox_index_fp)
+        # Read Dropbox index file; readers share the lock so they never see a write in progress
+        with self._backend.shared_lock(self._index_filepath()):
+            generation, serialized_index, folded_seqs = self._read_index_file()
+        self._op_log = None
+        if machine_id is not None:
+            view_filepath = None
+            if view_dirpath is not None:
+                view_filepath = os.path.join(view_dirpath, hashlib.sha256(unbox_dirpath.encode("utf-8")).hexdigest() + "." + machine_id + ".view")
+            self._op_log = unbox_oplog.OpLog(os.path.join(unbox_dirpath, self._OPLOG_DIRNAME), machine_id, view_filepath, self._backend)
+            generation, serialized_index = self._op_log.load(generation, serialized_index, folded_seqs)
+        self._load_index(generation, serialized_index)
+
+        # Resources whose directories were created by stage_resource but are not yet in the index
+        # Maps resource name -> (parent dirname, version)
+        self._staged_resources = dict()
+
+        # Content hashes of files read while diffing versions
+        # Maps file path -> ((size, mtime, inode), content hash)
+        self._content_hashes = dict()
+
+
+
+    """ ======= Helper Methods ======= """
+    def _index_filepath(self):
+        """Gets the path to the index file in Dropbox"""
+        return os.path.join(self._unbox_dirpath, self._INDEX_FILENAME)
+
+    def _read_index_file(self, known_generation=None):
+        """Reads the index file in Dropbox
+        NOTE: The caller must hold a lock on the index file
+
+        Keyword Args:
+        known_generation -- generation whose contents the caller already has, in which case they are not loaded (default: None)
+
+        Return:
+        Tuple of (index generation, dict of resource names -> serialized resource info or None if the generation is known_generation,
+        dict of machine id -> sequence number of the last operation of its log folded into the index)
+        """
+        index_filepath = self._index_filepath()
+        if not self._backend.isfile(index_filepath):
+            return (0, dict(), dict())
+        dropbox_index_fp = self._backend.open(index_filepath, "rb")
+        try:
+            index_contents = pickle.load(dropbox_index_fp)
+            if isinstance(index_contents, tuple) and len(index_contents) == 3 and index_contents[0] == self._INDEX_FORMAT_MARKER:
+                _, generation, folded_seqs = index_contents
+                if generation == known_generation:
+                    return (generation, None, folded_seqs)
+                return (generation, pickle.load(dropbox_index_fp), folded_seqs)
+        finally:
             dropbox_index_fp.close()
-        else:
-            self._dropbox_index = dict()
-        # _dropbox_index maps resource names in Dropbox -> info dict{
-        #   versions_info : version name -> info dict{
-        #       dependencies : list of dependencies version needs[]
+        if isinstance(index_contents, tuple) and len(index_contents) == 3 and index_contents[0] == self._LEGACY_INDEX_FORMAT_MARKER:
+            return (index_contents[1], index_contents[2], dict())
+        return (0, index_contents, dict())
+
+    def _dump_index(self, generation, serialized_index, folded_seqs, dropbox_index_fp):
+        """Pickles the index header, then the index contents, to the index file in Dropbox
+
+        Keyword Args:
+        generation -- generation of the index contents
+        serialized_index -- dict of resource names -> serialized resource info
+        folded_seqs -- dict of machine id -> sequence number of the last operation of its log folded into the index contents
+        dropbox_index_fp -- file object of the index file
+        """
+        # Pickled in memory first, since pickling straight to a file object writes it in many small chunks
+        dropbox_index_fp.write(pickle.dumps((self._INDEX_FORMAT_MARKER, generation, folded_seqs), self._INDEX_PICKLE_PROTOCOL)
+                + pickle.dumps(serialized_index, self._INDEX_PICKLE_PROTOCOL))
+
+    def _load_index(self, generation, serialized_index):
+        """Replaces the in-memory index with the given index contents
+
+        Keyword Args:
+        generation -- generation of the index contents
+        serialized_index -- dict of resource names -> serialized resource info
+        """
+        # Generation of the index file the in-memory index was last synced with
+        self._generation = generation
+
+        # Index contents as of that generation, which changes are merged from if another writer committed since
+        # Maps resource name -> serialized resource info
+        self._synced_index = serialized_index
+
+        # _dropbox_index maps resource names in Dropbox -> ResourceRecord{
+        #   versions : version name -> VersionRecord{
+        #       dependencies : set of dependencies version needs
         #   current_version : version that will be used by default
-        #   directory : name of directory where resource is stored
+        #   parent_dirname : name of directory where resource is stored
+        # The index file keeps the nested-dict format the records serialize to
+        self._dropbox_index = dict()
+        for resource_name, resource_info in serialized_index.items():
+            self._dropbox_index[unbox_records.intern_string(resource_name)] = unbox_records.ResourceRecord.deserialize(resource_info)
 
+        # Sorted name and version indexes for resource queries
+        self._search_index = unbox_search.ResourceSearchIndex([(resource_name, resource_record.versions.keys())
+                for resource_name, resource_record in self._dropbox_index.items()])
 
+        # Memoized results of resource_path, filled lazily
+        # Maps resource name -> version name, or None for the current version -> absolute path
+        self._resource_paths = dict()
 
+    def _invalidate_resource_paths(self, resource_name, versions=None):
+        """Drops memoized paths for a resource
 
-    """ ======= Helper Methods ======= """
-    def _write_index(self):
-        """Writes the in-memory index to the index file in Dropbox"""
-        INDEX_FILEPATH = os.path.join(self._unbox_dirpath, self._INDEX_FILENAME)
-        dropbox_index_fp = open(INDEX_FILEPATH, "w")
-        pickle.dump(self._dropbox_index, dropbox_index_fp)
-        dropbox_index_fp.close()
+        Keyword Args:
+        resource_name -- name of resource
+        versions -- iterable of versions whose paths to drop, with None for the current version (default: every version)
+        """
+        if versions is None:
+            self._resource_paths.pop(resource_name, None)
+        elif resource_name in self._resource_paths:
+            for version in versions:
+                self._resource_paths[resource_name].pop(version, None)
+
+    def _write_index(self, changed_resources):
+        """Writes the in-memory index to the index file in Dropbox
+        NOTE: If another writer committed since the index was last read, this module's changes are merged into its index
+        version by version, as operation logs are; changes to resources it deleted are dropped. If it committed a different
+        resource under a changed resource's name, its resource is kept, this module's is removed and the clash is reported
+
+        Keyword Args:
+        changed_resources -- iterable of names of resources added, modified or deleted since the last write
+        """
+        if self._op_log is not None:
+            self._log_changes(changed_resources)
+            return
+        index_filepath = self._index_filepath()
+        clashes = []
+        with self._backend.exclusive_lock(index_filepath):
+            disk_generation, disk_index, folded_seqs = self._read_index_file(self._generation)
+            if disk_index is not None:
+                for resource_name in changed_resources:
+                    new_info = self._dropbox_index[resource_name].serialize() if resource_name in self._dropbox_index else None
+                    base_info = self._synced_index.get(resource_name)
+                    merged_info = unbox_oplog.merge_entry(resource_name, base_info, new_info, disk_index.get(resource_name))
+                    if new_info is not None and merged_info is not None and (merged_info[unbox_records._RSRC_INFO_KEY_PARENT_DIRNAME]
+                            != new_info[unbox_records._RSRC_INFO_KEY_PARENT_DIRNAME]):
+                        clashes.append((resource_name, new_info[unbox_records._RSRC_INFO_KEY_PARENT_DIRNAME], base_info is None
+                                or base_info[unbox_records._RSRC_INFO_KEY_PARENT_DIRNAME] != new_info[unbox_records._RSRC_INFO_KEY_PARENT_DIRNAME]))
+                    if merged_info is not None:
+                        disk_index[resource_name] = merged_info
+                    else:
+                        disk_index.pop(resource_name, None)
+                self._load_index(disk_generation, disk_index)
+            # Only changed resources are reserialized; the rest are unchanged since the index was synced
+            serialized_index = dict(self._synced_index)
+            for resource_name in changed_resources:
+                if resource_name in self._dropbox_index:
+                    serialized_index[resource_name] = self._dropbox_index[resource_name].serialize()
+                else:
+                    serialized_index.pop(resource_name, None)
+            new_generation = max(disk_generation, self._generation) + 1
+            index_bytes = self._backend.atomic_write(index_filepath,
+                    lambda dropbox_index_fp: self._dump_index(new_generation, serialized_index, folded_seqs, dropbox_index_fp))
+            unbox_metrics.INDEX_BYTES_WRITTEN.inc(index_bytes)
+            self._generation = new_generation
+            self._synced_index = serialized_index
+        self._reject_clashes(clashes)
+
+    def _reject_clashes(self, clashes):
+        """Removes the directories of resources that lost a name clash with a resource another writer committed, then reports them
+
+        Keyword Args:
+        clashes -- list of (resource name, parent dirname of this module's resource, whether this module created that directory) tuples
+        """
+        if len(clashes) == 0:
+            return
+        for _, parent_dirname, created in clashes:
+            if created:
+                self._backend.rmtree(os.path.join(self._unbox_dirpath, parent_dirname), ignore_errors=True)
+        raise ValueError("Cannot commit changes; another writer committed a different resource named '"
+                + "', '".join(sorted([resource_name for resource_name, _, _ in clashes])) + "' first")
+
+    def _log_changes(self, changed_resources):
+        """Appends changes to this machine's operation log, merging in what other machines logged since the last merge
+        NOTE: Changes are logged per version, so concurrent changes to different versions of a resource both survive. A resource
+        another machine created under the same name first wins, and this machine's resource is removed
+
+        Keyword Args:
+        changed_resources -- iterable of names of resources added, modified or deleted since the last write
+        """
+        changed_resources = sorted(set(changed_resources))
+        serialized_changes = [(resource_name, self._dropbox_index[resource_name].serialize() if resource_name in self._dropbox_index else None)
+                for resource_name in changed_resources]
+        ops = []
+        created = set()
+        for resource_name, resource_info in serialized_changes:
+            ops.extend(self._op_log.diff(resource_name, resource_info))
+            if resource_info is not None and self._op_log.parent_dirname(resource_name) != resource_info[unbox_records._RSRC_INFO_KEY_PARENT_DIRNAME]:
+                created.add(resource_name)
+        num_merged, log_bytes = self._op_log.append(ops)
+        unbox_metrics.INDEX_BYTES_WRITTEN.inc(log_bytes)
+
+        # Only rebuild the in-memory index if other changes were merged in, or merge rules overrode one of ours
+        if num_merged > 0 or not all([self._op_log.matches(resource_name, resource_info) for resource_name, resource_info in serialized_changes]):
+            self._load_index(self._op_log.generation(), self._op_log.index())
+        else:
+            self._generation = self._op_log.generation()
+        if self._op_log.num_unfolded_ops() >= self._OPLOG_COMPACT_OPS:
+            self._compact_op_logs()
+        self._reject_clashes([(resource_name, resource_info[unbox_records._RSRC_INFO_KEY_PARENT_DIRNAME], resource_name in created)
+                for resource_name, resource_info in serialized_changes if resource_info is not None
+                and self._op_log.parent_dirname(resource_name) not in (None, resource_info[unbox_records._RSRC_INFO_KEY_PARENT_DIRNAME])])
+
+    def _compact_op_logs(self):
+        """Folds every logged operation merged so far into a new index file, so loads merge logs from there instead of their start
+        NOTE: Skipped if the index file changed since the logs were merged on top of it, e.g. because another machine compacted first
+        """
+        index_filepath = self._index_filepath()
+        with self._backend.exclusive_lock(index_filepath):
+            disk_generation, _, _ = self._read_index_file(self._op_log.base_generation())
+            if disk_generation != self._op_log.base_generation():
+                return
+            generation, serialized_index, folded_seqs = self._op_log.generation(), self._op_log.index(), self._op_log.merged_seqs()
+            index_bytes = self._backend.atomic_write(index_filepath,
+                    lambda dropbox_index_fp: self._dump_index(generation, serialized_index, folded_seqs, dropbox_index_fp))
+            unbox_metrics.INDEX_BYTES_WRITTEN.inc(index_bytes)
+            self._op_log.rebase(generation, serialized_index, folded_seqs)
+
+    def index_generation(self):
+        """Gets the generation of the index, which increases with every committed change
+
+        Return:
+        Generation number of the index as last read or written
+        """
+        return self._generation
+
+    def unbox_dirpath(self):
+        """Gets the path to the Dropbox Unbox directory this module manages"""
+        return self._unbox_dirpath
+
+    def resource_origin(self, resource_name):
+        """Gets where a resource is stored
+
+        Keyword Args:
+        resource_name -- name of resource
+
+        Return:
+        Path to the Dropbox Unbox directory holding the resource
+        """
+        if not self.resource_exists(resource_name):
+            raise ValueError("Cannot get resource origin; resource does not exist")
+        return self._unbox_dirpath
 
     def resource_exists(self, resource):
         """Checks if a resource is in the Dropbox Unbox system
@@ -109,9 +358,7 @@ class DropboxModule:
         # Ensure validity
         if not self.resource_exists(resource_name):
             raise ValueError("Cannot check if resource version exists; cannot find resource")
-        resource_info = self._dropbox_index[resource_name]
-        resource_versions_info = resource_info[self._RSRC_INFO_KEY_VERSIONS_INFO]
-        return version in resource_versions_info
+        return version in self._dropbox_index[resource_name].versions
 
 
 
@@ -125,6 +372,45 @@ class DropboxModule:
         """
         return self._dropbox_index.keys()
 
+    def find_resources(self, pattern=None):
+        """Finds resources whose names match a glob pattern, using the sorted name index
+
+        Keyword Args:
+        pattern -- glob pattern to match (default: all resources)
+
+        Return:
+        Sorted list of matching resource names
+        """
+        if pattern is None:
+            return self._search_index.names_in_range()
+        return self._search_index.names_matching(pattern)
+
+    def iter_resources(self, pattern=None):
+        """Lazily yields resources and their index entries, only visiting names that can match the pattern
+        NOTE: Resources must not be added or deleted while iterating
+
+        Keyword Args:
+        pattern -- glob pattern to match (default: all resources)
+
+        Return:
+        Generator of (resource name, (resource dirname, current version, list of version names)) tuples in name order
+        """
+        for resource_name in self._search_index.iter_names(pattern):
+            resource_record = self._dropbox_index[resource_name]
+            yield (resource_name, (resource_record.parent_dirname, resource_record.current_version, resource_record.versions.keys()))
+
+    def resources_in_range(self, start=None, end=None):
+        """Gets resources whose names fall in the half-open range [start, end)
+
+        Keyword Args:
+        start -- lowest name to include (default: no lower bound)
+        end -- name to stop before (default: no upper bound)
+
+        Return:
+        Sorted list of resource names
+        """
+        return self._search_index.names_in_range(start, end)
+
     def resource_info(self, resource_name):
         """Gets the dictionary entry for the given resource
 
@@ -138,11 +424,11 @@ class DropboxModule:
         if not self.resource_exists(resource_name):
             raise ValueError("Cannot get resource info; resource does not exist")
 
-        resource_info = self._dropbox_index[resource_name]
+        resource_record = self._dropbox_index[resource_name]
         return (
-                resource_info[self._RSRC_INFO_KEY_PARENT_DIRNAME],
-                resource_info[self._RSRC_INFO_KEY_CURRENT_VERSION], 
-                resource_info[self._RSRC_INFO_KEY_VERSIONS_INFO].keys()
+                resource_record.parent_dirname,
+                resource_record.current_version, 
+                resource_record.versions.keys()
             )
 
     def resource_path(self, resource, version=None):
@@ -156,6 +442,10 @@ class DropboxModule:
         Return:
         Absolute path to the resource
         """
+        version_paths = self._resource_paths.get(resource)
+        if version_paths is not None and version in version_paths:
+            return version_paths[version]
+
         # Check validity
         if not self.resource_exists(resource):
             raise ValueError("Could not get path to resource in Dropbox; resource does not exist")
@@ -163,39 +453,49 @@ class DropboxModule:
             raise ValueError("Could not find version for resource; version does not exist")
 
         # Find resource and get absolute path
-        resource_info = self._dropbox_index[resource]
-        resource_parent_dirname = resource_info[self._RSRC_INFO_KEY_PARENT_DIRNAME]
-        if version is None:
-            version = self._CURRENT_RSRC_VERSION_KEYWORD
-        else:
-            version = resource_info[self._RSRC_INFO_KEY_CURRENT_VERSION]
-
-        resource_path = os.path.join(self._unbox_dirpath, resource_parent_dirname, version, resource)
+        resource_parent_dirname = self._dropbox_index[resource].parent_dirname
+        version_dirname = self._CURRENT_RSRC_VERSION_KEYWORD if version is None else version
+        resource_path = os.path.join(self._unbox_dirpath, resource_parent_dirname, version_dirname, resource)
+        self._resource_paths.setdefault(resource, dict())[version] = resource_path
         return resource_path
 
-    def add_resource(self, local_path, version="1.0", dependencies=None):
-        """Copies the given resource into the Dropbox system
-        NOTE: The resource must not already be in the system
+    def resource_paths(self, resources):
+        """Gets the full paths to many resource versions at once
 
         Keyword Args:
-        path -- path to resource to add
-        version -- version to give the resource (default: 1.0)
-        dependencies -- dependencies the resource depends on (default: None)
+        resources -- iterable of (resource name, version name or None for the current version) tuples
 
         Return:
-        Path to the resource in Dropbox
+        List of absolute paths to the resources, in input order
         """
-        if dependencies == None:
-            dependencies = set()
+        resource_paths = self._resource_paths
+        resource_path = self.resource_path
+        paths = []
+        for resource, version in resources:
+            version_paths = resource_paths.get(resource)
+            if version_paths is not None and version in version_paths:
+                paths.append(version_paths[version])
+            else:
+                paths.append(resource_path(resource, version))
+        return paths
+
+    def _validate_new_resource(self, local_path, version):
+        """Checks that a local file object can be added to the Dropbox system as a new resource
 
-        # Sanity checks
+        Keyword Args:
+        local_path -- path to resource to add
+        version -- version to give the resource
+
+        Return:
+        Tuple of (absolute path to resource, resource name, stripped version name)
+        """
         if local_path == None:
             raise ValueError("Cannot add resource to Dropbox directory; cannot use null resource")
         local_path = unbox_filesystem.abs_path(local_path)
         upstream, resource_filename = os.path.split(local_path)
-        if not os.path.exists(local_path):
+        if not self._backend.exists(local_path):
             raise ValueError("Cannot add resource to Dropbox; resource does not exist")
-        if not (os.path.isdir(local_path) or os.path.isfile(local_path)):
+        if not (self._backend.isdir(local_path) or self._backend.isfile(local_path)):
             raise ValueError("Cannot add resource to Dropbox; resource is not a file or directory")
         if resource_filename in self._dropbox_index:
             raise ValueError("Cannot add resource to Dropbox; resource with same name already exists")
@@ -204,40 +504,215 @@ class DropboxModule:
         version = version.strip()
         if version == self._CURRENT_RSRC_VERSION_KEYWORD:
             raise ValueError("Version name '" + self._CURRENT_RSRC_VERSION_KEYWORD + "' is a reserved name")
+        return (local_path, resource_filename, version)
 
-        # Creates directory structure to copy resource to
-        upstream, resource_filename = os.path.split(local_path)
+    def _make_resource_dirs(self, version):
+        """Creates the directory structure for a new resource, with the 'current' symlink pointing to its only version
+
+        Keyword Args:
+        version -- name of the resource's first version
+
+        Return:
+        Tuple of (name of resource's parent directory, path to the version directory)
+        """
         parent_dirname = str(uuid.uuid4())
         parent_dirpath = os.path.join(self._unbox_dirpath, parent_dirname)
-        os.mkdir(parent_dirpath)
+        self._backend.mkdir(parent_dirpath)
         version_dirpath = os.path.join(parent_dirpath, str(version))
-        os.mkdir(version_dirpath)
+        self._backend.mkdir(version_dirpath)
 
         # Creates symlink to current version
         current_version_linkpath = os.path.join(parent_dirpath, self._CURRENT_RSRC_VERSION_KEYWORD)
-        os.symlink(version_dirpath, current_version_linkpath)
+        self._backend.symlink(version_dirpath, current_version_linkpath)
+        return (parent_dirname, version_dirpath)
 
-        # Copies resource to proper spot
-        dest_dirpath = os.path.join(parent_dirpath, str(version))
-        if os.path.isdir(local_path):
-            shutil.copytree(local_path, dest_dirpath)
+    def _copy_resource(self, local_path, version_dirpath):
+        """Copies a local file or directory tree into a version directory
+
+        Keyword Args:
+        local_path -- absolute path to the resource to copy
+        version_dirpath -- path to the version directory to copy the resource into
+        """
+        if self._backend.isdir(local_path):
+            self._backend.copytree(local_path, os.path.join(version_dirpath, os.path.basename(local_path)))
         else:
-            shutil.copy(local_path, dest_dirpath)
+            self._backend.copy(local_path, version_dirpath)
+        unbox_metrics.BYTES_COPIED.inc(unbox_filesystem.file_object_size(local_path, self._backend))
+
+    def _register_resource(self, resource_name, parent_dirname, version, dependencies):
+        """Registers a newly-copied resource in the in-memory index
+
+        Keyword Args:
+        resource_name -- name of the resource
+        parent_dirname -- name of the directory containing all versions of the resource
+        version -- name of the resource's first version
+        dependencies -- set of dependencies the version needs
+        """
+        version_record = unbox_records.VersionRecord(dependencies)
+        resource_record = unbox_records.ResourceRecord(parent_dirname, str(version), { str(version) : version_record })
+        self._dropbox_index[unbox_records.intern_string(resource_name)] = resource_record
+        self._search_index.add_resource(resource_name, [str(version)])
+
+    @unbox_metrics.timed("add_resource")
+    def add_resource(self, local_path, version="1.0", dependencies=None):
+        """Copies the given resource into the Dropbox system
+        NOTE: The resource must not already be in the system
+
+        Keyword Args:
+        path -- path to resource to add
+        version -- version to give the resource (default: 1.0)
+        dependencies -- dependencies the resource depends on (default: None)
+
+        Return:
+        Path to the resource in Dropbox
+        """
+        if dependencies == None:
+            dependencies = set()
+
+        # Sanity checks
+        local_path, resource_filename, version = self._validate_new_resource(local_path, version)
+
+        # Creates directory structure and copies resource to proper spot
+        parent_dirname, dest_dirpath = self._make_resource_dirs(version)
+        self._copy_resource(local_path, dest_dirpath)
 
         # Register the addition in the Dropbox index
-        version_info = {
-            self._VERSION_INFO_KEY_DEPENDENCIES : dependencies
-        }
-        resource_info = {
-            self._RSRC_INFO_KEY_PARENT_DIRNAME : parent_dirname, 
-            self._RSRC_INFO_KEY_VERSIONS_INFO : { str(version) : version_info },
-            self._RSRC_INFO_KEY_CURRENT_VERSION : version
-        }
-        self._dropbox_index[resource_filename] = resource_info
-        self._write_index()
+        self._register_resource(resource_filename, parent_dirname, version, dependencies)
+        self._write_index([resource_filename])
 
         return dest_dirpath
 
+    @unbox_metrics.timed("add_resources")
+    def add_resources(self, resources, num_threads=_BULK_COPY_THREADS):
+        """Copies many resources into the Dropbox system, writing the index only once
+        NOTE: Every item is validated before any data is copied; items that fail validation are skipped
+
+        Keyword Args:
+        resources -- iterable of (local path, version, dependencies) tuples; version and dependencies may be None
+        num_threads -- number of resources to copy concurrently (default: 4)
+
+        Return:
+        List of (local path, resource name, path to resource in Dropbox, error message) tuples, in input order
+        Path is None if the item was not added; error message is None if it was
+        """
+        # Validate everything up front, including name collisions within the batch
+        report = []
+        to_copy = []
+        batch_names = set()
+        for item in resources:
+            local_path, version, dependencies = (tuple(item) + (None, None))[:3]
+            if version == None:
+                version = "1.0"
+            if dependencies == None:
+                dependencies = set()
+            try:
+                abs_local_path, resource_name, version = self._validate_new_resource(local_path, version)
+                if resource_name in batch_names:
+                    raise ValueError("Cannot add resource to Dropbox; resource with same name is already in batch")
+            except ValueError as e:
+                report.append((local_path, None, None, str(e)))
+                continue
+            batch_names.add(resource_name)
+            report.append((local_path, resource_name, None, None))
+            to_copy.append((len(report) - 1, abs_local_path, resource_name, version, set(dependencies)))
+
+        def copy_one(entry):
+            report_idx, abs_local_path, resource_name, version, dependencies = entry
+            parent_dirname = None
+            try:
+                parent_dirname, dest_dirpath = self._make_resource_dirs(version)
+                self._copy_resource(abs_local_path, dest_dirpath)
+            except (OSError, IOError, shutil.Error) as e:
+                if parent_dirname is not None:
+                    self._backend.rmtree(os.path.join(self._unbox_dirpath, parent_dirname), ignore_errors=True)
+                return (entry, None, None, "Cannot add resource to Dropbox; copy failed: " + str(e))
+            return (entry, parent_dirname, dest_dirpath, None)
+
+        # Copy data in parallel; only the copies touch the disk, so threads are sufficient
+        if num_threads > 1 and len(to_copy) > 1:
+            pool = ThreadPool(min(num_threads, len(to_copy)))
+            try:
+                copy_results = pool.map(copy_one, to_copy)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            copy_results = [copy_one(entry) for entry in to_copy]
+
+        # Register successful copies and commit the index once
+        registered = []
+        for entry, parent_dirname, dest_dirpath, error in copy_results:
+            report_idx, _, resource_name, version, dependencies = entry
+            local_path = report[report_idx][0]
+            if error is not None:
+                report[report_idx] = (local_path, resource_name, None, error)
+                continue
+            self._register_resource(resource_name, parent_dirname, version, dependencies)
+            registered.append(resource_name)
+            report[report_idx] = (local_path, resource_name, dest_dirpath, None)
+        if len(registered) > 0:
+            self._write_index(registered)
+
+        return report
+
+    def stage_resource(self, resource_name, version):
+        """Creates the directory structure for a new resource whose data the caller will write in place
+        NOTE: Staged resources are not in the index until commit_staged_resources is called
+
+        Keyword Args:
+        resource_name -- name of the new resource
+        version -- version to give the resource
+
+        Return:
+        Path to the version directory the resource should be written into
+        """
+        # Sanity checks
+        if resource_name == None or len(resource_name.strip()) == 0 or os.sep in resource_name:
+            raise ValueError("Cannot stage resource; invalid resource name")
+        if resource_name in self._dropbox_index or resource_name in self._staged_resources:
+            raise ValueError("Cannot stage resource; resource with same name already exists")
+        if version == None or len(version.strip()) == 0:
+            raise ValueError("Cannot have empty version name")
+        version = version.strip()
+        if version == self._CURRENT_RSRC_VERSION_KEYWORD:
+            raise ValueError("Version name '" + self._CURRENT_RSRC_VERSION_KEYWORD + "' is a reserved name")
+
+        parent_dirname, version_dirpath = self._make_resource_dirs(version)
+        self._staged_resources[resource_name] = (parent_dirname, version)
+        return version_dirpath
+
+    @unbox_metrics.timed("commit_staged_resources")
+    def commit_staged_resources(self, dependencies=None, templates=None):
+        """Registers every staged resource in the index, writing the index once
+
+        Keyword Args:
+        dependencies -- dict of resource name -> set of dependencies for its version (default: none)
+        templates -- set of names of resources to flag as templates (default: none)
+
+        Return:
+        List of names of resources committed
+        """
+        if dependencies == None:
+            dependencies = dict()
+        if templates == None:
+            templates = set()
+        committed = []
+        for resource_name, (parent_dirname, version) in self._staged_resources.items():
+            self._register_resource(resource_name, parent_dirname, version, set(dependencies.get(resource_name, set())))
+            self._dropbox_index[resource_name].template = resource_name in templates
+            committed.append(resource_name)
+        self._staged_resources = dict()
+        if len(committed) > 0:
+            self._write_index(committed)
+        return committed
+
+    def abort_staged_resources(self):
+        """Removes the directories of every staged resource without touching the index"""
+        for parent_dirname, _ in self._staged_resources.values():
+            self._backend.rmtree(os.path.join(self._unbox_dirpath, parent_dirname), ignore_errors=True)
+        self._staged_resources = dict()
+
+    @unbox_metrics.timed("delete_resource")
     def delete_resource(self, resource_name):
         """Deletes a resource and all its versions from the Dropbox Unbox filesystem
 
@@ -249,11 +724,14 @@ class DropboxModule:
             raise ValueError("Cannot delete resource; cannot find resource")
 
         # Perform delete and write to file
-        resource_dirname = self._dropbox_index[resource_name][self._RSRC_INFO_KEY_PARENT_DIRNAME]
+        resource_dirname = self._dropbox_index[resource_name].parent_dirname
         resource_dirpath = os.path.join(self._unbox_dirpath, resource_dirname)
+        resource_versions = self._dropbox_index[resource_name].versions.keys()
+        self._search_index.remove_resource(resource_name, resource_versions)
+        self._invalidate_resource_paths(resource_name)
         del(self._dropbox_index[resource_name])
-        shutil.rmtree(resource_dirpath)
-        self._write_index()
+        self._backend.rmtree(resource_dirpath)
+        self._write_index([resource_name])
 
 
 
@@ -275,11 +753,33 @@ class DropboxModule:
             raise ValueError("Cannot get resource version info; cannot find version")
 
         # Extract version info
-        resource_info = self._dropbox_index[resource_name]
-        versions_info = resource_info[self._RSRC_INFO_KEY_VERSIONS_INFO]
-        version_info = versions_info[version]
-        return version_info[self._VERSION_INFO_KEY_DEPENDENCIES]
+        return self._dropbox_index[resource_name].versions[version].dependencies
+
+    def sorted_versions(self, resource_name):
+        """Gets a resource's versions in semantic-version order
 
+        Keyword Args:
+        resource_name -- name of resource
+
+        Return:
+        List of version names, oldest first
+        """
+        if not self.resource_exists(resource_name):
+            raise ValueError("Cannot sort resource versions; cannot find resource")
+        return unbox_search.sort_versions(self._dropbox_index[resource_name].versions.keys())
+
+    def find_versions(self, spec):
+        """Finds resource versions matching a version query, using the version index
+
+        Keyword Args:
+        spec -- version prefix, optionally ending in an 'x' or '*' component (e.g. "2.x")
+
+        Return:
+        List of (resource name, version name) tuples in semantic-version order
+        """
+        return self._search_index.versions_matching(spec)
+
+    @unbox_metrics.timed("copy_version")
     def copy_version(self, resource_name, source_version, new_version, copy_dependencies=True):
         """Copies the given resource file ONLY into a new version
 
@@ -297,35 +797,65 @@ class DropboxModule:
             raise ValueError("Resource name '" + self._CURRENT_RSRC_VERSION_KEYWORD + "' is a reserved name")
         if not self.resource_exists(resource_name):
             raise ValueError("Cannot add resource version; cannot find resource")
+        resource_record = self._dropbox_index[resource_name]
+        if source_version == self._CURRENT_RSRC_VERSION_KEYWORD:
+            source_version = resource_record.current_version
         if not self.version_exists(resource_name, source_version):
             raise ValueError("Cannot add resource version; cannot find source version")
+        if self.version_exists(resource_name, new_version):
+            raise ValueError("Cannot add resource version; version already exists")
 
-        # Create files for new version from source version
-        resource_info = self._dropbox_index[resource_name]
-        resource_dirname = resource_info[self._RSRC_INFO_KEY_PARENT_DIRNAME]
+        # Create files for new version from source version, keeping timestamps so diffs between them stay cheap
+        resource_dirname = resource_record.parent_dirname
         new_version_dirpath = os.path.join(self._unbox_dirpath, resource_dirname, new_version)
-        os.mkdir(new_version_dirpath)
+        self._backend.mkdir(new_version_dirpath)
         new_version_filepath = os.path.join(new_version_dirpath, resource_name)
-        if source_version == self._CURRENT_RSRC_VERSION_KEYWORD:
-            source_version_filepath = os.path.join(self._unbox_dirpath, resource_dirname, self._CURRENT_RSRC_VERSION_KEYWORD)
-        else:
-            source_version_filepath = os.path.join(self._unbox_dirpath, resource_dirname, source_version, resource_name)
-        if os.path.isdir(source_version_filepath):
-            shutil.copytree(source_version_filepath, new_version_dirpath)
+        source_version_filepath = os.path.join(self._unbox_dirpath, resource_dirname, source_version, resource_name)
+        if self._backend.isdir(source_version_filepath):
+            self._backend.copytree(source_version_filepath, new_version_filepath, symlinks=True)
         else:
-            shutil.copy(source_version_filepath, new_version_dirpath)
+            self._backend.copy2(source_version_filepath, new_version_filepath)
+        unbox_metrics.BYTES_COPIED.inc(unbox_filesystem.file_object_size(source_version_filepath, self._backend))
 
         # Update in-memory copy
-        resource_versions_info = resource_info[self._RSRC_INFO_KEY_VERSIONS_INFO]
-        source_version_info = resource_versions_info[source_version]
-        new_version_info = dict()
+        source_version_record = resource_record.versions[source_version]
         if copy_dependencies == True:
-            new_version_info[self._VERSION_INFO_KEY_DEPENDENCIES] = set(source_version_info[self._VERSION_INFO_KEY_DEPENDENCIES])
+            new_version_record = unbox_records.VersionRecord(source_version_record.dependencies)
         else:
-            new_version_info[self._VERSION_INFO_KEY_DEPENDENCIES] = set()
-        resource_versions_info[new_version] = new_version_info
+            new_version_record = unbox_records.VersionRecord()
+        resource_record.versions[unbox_records.intern_string(new_version)] = new_version_record
+        self._search_index.add_version(resource_name, new_version)
 
-        self._write_index()
+        self._write_index([resource_name])
+
+    def is_template(self, resource_name):
+        """Checks if a resource is a template, rendered with each machine's template variables before being linked
+
+        Keyword Args:
+        resource_name -- name of resource
+
+        Return:
+        True if the resource is a template, false otherwise
+        """
+        if not self.resource_exists(resource_name):
+            raise ValueError("Cannot check if resource is a template; cannot find resource")
+        return self._dropbox_index[resource_name].template
+
+    def set_template(self, resource_name, template):
+        """Flags or unflags a resource as a template
+
+        Keyword Args:
+        resource_name -- name of resource
+        template -- whether the resource is a template
+        """
+        if not self.resource_exists(resource_name):
+            raise ValueError("Cannot set template flag; cannot find resource")
+        if template != True and template != False:
+            raise ValueError("Cannot set template flag; non-boolean value for template")
+        resource_record = self._dropbox_index[resource_name]
+        if resource_record.template != template:
+            resource_record.template = template
+            self._write_index([resource_name])
 
     def add_version_dependency(self, resource_name, version_name, dependency_name):
         """Adds the given dependency to the given resource version
@@ -344,11 +874,10 @@ class DropboxModule:
             raise ValueError("Cannot add version dependency; dependency name must be non-empty string")
 
         # Add version dependency to in-memory list and write to file
-        versions_info = self._dropbox_index[resource_name][self._RSRC_INFO_KEY_VERSIONS_INFO]
-        version_dependencies = versions_info[version_name][self._VERSION_INFO_KEY_DEPENDENCIES]
+        version_dependencies = self._dropbox_index[resource_name].versions[version_name].dependencies
         if dependency_name not in version_dependencies:
-            version_dependencies.add(dependency_name)
-            self._write_index()
+            version_dependencies.add(unbox_records.intern_string(dependency_name))
+            self._write_index([resource_name])
 
     def delete_version_dependency(self, resource_name, version_name, dependency_name):
         """Deletes the given dependency for the given resource version
@@ -367,11 +896,11 @@ class DropboxModule:
             raise ValueError("Cannot add version dependency; dependency name must be non-empty string")
 
         # Remove version dependency from in-memory list and write to file
-        versions_info = self._dropbox_index[resource_name][self._RSRC_INFO_KEY_VERSIONS_INFO]
-        version_dependencies = versions_info[version_name][self._VERSION_INFO_KEY_DEPENDENCIES]
+        version_dependencies = self._dropbox_index[resource_name].versions[version_name].dependencies
         version_dependencies.discard(dependency_name)
-        self._write_index()
+        self._write_index([resource_name])
 
+    @unbox_metrics.timed("change_current_version")
     def change_current_version(self, resource_name, version):
         """Changes the current version of a Dropbox resource
 
@@ -386,20 +915,97 @@ class DropboxModule:
             raise ValueError("Cannot change resource version; cannot find version")
 
         # Perform version change and write changes to file
-        resource_dirname = self._dropbox_index[resource_name][self._RSRC_INFO_KEY_PARENT_DIRNAME]
-        resource_dirpath = os.path.join(self._unbox_dirpath, resource_dirname)
-        current_rsrc_version_linkpath = os.path.join(
-                resource_dirpath,
-                self._CURRENT_RSRC_VERSION_KEYWORD)
-        target_rsrc_version_filepath = os.path.join(
-                resource_dirpath,
-                version,
-                resource_name)
-        os.unlink(current_rsrc_version_linkpath)
-        os.symlink(target_rsrc_version_filepath, current_rsrc_version_linkpath)
-        self._dropbox_index[resource_name][self._RSRC_INFO_KEY_CURRENT_VERSION] = version
-        self._write_index()
+        self._switch_current_versions([(resource_name, version)])
+
+    @unbox_metrics.timed("change_current_versions")
+    def change_current_versions(self, changes):
+        """Changes the current versions of many Dropbox resources together, committing the index once
+        NOTE: Either every resource is switched or, if any step fails, none are
+
+        Keyword Args:
+        changes -- iterable of (resource name, version) tuples; each resource may appear once
+        """
+        # Sanity checks, so nothing is touched unless every change is valid
+        changes = list(changes)
+        errors = []
+        seen_resources = set()
+        for resource_name, version in changes:
+            if resource_name in seen_resources:
+                errors.append(resource_name + ": resource appears more than once")
+            elif not self.resource_exists(resource_name):
+                errors.append(resource_name + ": cannot find resource")
+            elif not self.version_exists(resource_name, version):
+                errors.append(resource_name + ": cannot find version " + version)
+            seen_resources.add(resource_name)
+        if len(errors) > 0:
+            raise ValueError("Cannot change resource versions; " + "; ".join(errors))
+        self._switch_current_versions(changes)
+
+    def _switch_current_versions(self, changes):
+        """Points the 'current' symlinks of resources at new versions and commits the index, rolling everything back on failure
+        NOTE: Each new symlink is staged under a temporary name and renamed over the old one, so no 'current' link is ever missing
 
+        Keyword Args:
+        changes -- list of validated (resource name, version) tuples
+        """
+        # Note the old 'current' symlinks and versions before touching anything, since committing may reload the index
+        staged = []
+        try:
+            for resource_name, version in changes:
+                resource_dirpath = os.path.join(self._unbox_dirpath, self._dropbox_index[resource_name].parent_dirname)
+                current_rsrc_version_linkpath = os.path.join(resource_dirpath, self._CURRENT_RSRC_VERSION_KEYWORD)
+                staged_linkpath = os.path.join(resource_dirpath, "." + self._CURRENT_RSRC_VERSION_KEYWORD + "-" + uuid.uuid4().hex)
+                staged.append((resource_name, os.path.join(resource_dirpath, version), current_rsrc_version_linkpath, staged_linkpath,
+                        self._backend.readlink(current_rsrc_version_linkpath), self._dropbox_index[resource_name].current_version))
+        except OSError as e:
+            raise ValueError("Cannot change resource versions; could not read 'current' link: " + str(e))
+
+        # Stage new 'current' symlinks beside the old ones
+        try:
+            for idx, (_, version_dirpath, _, staged_linkpath, _, _) in enumerate(staged):
+                self._backend.symlink(version_dirpath, staged_linkpath)
+        except OSError as e:
+            for _, _, _, staged_linkpath, _, _ in staged[:idx]:
+                self._backend.unlink(staged_linkpath)
+            raise ValueError("Cannot change resource versions; could not stage 'current' link: " + str(e))
+
+        # Swap each staged symlink in, then commit the index once
+        swapped = set()
+        try:
+            for resource_name, _, current_rsrc_version_linkpath, staged_linkpath, _, _ in staged:
+                self._backend.rename(staged_linkpath, current_rsrc_version_linkpath)
+                swapped.add(resource_name)
+            for resource_name, version in changes:
+                self._dropbox_index[resource_name].current_version = unbox_records.intern_string(version)
+                self._invalidate_resource_paths(resource_name, [None])
+            self._write_index([resource_name for resource_name, _ in changes])
+        except Exception:
+            self._restore_current_versions(staged, swapped)
+            raise
+
+    def _restore_current_versions(self, staged, swapped):
+        """Puts back the old 'current' symlinks and versions after a failed switch, the same way they were swapped out
+        NOTE: Failures are skipped rather than raised, so the error that caused the rollback is the one reported, and
+        resources the index no longer has, e.g. because committing merged in another writer's delete, are left alone
+
+        Keyword Args:
+        staged -- list of (resource name, new version path, 'current' link path, staged link path, old link target, old version) tuples
+        swapped -- set of names of resources whose staged link was renamed over their 'current' link
+        """
+        for resource_name, _, current_rsrc_version_linkpath, staged_linkpath, old_link_target, old_version in staged:
+            try:
+                if resource_name in swapped:
+                    self._backend.symlink(old_link_target, staged_linkpath)
+                    self._backend.rename(staged_linkpath, current_rsrc_version_linkpath)
+                elif self._backend.lexists(staged_linkpath):
+                    self._backend.unlink(staged_linkpath)
+            except OSError:
+                pass
+            if resource_name in self._dropbox_index:
+                self._dropbox_index[resource_name].current_version = old_version
+            self._invalidate_resource_paths(resource_name, [None])
+
+    @unbox_metrics.timed("delete_version")
     def delete_version(self, resource_name, version):
         """Deletes the given version of a Dropbox resource
 
@@ -414,9 +1020,9 @@ class DropboxModule:
             raise ValueError("Cannot delete resource version; cannot find resource")
         if not self.version_exists(resource_name, version):
             raise ValueError("Cannot delete resource version; cannot find version")
-        resource_info = self._dropbox_index[resource_name]
-        resource_versions = resource_info[self._RSRC_INFO_KEY_VERSIONS_INFO]
-        if version == resource_info[self._RSRC_INFO_KEY_CURRENT_VERSION]:
+        resource_record = self._dropbox_index[resource_name]
+        resource_versions = resource_record.versions
+        if version == resource_record.current_version:
             raise ValueError("Cannot delete resource version; version is current version -- change current version first")
         if len(resource_versions) <= 1:
             raise ValueError("Cannot delete resource version; no other versions exist")
@@ -424,10 +1030,202 @@ class DropboxModule:
         # Delete data associated with version and write changes to file
         version_dirpath = os.path.join(
                 self._unbox_dirpath,
-                self._dropbox_index[resource_name][self._RSRC_INFO_KEY_PARENT_DIRNAME],
+                resource_record.parent_dirname,
                 version)
-        shutil.rmtree(version_dirpath)
+        self._backend.rmtree(version_dirpath)
         del(resource_versions[version])
-        self._write_index()
+        self._search_index.remove_version(resource_name, version)
+        self._invalidate_resource_paths(resource_name, [version])
+        self._write_index([resource_name])
+
+
+
+
+    def version_checksums(self, resource_name, version):
+        """Gets the checksums recorded for a version's files by the last scrub
+
+        Keyword Args:
+        resource_name -- name of resource
+        version -- name of version
+
+        Return:
+        Dict of file paths relative to the version directory -> [hex digest, size, whole-second mtime], or None if never scrubbed
+        """
+        if not self.version_exists(resource_name, version):
+            raise ValueError("Cannot get version checksums; cannot find version")
+        return self._dropbox_index[resource_name].versions[version].checksums
+
+    def record_version_checksums(self, updates):
+        """Records scrub checksums for many versions with a single index commit
+        NOTE: Versions deleted since they were scrubbed are skipped
+
+        Keyword Args:
+        updates -- iterable of (resource name, version, dict of checksums) tuples
+        """
+        changed_resources = set()
+        for resource_name, version, checksums in updates:
+            if resource_name in self._dropbox_index and version in self._dropbox_index[resource_name].versions:
+                self._dropbox_index[resource_name].versions[version].checksums = checksums
+                changed_resources.add(resource_name)
+        if len(changed_resources) > 0:
+            self._write_index(changed_resources)
+
+    def _cached_content_hash(self, filepath, file_stat):
+        """Gets a file's content hash, reading the file only if it changed since it was last hashed
+
+        Keyword Args:
+        filepath -- path of file
+        file_stat -- lstat result for the file
 
+        Return:
+        Content hash of the file
+        """
+        stat_key = (file_stat.st_size, file_stat.st_mtime, file_stat.st_ino)
+        cached = self._content_hashes.get(filepath)
+        if cached is not None and cached[0] == stat_key:
+            return cached[1]
+        content_hash = unbox_links.content_hash(filepath, self._backend)
+        self._content_hashes[filepath] = (stat_key, content_hash)
+        return content_hash
+
+    def _diff_trees(self, old_path, new_path, relative_path, changes):
+        """Compares two file objects, recursing into directories
+        NOTE: Files with equal sizes and modification times are taken to be unchanged without being read; like rsync,
+        times are compared to the second, since copies don't always keep sub-second precision
+
+        Keyword Args:
+        old_path -- path of file object in the older version
+        new_path -- path of file object in the newer version
+        relative_path -- path of the file objects relative to their version directories
+        changes -- list to append (change kind, relative path) tuples to
+        """
+        old_stat = self._backend.lstat(old_path)
+        new_stat = self._backend.lstat(new_path)
+        if stat.S_IFMT(old_stat.st_mode) != stat.S_IFMT(new_stat.st_mode):
+            changes.append((self.DIFF_MODIFIED, relative_path))
+        elif stat.S_ISDIR(new_stat.st_mode):
+            old_names = set(self._backend.listdir(old_path))
+            new_names = set(self._backend.listdir(new_path))
+            for name in sorted(old_names | new_names):
+                child_relative_path = os.path.join(relative_path, name)
+                if name not in new_names:
+                    changes.append((self.DIFF_REMOVED, child_relative_path))
+                elif name not in old_names:
+                    changes.append((self.DIFF_ADDED, child_relative_path))
+                else:
+                    self._diff_trees(os.path.join(old_path, name), os.path.join(new_path, name), child_relative_path, changes)
+        elif stat.S_ISLNK(new_stat.st_mode):
+            if self._backend.readlink(old_path) != self._backend.readlink(new_path):
+                changes.append((self.DIFF_MODIFIED, relative_path))
+        elif old_stat.st_size != new_stat.st_size:
+            changes.append((self.DIFF_MODIFIED, relative_path))
+        elif int(old_stat.st_mtime) != int(new_stat.st_mtime):
+            if self._cached_content_hash(old_path, old_stat) != self._cached_content_hash(new_path, new_stat):
+                changes.append((self.DIFF_MODIFIED, relative_path))
+
+    def diff_versions(self, resource_name, old_version, new_version):
+        """Compares two versions of a resource using file metadata, reading only files whose size matches but timestamp doesn't
+
+        Keyword Args:
+        resource_name -- name of resource
+        old_version -- version to compare from; 'current' for the current version
+        new_version -- version to compare to; 'current' for the current version
 
+        Return:
+        List of (change kind, path relative to the version directory) tuples in tree order, using the DIFF_* constants
+        An added or removed directory is reported once, without its contents
+        """
+        # Sanity checks
+        if not self.resource_exists(resource_name):
+            raise ValueError("Cannot diff resource versions; cannot find resource")
+        resource_record = self._dropbox_index[resource_name]
+        versions = []
+        for version in (old_version, new_version):
+            if version == self._CURRENT_RSRC_VERSION_KEYWORD:
+                version = resource_record.current_version
+            if not self.version_exists(resource_name, version):
+                raise ValueError("Cannot diff resource versions; cannot find version '" + str(version) + "'")
+            versions.append(version)
+
+        changes = []
+        self._diff_trees(self.resource_path(resource_name, versions[0]), self.resource_path(resource_name, versions[1]), resource_name, changes)
+        return changes
+
+
+
+    """ ======= Estimate Methods ======= """
+    def _index_growth(self, entry_key, entry_value):
+        """Estimates how much the pickled index grows when an entry is added to one of its dicts
+
+        Keyword Args:
+        entry_key -- key of new entry
+        entry_value -- serialized value of new entry
+
+        Return:
+        Estimated growth in bytes
+        """
+        return (len(pickle.dumps({ entry_key : entry_value }, self._INDEX_PICKLE_PROTOCOL))
+                - len(pickle.dumps(dict(), self._INDEX_PICKLE_PROTOCOL)))
+
+    def estimate_add_resources(self, resources, stat_cache=None):
+        """Predicts the cost of add_resources without copying anything
+
+        Keyword Args:
+        resources -- iterable of (local path, version, dependencies) tuples, as taken by add_resources
+        stat_cache -- unbox_filesystem.StatCache to read file information through (default: a new cache)
+
+        Return:
+        CostEstimate for the items that would pass validation
+        """
+        if stat_cache is None:
+            stat_cache = unbox_filesystem.StatCache(self._backend)
+        estimate = unbox_estimate.CostEstimate()
+        batch_names = set()
+        for item in resources:
+            local_path, version, dependencies = (tuple(item) + (None, None))[:3]
+            try:
+                abs_local_path, resource_name, version = self._validate_new_resource(local_path, "1.0" if version == None else version)
+            except ValueError:
+                continue
+            if resource_name in batch_names:
+                continue
+            batch_names.add(resource_name)
+
+            # Resource data, plus the resource directory, version directory and 'current' symlink
+            tree_bytes, tree_files = unbox_estimate.tree_cost(stat_cache, abs_local_path)
+            estimate.bytes_to_copy += tree_bytes
+            estimate.files_to_create += tree_files + 3
+            resource_record = unbox_records.ResourceRecord(str(uuid.uuid4()), version,
+                    { version : unbox_records.VersionRecord(dependencies) })
+            estimate.index_growth += self._index_growth(resource_name, resource_record.serialize())
+        return estimate
+
+    def estimate_copy_version(self, resource_name, source_version, new_version, stat_cache=None):
+        """Predicts the cost of copy_version without copying anything
+
+        Keyword Args:
+        resource_name -- name of resource to create version for
+        source_version -- version to copy resource from
+        new_version -- name of new version
+        stat_cache -- unbox_filesystem.StatCache to read file information through (default: a new cache)
+
+        Return:
+        CostEstimate for the copy
+        """
+        if stat_cache is None:
+            stat_cache = unbox_filesystem.StatCache(self._backend)
+        if not self.resource_exists(resource_name):
+            raise ValueError("Cannot estimate resource version copy; cannot find resource")
+        if not self.version_exists(resource_name, source_version):
+            raise ValueError("Cannot estimate resource version copy; cannot find source version")
+        if self.version_exists(resource_name, new_version):
+            raise ValueError("Cannot estimate resource version copy; version already exists")
+
+        # Resource data plus the version directory
+        estimate = unbox_estimate.CostEstimate()
+        tree_bytes, tree_files = unbox_estimate.tree_cost(stat_cache, self.resource_path(resource_name, source_version))
+        estimate.bytes_to_copy = tree_bytes
+        estimate.files_to_create = tree_files + 1
+        version_record = self._dropbox_index[resource_name].versions[source_version]
+        estimate.index_growth = self._index_growth(new_version, version_record.serialize())
+        return estimate
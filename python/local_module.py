@@ -1,8 +1,13 @@
 import os
-import shutil
+import stat
 import json
 import uuid
+import unbox_backend
 import unbox_filesystem
+import unbox_records
+import unbox_links
+import unbox_metrics
+import unbox_estimate
 
 class LocalModule:
     """Module for the Unbox filesystem to handle local Unbox directory-related commands
@@ -20,21 +25,31 @@ class LocalModule:
     # Key 
     _IGNORED_RESOURCES_LIST_KEY = "ignored_resources"
 
-    # Path symlink points to
-    _UNBXD_RSRC_INFO_KEY_LINKTARGET = "link_target"
+    # Key to the generation counter of an index file, increased with every committed change
+    _GENERATION_KEY = "generation"
 
-    # Name of resource
-    _UNBXD_RSRC_INFO_KEY_NAME = "resource_name"
+    # Name of file holding metric totals accumulated over every run on this machine
+    _METRICS_FILENAME = "metrics.json"
 
-    # Version of resource 
-    _UNBXD_RSRC_INFO_KEY_VERSION = "resource_version"
+    # Name of directory holding each profile's cached link plan
+    _PLANS_DIRNAME = "plans"
 
-    # Ignore new versions of resource
-    _UNBXD_RSRC_INFO_KEY_IGNORENEW = "ignore_new_versions"
+    # Name of file caching the link destinations a rule file maps resources to
+    _RULES_CACHE_FILENAME = "rules_cache.json"
+
+    # Name of file holding the scrub cursor and the latest result for each scrubbed version and backup
+    _SCRUB_STATE_FILENAME = "scrub.json"
+
+    # Name of file holding the content fingerprints and pending edits of resources watched for automatic versioning
+    _AUTOVERSION_STATE_FILENAME = "autoversion.json"
+
+    # Name of directory holding template resources rendered with this machine's template variables
+    _RENDERS_DIRNAME = "renders"
 
     # Constants for dealing with the backup system
     _BACKUP_DIRNAME = "backups"
     _BACKUP_INDEX_FILENAME = "index.json"
+    _BACKUPS_DICT_KEY = "backups"
 
 
 
@@ -42,28 +57,44 @@ class LocalModule:
     # Path to local Unbox directory
     _local_unbox_dirpath = ""
 
-    # Mapping resources on local machine -> resource types on the machine {
-    _local_index = {
-        # Maps symlink's paths ->
-            # resource path
-            # resource name
-            # resource version
-            # whether link should ignore new resource versions
-        _UNBOXED_RESOURCES_DICT_KEY : dict(),
-        _IGNORED_RESOURCES_LIST_KEY : list()
-    }
-
-    # Mapping resources in backup -> directory in backup directory containing resource
+    # Mapping symlink paths on local machine -> LinkRecord of
+        # resource path
+        # resource name
+        # resource version
+        # whether link should ignore new resource versions
+    _links = dict()
+
+    # List of ignored resources
+    _ignored_resources = list()
+
+    # Mapping resources in backup -> BackupRecord of directory in backup directory containing resource
     _backup_index = dict()
 
+    # Generations of the local and backup index files the in-memory indexes were last synced with
+    _local_generation = 0
+    _backup_generation = 0
+
+    # Reverse index mapping resource names -> resource versions -> set of paths of links to that version
+    _links_by_resource = dict()
 
+    # Whether new symlinks point at their resources with paths relative to the link's directory
+    _relative_links = False
 
-    def __init__(self, local_unbox_dirpath):
+    # Filesystem backend every file operation goes through
+    _backend = unbox_backend.OS_BACKEND
+
+
+
+    def __init__(self, local_unbox_dirpath, relative_links=False, backend=None):
         """Instantiates a new module to manage the local Unbox directory
 
         Keyword Args:
         local_unbox_dirpath -- path to the local Unbox directory
+        relative_links -- whether to create symlinks with relative targets, so link trees survive relocation (default: False)
+        backend -- unbox_backend filesystem backend to perform every file operation through (default: the real filesystem)
         """
+        self._relative_links = relative_links
+        self._backend = backend or unbox_backend.OS_BACKEND
         local_unbox_dirpath = unbox_filesystem.abs_path(local_unbox_dirpath)
 
         # Test if local Unbox directory exists and create if not
@@ -76,19 +107,11 @@ class LocalModule:
         # Register input variables
         self._local_unbox_dirpath = local_unbox_dirpath
 
-        # Read backup index file
-        backup_index_filepath = os.path.join(local_unbox_dirpath, self._BACKUP_DIRNAME, self._BACKUP_INDEX_FILENAME)
-        if os.path.isfile(backup_index_filepath):
-            backup_index_fp = open(backup_index_filepath, "r")
-            self._backup_index = json.load(backup_index_fp)
-            backup_index_fp.close()
-
-        # Read local index file
-        local_index_filepath = os.path.join(self._local_unbox_dirpath, self._INDEX_FILENAME)
-        if os.path.isfile(local_index_filepath):
-            dropbox_index_fp = open(dropbox_index_filepath, "r")
-            self._dropbox_index = json.load(dropbox_index_fp)
-            dropbox_index_fp.close()
+        # Read index files; readers share the locks so they never see a write in progress
+        with self._backend.shared_lock(self._backup_index_filepath()):
+            self._load_backup_index(*self._read_backup_index_file())
+        with self._backend.shared_lock(self._local_index_filepath()):
+            self._load_local_index(*self._read_local_index_file())
 
 
 
@@ -101,7 +124,7 @@ class LocalModule:
         path -- path to local Unbox directory
         """
         backup_dir = os.path.join(path, self._BACKUP_DIRNAME)
-        return os.path.isdir(path) and os.path.isdir(backup_dir)
+        return self._backend.isdir(path) and self._backend.isdir(backup_dir)
 
     def _make_local_dir(self, path):
         """Creates the elements of a local Unbox directory
@@ -109,20 +132,120 @@ class LocalModule:
         Keyword Args:
         path -- path to Unbox directory
         """
-        if not os.path.isdir(path):
-            os.mkdir(path)
+        if not self._backend.isdir(path):
+            self._backend.mkdir(path)
         backup_dir = os.path.join(path, self._BACKUP_DIRNAME)
-        if not os.path.isdir(backup_dir):
-            os.mkdir(backup_dir)
+        if not self._backend.isdir(backup_dir):
+            self._backend.mkdir(backup_dir)
 
 
     """ ========== Non-Backup Functions =========== """
-    def _write_local_index(self):
-        """Writes the in-memory local index to the local index file"""
-        INDEX_FILEPATH = os.path.join(self._local_unbox_dirpath, self._INDEX_FILENAME)
-        local_index_fp = open(INDEX_FILEPATH, "w")
-        json.dump(self._local_index, local_index_fp, indent=4)
+    def _local_index_filepath(self):
+        """Gets the path to the local index file"""
+        return os.path.join(self._local_unbox_dirpath, self._INDEX_FILENAME)
+
+    def _read_local_index_file(self):
+        """Reads the local index file
+        NOTE: The caller must hold a lock on the local index file
+
+        Returns:
+        Tuple of (index generation, dict of link paths -> serialized link info, list of ignored resources)
+        """
+        local_index_filepath = self._local_index_filepath()
+        if not self._backend.isfile(local_index_filepath):
+            return (0, dict(), list())
+        local_index_fp = self._backend.open(local_index_filepath, "r")
+        local_index = json.load(local_index_fp)
         local_index_fp.close()
+        return (
+                local_index.get(self._GENERATION_KEY, 0),
+                local_index[self._UNBOXED_RESOURCES_DICT_KEY],
+                local_index[self._IGNORED_RESOURCES_LIST_KEY]
+        )
+
+    def _load_local_index(self, generation, serialized_links, ignored_resources):
+        """Replaces the in-memory local index with the given index contents
+
+        Keyword Args:
+        generation -- generation of the index contents
+        serialized_links -- dict of link paths -> serialized link info
+        ignored_resources -- list of ignored resources
+        """
+        self._local_generation = generation
+        self._links = dict()
+        for link_path, link_info in serialized_links.items():
+            self._links[link_path] = unbox_records.LinkRecord.deserialize(link_info)
+        self._ignored_resources = [unbox_records.intern_string(resource) for resource in ignored_resources]
+        # Ignored resources as of that generation, which changes are merged from if another writer committed since
+        self._synced_ignored_resources = set(self._ignored_resources)
+
+        # Build reverse index of links from the local index
+        self._links_by_resource = dict()
+        for link_path, link_record in self._links.items():
+            self._index_link(link_path, link_record.resource_name, link_record.resource_version)
+
+    def _write_local_index(self, changed_links):
+        """Writes the in-memory local index to the local index file
+        NOTE: If another writer committed since the index was last read, its changes are merged in first; 
+        for links changed on both sides, this module's version wins, and the resources this module ignored or stopped
+        ignoring since are added to or removed from the other writer's ignored list
+
+        Keyword Args:
+        changed_links -- iterable of paths of links added, modified or deleted since the last write
+        """
+        local_index_filepath = self._local_index_filepath()
+        with self._backend.exclusive_lock(local_index_filepath):
+            disk_generation, disk_links, disk_ignored_resources = self._read_local_index_file()
+            if disk_generation != self._local_generation:
+                for link_path in changed_links:
+                    if link_path in self._links:
+                        disk_links[link_path] = self._links[link_path].serialize()
+                    else:
+                        disk_links.pop(link_path, None)
+                ignored_resources = set(self._ignored_resources)
+                merged_ignored_resources = [resource for resource in disk_ignored_resources
+                        if resource in ignored_resources or resource not in self._synced_ignored_resources]
+                merged_ignored_resources.extend([resource for resource in self._ignored_resources
+                        if resource not in self._synced_ignored_resources and resource not in merged_ignored_resources])
+                self._load_local_index(disk_generation, disk_links, merged_ignored_resources)
+            new_generation = max(disk_generation, self._local_generation) + 1
+            local_index = {
+                self._GENERATION_KEY : new_generation,
+                self._UNBOXED_RESOURCES_DICT_KEY : dict([(link_path, link_record.serialize()) for link_path, link_record in self._links.items()]),
+                self._IGNORED_RESOURCES_LIST_KEY : self._ignored_resources
+            }
+            index_bytes = self._backend.atomic_write(local_index_filepath, 
+                    lambda local_index_fp: local_index_fp.write(json.dumps(local_index, indent=4).encode("utf-8")))
+            unbox_metrics.INDEX_BYTES_WRITTEN.inc(index_bytes)
+            self._local_generation = new_generation
+            self._synced_ignored_resources = set(self._ignored_resources)
+
+    def _index_link(self, link_path, resource_name, resource_version):
+        """Registers a link in the reverse index
+
+        Keyword Args:
+        link_path -- path of link
+        resource_name -- name of resource the link points to
+        resource_version -- version of resource the link points to
+        """
+        resource_versions = self._links_by_resource.setdefault(resource_name, dict())
+        resource_versions.setdefault(resource_version, set()).add(link_path)
+
+    def _unindex_link(self, link_path, resource_name, resource_version):
+        """Removes a link from the reverse index
+
+        Keyword Args:
+        link_path -- path of link
+        resource_name -- name of resource the link points to
+        resource_version -- version of resource the link points to
+        """
+        resource_versions = self._links_by_resource.get(resource_name, dict())
+        version_links = resource_versions.get(resource_version, set())
+        version_links.discard(link_path)
+        if len(version_links) == 0:
+            resource_versions.pop(resource_version, None)
+        if len(resource_versions) == 0:
+            self._links_by_resource.pop(resource_name, None)
 
 
 
@@ -136,7 +259,7 @@ class LocalModule:
         Returns:
         True if the link is being tracked, false otherwise
         """
-        return link_path in self._local_index[_UNBOXED_RESOURCES_DICT_KEY]
+        return os.path.abspath(link_path) in self._links
 
     def link_info(self, link_path):
         """Gets the info dict for the link
@@ -154,30 +277,75 @@ class LocalModule:
         if not self.link_exists(link_path):
             raise ValueError("Could not get link info; link is not being tracked")
 
-        link_info = self._local_index[_UNBOXED_RESOURCES_DICT_KEY][link_path]
+        link_record = self._links[os.path.abspath(link_path)]
         return (
-                link_info[_UNBXD_RSRC_INFO_KEY_LINKTARGET],
-                link_info[_UNBXD_RSRC_INFO_KEY_NAME],
-                link_info[_UNBXD_RSRC_INFO_KEY_VERSION],
-                link_info[_UNBXD_RSRC_INFO_KEY_IGNORENEW]
+                link_record.link_target,
+                link_record.resource_name,
+                link_record.resource_version,
+                link_record.ignore_new
         )
 
+    def link_strategy(self, link_path):
+        """Gets how a link's resource is materialized at the link path
 
-    def add_link(self, link_path, resource_path, resource_name, resource_version, ignore_new=False):
-        """Tracks a resource locally
+        Keyword Args:
+        link_path -- path to the link
+
+        Returns:
+        Tuple of (materialization strategy, hash of the materialized content or None for symlinks)
+        """
+        if not self.link_exists(link_path):
+            raise ValueError("Could not get link strategy; link is not being tracked")
+
+        link_record = self._links[os.path.abspath(link_path)]
+        return (link_record.strategy, link_record.content_hash)
+
+    def link_content_stats(self, link_path):
+        """Gets the stat signatures of a materialized link's content and its target, taken when the content was last materialized
+
+        Keyword Args:
+        link_path -- path to the link
+
+        Returns:
+        List of [link path, link target] stat signatures, or None if they weren't recorded and the content must be hashed
+        """
+        if not self.link_exists(link_path):
+            raise ValueError("Could not get link content stats; link is not being tracked")
+
+        return self._links[os.path.abspath(link_path)].content_stats
+
+    def _content_stats(self, link_path, resource_path):
+        """Takes the stat signatures of freshly materialized content at a link path and of the resource it was materialized from
+
+        Keyword Args:
+        link_path -- path of materialized link
+        resource_path -- path of resource
+
+        Returns:
+        List of [link path, resource path] stat signatures
+        """
+        return [unbox_links.stat_signature(link_path, self._backend), unbox_links.stat_signature(resource_path, self._backend)]
+
+
+    def _validate_new_link(self, link_path, resource_path, resource_name, resource_version, ignore_new, strategy):
+        """Checks that a new link can be added
 
         Keyword Args:
         link_path -- path to place the symlink in
         resource_path -- path of resource to link to
+        resource_name -- name of target resource
         resource_version -- version of target resource being used
         ignore_new -- whether the link shouldn't care about new resource versions
+        strategy -- how to materialize the resource at the link path
+
+        Returns:
+        Tuple of (absolute link path, absolute resource path, stripped resource name, stripped resource version)
         """
-        # Sanity checks
         link_path = os.path.abspath(link_path)
         resource_path = os.path.abspath(resource_path)
-        if not os.path.exists(resource_path):
+        if not self._backend.exists(resource_path):
             raise ValueError("Cannot add link; resource at given path does not exist")
-        if os.path.exists(link_path):
+        if self._backend.exists(link_path):
             raise ValueError("Cannot add link; file already exists at link path")
         if resource_name == None or len(resource_name.strip()) == 0:
             raise ValueError("Cannot add link; resource name is empty")
@@ -185,21 +353,78 @@ class LocalModule:
             raise ValueError("Cannot add link; resource version is empty")
         if ignore_new != True and ignore_new != False:
             raise ValueError("Cannod add link; non-boolean value for ignore_new")
-        resource_name = resource_name.strip()
-        resource_version = resource_version.strip()
-
-        # Add symlink to the filesystem
-        os.symlink(link_path, resource_path)
-
-        # Register addition in local index
-        link_info = {
-            _UNBXD_RSRC_INFO_KEY_LINKTARGET : resource_path,
-            _UNBXD_RSRC_INFO_KEY_NAME : resource_name,
-            _UNBXD_RSRC_INFO_KEY_VERSION : resource_version,
-            _UNBXD_RSRC_INFO_KEY_IGNORENEW : ignore_new
-        }
-        self._local_index[_UNBOXED_RESOURCES_DICT_KEY][link_path] = link_info
-        self._write_local_index()
+        if strategy not in unbox_links.STRATEGIES:
+            raise ValueError("Cannot add link; unknown link strategy '" + str(strategy) + "'")
+        return (link_path, resource_path, resource_name.strip(), resource_version.strip())
+
+    def add_link(self, link_path, resource_path, resource_name, resource_version, ignore_new=False, strategy=unbox_links.STRATEGY_SYMLINK):
+        """Tracks a resource locally
+
+        Keyword Args:
+        link_path -- path to place the symlink in
+        resource_path -- path of resource to link to
+        resource_version -- version of target resource being used
+        ignore_new -- whether the link shouldn't care about new resource versions
+        strategy -- how to materialize the resource at the link path; one of the unbox_links.STRATEGY_* constants (default: symlink)
+        """
+        _, _, error = self.add_links([(link_path, resource_path, resource_name, resource_version, ignore_new, strategy)])[0]
+        if error is not None:
+            raise ValueError(error)
+
+    @unbox_metrics.timed("add_links")
+    def add_links(self, links):
+        """Tracks many resources locally, creating symlinks directory by directory and writing the local index once
+
+        Keyword Args:
+        links -- iterable of (link path, resource path, resource name, resource version, ignore_new[, strategy]) tuples; strategy defaults to symlink
+
+        Returns:
+        List of (link path, outcome, error message) tuples in input order; error message is None if the link was added
+        """
+        # Sanity checks
+        report = []
+        to_link = []
+        for link in links:
+            link_path, resource_path, resource_name, resource_version, ignore_new = link[:5]
+            strategy = link[5] if len(link) > 5 else unbox_links.STRATEGY_SYMLINK
+            try:
+                link_path, resource_path, resource_name, resource_version = self._validate_new_link(
+                        link_path, resource_path, resource_name, resource_version, ignore_new, strategy)
+                to_link.append((len(report), link_path, resource_path, resource_name, resource_version, ignore_new, strategy))
+                report.append(None)
+            except ValueError as e:
+                report.append((link_path, unbox_links.LINK_FAILED, str(e)))
+
+        # Add symlinks to the filesystem a directory at a time, then hardlink, clone or copy the rest
+        symlinks = [link for link in to_link if link[6] == unbox_links.STRATEGY_SYMLINK]
+        link_results = dict(zip([link[0] for link in symlinks], unbox_links.materialize_links(
+                [(resource_path, link_path) for _, link_path, resource_path, _, _, _, _ in symlinks],
+                relative=self._relative_links, backend=self._backend)))
+        content_hashes = dict()
+        for report_idx, link_path, resource_path, _, _, _, strategy in to_link:
+            if strategy == unbox_links.STRATEGY_SYMLINK:
+                continue
+            try:
+                outcome, content_hash = unbox_links.materialize_content(resource_path, link_path, strategy, backend=self._backend)
+                content_hashes[report_idx] = (content_hash, self._content_stats(link_path, resource_path))
+                link_results[report_idx] = (link_path, outcome, None)
+            except (IOError, OSError, ValueError) as e:
+                link_results[report_idx] = (link_path, unbox_links.LINK_FAILED, str(e))
+
+        # Register additions in local index
+        added_links = []
+        for report_idx, link_path, resource_path, resource_name, resource_version, ignore_new, strategy in to_link:
+            report[report_idx] = link_results[report_idx]
+            if link_results[report_idx][1] == unbox_links.LINK_FAILED:
+                continue
+            content_hash, content_stats = content_hashes.get(report_idx, (None, None))
+            self._links[link_path] = unbox_records.LinkRecord(resource_path, resource_name, resource_version, ignore_new, strategy, content_hash, content_stats)
+            self._index_link(link_path, resource_name, resource_version)
+            added_links.append(link_path)
+        unbox_metrics.LINKS_CREATED.inc(len(added_links))
+        if len(added_links) > 0:
+            self._write_local_index(added_links)
+        return report
 
     def delete_link(self, link_path):
         """Deletes a resource being tracked locally
@@ -210,9 +435,125 @@ class LocalModule:
         if not self.link_exists(link_path):
             raise ValueError("Could not delete link; link does not exist")
 
-        os.remove(link_path)
-        del self._local_index[_UNBOXED_RESOURCES_DICT_KEY][link_path]
-        self._write_index()
+        self.delete_links([link_path])
+
+    @unbox_metrics.timed("delete_links")
+    def delete_links(self, link_paths):
+        """Deletes many links being tracked locally, writing the local index once
+
+        Keyword Args:
+        link_paths -- iterable of paths of links to delete
+        """
+        link_paths = [os.path.abspath(link_path) for link_path in link_paths]
+        for link_path in link_paths:
+            if not self.link_exists(link_path):
+                raise ValueError("Could not delete links; link " + link_path + " does not exist")
+
+        for link_path in link_paths:
+            link_record = self._links[link_path]
+            if link_record.strategy == unbox_links.STRATEGY_SYMLINK:
+                if self._backend.islink(link_path):
+                    self._backend.remove(link_path)
+            elif (self._backend.exists(link_path) and not self._backend.islink(link_path)
+                    and unbox_links.content_hash(link_path, self._backend) == link_record.content_hash):
+                # Only remove materialized copies that haven't been modified since Unbox placed them
+                if self._backend.isdir(link_path):
+                    self._backend.rmtree(link_path)
+                else:
+                    self._backend.remove(link_path)
+            del self._links[link_path]
+            self._unindex_link(link_path, link_record.resource_name, link_record.resource_version)
+        unbox_metrics.LINKS_REMOVED.inc(len(link_paths))
+        if len(link_paths) > 0:
+            self._write_local_index(link_paths)
+
+    def dependent_links(self, resource_name, resource_version=None):
+        """Gets the links pointing to a resource, using the reverse index
+
+        Keyword Args:
+        resource_name -- name of resource
+        resource_version -- version of resource (default: all versions)
+
+        Returns:
+        Set of paths of links pointing to the resource
+        """
+        resource_versions = self._links_by_resource.get(resource_name, dict())
+        if resource_version is not None:
+            return set(resource_versions.get(resource_version, set()))
+        dependents = set()
+        for version_links in resource_versions.values():
+            dependents.update(version_links)
+        return dependents
+
+    @unbox_metrics.timed("retarget_links")
+    def retarget_links(self, link_paths, resource_path, resource_version):
+        """Points many links at a new version of their resource, writing the local index once
+        NOTE: Links already pointing at the given path only have their recorded version changed, and copies whose content
+        is unchanged aren't rewritten
+
+        Keyword Args:
+        link_paths -- iterable of paths of links to retarget
+        resource_path -- path of resource to point links to
+        resource_version -- version of resource at the given path
+        """
+        self.retarget_link_groups([(link_paths, resource_path, resource_version)])
+
+    def retarget_link_groups(self, retargets):
+        """Points groups of links at new versions of their resources, writing the local index once for all of them
+        NOTE: Links already pointing at the given path only have their recorded version changed, and copies whose content
+        is unchanged aren't rewritten
+
+        Keyword Args:
+        retargets -- iterable of (iterable of paths of links to retarget, path of resource to point them to, version of resource at that path) tuples
+        """
+        # Sanity checks
+        targets = dict()
+        for link_paths, resource_path, resource_version in retargets:
+            resource_path = os.path.abspath(resource_path)
+            if not self._backend.exists(resource_path):
+                raise ValueError("Cannot retarget links; resource at given path does not exist")
+            if resource_version == None or len(resource_version.strip()) == 0:
+                raise ValueError("Cannot retarget links; resource version is empty")
+            for link_path in link_paths:
+                link_path = os.path.abspath(link_path)
+                if not self.link_exists(link_path):
+                    raise ValueError("Cannot retarget links; link " + link_path + " is not being tracked")
+                targets[link_path] = (resource_path, resource_version.strip())
+        link_paths = sorted(targets)
+
+        symlink_paths = [link_path for link_path in link_paths if self._links[link_path].strategy == unbox_links.STRATEGY_SYMLINK]
+        link_results = unbox_links.materialize_links([(targets[link_path][0], link_path) for link_path in symlink_paths],
+                relative=self._relative_links, backend=self._backend)
+        content_hashes = dict()
+        for link_path in link_paths:
+            link_record = self._links[link_path]
+            if link_record.strategy == unbox_links.STRATEGY_SYMLINK:
+                continue
+            resource_path = targets[link_path][0]
+            try:
+                outcome, content_hash = unbox_links.materialize_content(resource_path, link_path, link_record.strategy, link_record.content_hash,
+                        backend=self._backend)
+                content_hashes[link_path] = (content_hash, self._content_stats(link_path, resource_path))
+                link_results.append((link_path, outcome, None))
+            except (IOError, OSError, ValueError) as e:
+                link_results.append((link_path, unbox_links.LINK_FAILED, str(e)))
+        failures = []
+        for link_path, outcome, error in link_results:
+            if outcome == unbox_links.LINK_FAILED:
+                failures.append(link_path + ": " + error)
+                continue
+            link_record = self._links[link_path]
+            link_record.link_target, resource_version = targets[link_path]
+            if link_path in content_hashes:
+                link_record.content_hash, link_record.content_stats = content_hashes[link_path]
+            self._unindex_link(link_path, link_record.resource_name, link_record.resource_version)
+            link_record.resource_version = unbox_records.intern_string(resource_version)
+            self._index_link(link_path, link_record.resource_name, link_record.resource_version)
+        unbox_metrics.LINKS_RETARGETED.inc(len(link_paths) - len(failures))
+        if len(link_paths) > len(failures):
+            self._write_local_index(link_paths)
+        if len(failures) > 0:
+            raise ValueError("Cannot retarget links; " + "; ".join(failures))
 
 
     def set_ignore_new(self, link_path, ignore_new):
@@ -228,8 +569,116 @@ class LocalModule:
         if ignore_new != True and ignore_new != False:
             raise ValueError("Could not set 'ignore new' field; new value is not boolean")
 
-        self._local_index[_UNBOXED_RESOURCES_DICT_KEY][link_path][_UNBXD_RSRC_INFO_KEY_IGNORENEW] = ignore_new
-        self._write_local_index()
+        link_path = os.path.abspath(link_path)
+        self._links[link_path].ignore_new = ignore_new
+        self._write_local_index([link_path])
+
+    def set_ignored(self, resource_name, ignored):
+        """Sets whether the user chose not to link a resource
+
+        Keyword Args:
+        resource_name -- name of resource
+        ignored -- boolean value to set
+        """
+        # Sanity check
+        if resource_name == None or len(resource_name.strip()) == 0:
+            raise ValueError("Could not set ignored resource; resource name is empty")
+        if ignored != True and ignored != False:
+            raise ValueError("Could not set ignored resource; new value is not boolean")
+
+        resource_name = unbox_records.intern_string(resource_name.strip())
+        if ignored == (resource_name in self._ignored_resources):
+            return
+        if ignored:
+            self._ignored_resources.append(resource_name)
+        else:
+            self._ignored_resources.remove(resource_name)
+        self._write_local_index([])
+
+    def links_list(self):
+        """Gets the paths of all links being tracked
+
+        Returns:
+        List of link paths
+        """
+        return list(self._links.keys())
+
+    def iter_links(self, resource_name=None, dirpath=None):
+        """Lazily yields tracked links and their info, filtered through the reverse index where possible
+        NOTE: Links must not be added or deleted while iterating
+
+        Keyword Args:
+        resource_name -- only yield links to this resource (default: links to any resource)
+        dirpath -- only yield links inside this directory (default: links anywhere)
+
+        Returns:
+        Generator of (link path, (link target path, resource name, resource version, ignore_new flag)) tuples
+        """
+        if resource_name is not None:
+            link_paths = (link_path for version_links in self._links_by_resource.get(resource_name, dict()).values() for link_path in version_links)
+        else:
+            link_paths = iter(self._links)
+        if dirpath is not None:
+            dirpath_prefix = os.path.join(unbox_filesystem.abs_path(dirpath), "")
+            link_paths = (link_path for link_path in link_paths if link_path.startswith(dirpath_prefix))
+        for link_path in link_paths:
+            link_record = self._links[link_path]
+            yield (link_path, (link_record.link_target, link_record.resource_name, link_record.resource_version, link_record.ignore_new))
+
+    def ignored_list(self):
+        """Gets the resources the user chose not to link
+
+        Returns:
+        List of ignored resource names
+        """
+        return list(self._ignored_resources)
+
+    def backup_dirpath(self, path):
+        """Gets the directory in the backup system holding a backed-up file object
+
+        Keyword Args:
+        path -- local path of the backed-up file object
+
+        Returns:
+        Path to the directory holding the file object
+        """
+        path = unbox_filesystem.abs_path(path)
+        if not self.backup_exists(path):
+            raise ValueError("Cannot get backup directory; file does not exist in backup")
+        return os.path.join(self._local_unbox_dirpath, self._BACKUP_DIRNAME, self._backup_index[path].dirname)
+
+    def metrics_filepath(self):
+        """Gets the path to the file holding this machine's metric totals"""
+        return os.path.join(self._local_unbox_dirpath, self._METRICS_FILENAME)
+
+    def rules_cache_filepath(self):
+        """Gets the path to the file caching the link destinations a rule file maps resources to"""
+        return os.path.join(self._local_unbox_dirpath, self._RULES_CACHE_FILENAME)
+
+    def scrub_state_filepath(self):
+        """Gets the path to the file holding the scrub cursor and results"""
+        return os.path.join(self._local_unbox_dirpath, self._SCRUB_STATE_FILENAME)
+
+    def autoversion_state_filepath(self):
+        """Gets the path to the file holding the fingerprints and pending edits of automatically versioned resources"""
+        return os.path.join(self._local_unbox_dirpath, self._AUTOVERSION_STATE_FILENAME)
+
+    def render_cache_dirpath(self):
+        """Gets the path to the directory caching rendered template resources, which may not exist yet"""
+        return os.path.join(self._local_unbox_dirpath, self._RENDERS_DIRNAME)
+
+    def plan_filepath(self, profile_name):
+        """Gets the path to the file caching a profile's compiled link plan
+
+        Keyword Args:
+        profile_name -- name of profile
+
+        Returns:
+        Path to the plan file, which may not exist yet
+        """
+        if os.sep in profile_name or profile_name.startswith("."):
+            raise ValueError("Cannot get plan file; profile name '" + profile_name + "' is not a valid filename")
+        return os.path.join(self._local_unbox_dirpath, self._PLANS_DIRNAME, profile_name + ".json")
 
     def check_integrity(self):
         """Checks the integrity of the local store
@@ -242,13 +691,55 @@ class LocalModule:
         """
         nonexistent_links = set()
         broken_links = set()
-        for link_path, link_info in self._local_index[_UNBOXED_RESOURCES_DICT_KEY]:
-            if not os.path.lexists(link_path):
+        for link_path in self._links:
+            if not self._backend.lexists(link_path):
                 nonexistent_links.add(link_path)
-            if os.path.lexists(link_path) and not os.path.exists(link_path):
+            if self._backend.lexists(link_path) and not self._backend.exists(link_path):
                 broken_links.add(link_path)
         return (nonexistent_links, broken_links)
 
+    def estimate_add_links(self, links, stat_cache=None):
+        """Predicts the cost of creating links without changing anything
+        NOTE: Links already in place are free; file objects in the way of a link are counted as backups to take
+
+        Keyword Args:
+        links -- iterable of (link path, resource path, resource name, resource version, ignore_new[, strategy]) tuples, as taken by add_links
+        stat_cache -- unbox_filesystem.StatCache to read file information through (default: a new cache)
+
+        Return:
+        CostEstimate for the links
+        """
+        if stat_cache is None:
+            stat_cache = unbox_filesystem.StatCache(self._backend)
+        estimate = unbox_estimate.CostEstimate()
+        for link in links:
+            link_path, resource_path = os.path.abspath(link[0]), os.path.abspath(link[1])
+            strategy = link[5] if len(link) > 5 else unbox_links.STRATEGY_SYMLINK
+            link_stat = stat_cache.lstat(link_path)
+            if link_stat is not None and stat.S_ISLNK(link_stat.st_mode):
+                if strategy == unbox_links.STRATEGY_SYMLINK and stat_cache.link_target(link_path) == resource_path:
+                    continue
+            elif link_stat is not None:
+                if link_path in self._links and self._links[link_path].strategy == strategy:
+                    continue
+                estimate.backups_to_take += 1
+            estimate.links_to_change += 1
+
+            # Symlinks and hardlinks share the resource's data; clones are counted as copies in case cloning is unsupported
+            tree_bytes, tree_files = unbox_estimate.tree_cost(stat_cache, self._backend.realpath(resource_path))
+            if strategy == unbox_links.STRATEGY_SYMLINK:
+                estimate.files_to_create += 1
+            else:
+                estimate.files_to_create += tree_files
+                if strategy != unbox_links.STRATEGY_HARDLINK:
+                    estimate.bytes_to_copy += tree_bytes
+            if link_path not in self._links:
+                # Non-symlink entries also hold a SHA-256 hex digest
+                content_hash = "0" * 64 if strategy != unbox_links.STRATEGY_SYMLINK else None
+                link_record = unbox_records.LinkRecord(resource_path, link[2], link[3], link[4], strategy, content_hash)
+                estimate.index_growth += len(json.dumps({ link_path : link_record.serialize() }, indent=4)) - len(json.dumps(dict(), indent=4))
+        return estimate
+
 
 
 
@@ -260,7 +751,7 @@ class LocalModule:
         path -- local path to resource
 
         Returns True if the resource is already saved, or False otherwise"""
-        return (path in self._backup_index.keys())
+        return (path in self._backup_index)
 
     """
     Gets the list of backed-up files
@@ -268,6 +759,7 @@ class LocalModule:
     def backup_list(self):
         return self._backup_index.keys()
 
+    @unbox_metrics.timed("backup_add")
     def backup_add(self, path):
         """Moves the given file/directory tree into the backup system
 
@@ -277,7 +769,7 @@ class LocalModule:
         """
         # Check validity
         path = unbox_filesystem.abs_path(path)
-        if not os.path.exists(path):
+        if not self._backend.exists(path):
             raise ValueError("Cannot add file to backup; file does not exist")
         if self.backup_exists(path):
             raise ValueError("Cannot add file to backup; file already exists in backup")
@@ -287,13 +779,15 @@ class LocalModule:
         upstream, basename = os.path.split(path)
         dest_dir = str(uuid.uuid4())
         dest_path = os.path.join(BACKUP_DIRPATH, dest_dir)
-        os.mkdir(dest_path)
-        shutil.move(path, dest_path)
+        self._backend.mkdir(dest_path)
+        self._backend.move(path, dest_path)
 
         # Register the addition in the backup index
-        self._backup_index[path] = dest_dir
-        self._write_backup_index()
+        self._backup_index[path] = unbox_records.BackupRecord(dest_dir)
+        unbox_metrics.BACKUPS_TAKEN.inc()
+        self._write_backup_index([path])
 
+    @unbox_metrics.timed("backup_restore")
     def backup_restore(self, path):
         """Retrieves the file/diretory tree from the backup system
 
@@ -309,14 +803,15 @@ class LocalModule:
         # Restore backed-up resource into original location
         resource_filename = os.path.basename(path)
         BACKUP_DIRPATH = os.path.join(self._local_unbox_dirpath, self._BACKUP_DIRNAME)
-        resource_parent_dirpath = os.path.join(BACKUP_DIRPATH, self._backup_index[path]) 
+        resource_parent_dirpath = os.path.join(BACKUP_DIRPATH, self._backup_index[path].dirname) 
         resource_parent_filepath = os.path.join(resource_parent_dirpath, resource_filename)
-        shutil.move(resource_parent_filepath, path)
-        os.rmdir(resource_parent_dirpath)
+        self._backend.move(resource_parent_filepath, path)
+        self._backend.rmdir(resource_parent_dirpath)
 
         # Register the removal in the backup index 
         del(self._backup_index[path])
-        self._write_backup_index()
+        unbox_metrics.BACKUPS_RESTORED.inc()
+        self._write_backup_index([path])
 
     def backup_delete(self, path):
         """Deletes a resource in the backup system
@@ -334,22 +829,104 @@ class LocalModule:
         # Remove the resource and the directory holding it
         resource_filename = os.path.basename(path)
         BACKUP_DIRPATH = os.path.join(self._local_unbox_dirpath, self._BACKUP_DIRNAME)
-        resource_parent_dirpath = os.path.join(BACKUP_DIRPATH, self._backup_index[path]) 
+        resource_parent_dirpath = os.path.join(BACKUP_DIRPATH, self._backup_index[path].dirname) 
         resource_parent_filepath = os.path.join(resource_parent_dirpath, resource_filename)
-        if os.path.isdir(resource_parent_filepath):
-            shutil.rmtree(saved_local_filepath)
+        if self._backend.isdir(resource_parent_filepath):
+            self._backend.rmtree(resource_parent_filepath)
         else:
-            os.remove(path)
-        os.rmdir(resource_parent_dirpath)
+            self._backend.remove(resource_parent_filepath)
+        self._backend.rmdir(resource_parent_dirpath)
 
         # Register the removal in the backup index 
         del(self._backup_index[path])
-        self._write_backup_index()
+        self._write_backup_index([path])
 
-    def _write_backup_index(self):
-        """Writes the in-memory backup index to the backup index file"""
-        BACKUP_DIRPATH = os.path.join(self._local_unbox_dirpath, self._BACKUP_DIRNAME)
-        BACKUP_INDEX_FILEPATH = os.path.join(BACKUP_DIRPATH, self._BACKUP_INDEX_FILENAME)
-        backup_index_fp = open(BACKUP_INDEX_FILEPATH, "w")
-        json.dump(self._backup_index, backup_index_fp, indent=4)
+    def backup_checksums(self, path):
+        """Gets the checksums recorded for a backup's files by the last scrub
+
+        Keyword Args:
+        path -- local path of the backed-up file object
+
+        Returns:
+        Dict of file paths relative to the backup's directory -> [hex digest, size, whole-second mtime], or None if never scrubbed
+        """
+        if not self.backup_exists(path):
+            raise ValueError("Cannot get backup checksums; file does not exist in backup")
+        return self._backup_index[path].checksums
+
+    def record_backup_checksums(self, updates):
+        """Records scrub checksums for many backups with a single backup index commit
+        NOTE: Backups restored or deleted since they were scrubbed are skipped
+
+        Keyword Args:
+        updates -- iterable of (local path of backed-up file object, dict of checksums) tuples
+        """
+        changed_paths = []
+        for path, checksums in updates:
+            if path in self._backup_index:
+                self._backup_index[path].checksums = checksums
+                changed_paths.append(path)
+        if len(changed_paths) > 0:
+            self._write_backup_index(changed_paths)
+
+    def _backup_index_filepath(self):
+        """Gets the path to the backup index file"""
+        return os.path.join(self._local_unbox_dirpath, self._BACKUP_DIRNAME, self._BACKUP_INDEX_FILENAME)
+
+    def _read_backup_index_file(self):
+        """Reads the backup index file
+        NOTE: The caller must hold a lock on the backup index file
+
+        Returns:
+        Tuple of (index generation, dict of backed-up paths -> serialized backup info)
+        """
+        backup_index_filepath = self._backup_index_filepath()
+        if not self._backend.isfile(backup_index_filepath):
+            return (0, dict())
+        backup_index_fp = self._backend.open(backup_index_filepath, "r")
+        backup_index = json.load(backup_index_fp)
         backup_index_fp.close()
+        # Files written before generations were tracked hold the bare mapping of backed-up paths
+        if self._GENERATION_KEY in backup_index and isinstance(backup_index.get(self._BACKUPS_DICT_KEY), dict):
+            return (backup_index[self._GENERATION_KEY], backup_index[self._BACKUPS_DICT_KEY])
+        return (0, backup_index)
+
+    def _load_backup_index(self, generation, serialized_backups):
+        """Replaces the in-memory backup index with the given index contents
+
+        Keyword Args:
+        generation -- generation of the index contents
+        serialized_backups -- dict of backed-up paths -> serialized backup info
+        """
+        self._backup_generation = generation
+        self._backup_index = dict()
+        for path, backup_info in serialized_backups.items():
+            self._backup_index[path] = unbox_records.BackupRecord.deserialize(backup_info)
+
+    def _write_backup_index(self, changed_paths):
+        """Writes the in-memory backup index to the backup index file
+        NOTE: If another writer committed since the index was last read, its changes are merged in first; 
+        for paths changed on both sides, this module's version wins
+
+        Keyword Args:
+        changed_paths -- iterable of backed-up paths added or removed since the last write
+        """
+        backup_index_filepath = self._backup_index_filepath()
+        with self._backend.exclusive_lock(backup_index_filepath):
+            disk_generation, disk_backups = self._read_backup_index_file()
+            if disk_generation != self._backup_generation:
+                for path in changed_paths:
+                    if path in self._backup_index:
+                        disk_backups[path] = self._backup_index[path].serialize()
+                    else:
+                        disk_backups.pop(path, None)
+                self._load_backup_index(disk_generation, disk_backups)
+            new_generation = max(disk_generation, self._backup_generation) + 1
+            backup_index = {
+                self._GENERATION_KEY : new_generation,
+                self._BACKUPS_DICT_KEY : dict([(path, backup_record.serialize()) for path, backup_record in self._backup_index.items()])
+            }
+            index_bytes = self._backend.atomic_write(backup_index_filepath, 
+                    lambda backup_index_fp: backup_index_fp.write(json.dumps(backup_index, indent=4).encode("utf-8")))
+            unbox_metrics.INDEX_BYTES_WRITTEN.inc(index_bytes)
+            self._backup_generation = new_generation
@@ -1,12 +1,27 @@
 #!/usr/bin/python
 
 import unittest
+import io
+import json
 import os
 import shutil
 import logging
+import pickle
 import sys
+import tarfile
 import dropbox_module
 import local_module
+import unbox_autoversion
+import unbox_backend
+import unbox_core
+import unbox_filesystem
+import unbox_links
+import unbox_metrics
+import unbox_profiles
+import unbox_records
+import unbox_rules
+import unbox_scrub
+import unbox_templates
 
 class TestDropboxModule(unittest.TestCase):
     """Tests the Dropbox filesystem module"""
@@ -83,6 +98,47 @@ class TestDropboxModule(unittest.TestCase):
         # Test a collision
         self.assertRaises(ValueError, test_module.add_resource, TEST_FILENAME)
 
+    def test_bulk_add_resources(self):
+        """Adds a file, a directory, an invalid path and an in-batch collision in one bulk call"""
+        # Set up a file and a directory tree
+        TEST_FILENAME = "test.txt"
+        test_filepath = os.path.join(self._TEST_DIRNAME, TEST_FILENAME)
+        test_fp = open(test_filepath, "w")
+        test_fp.write("This is test text!")
+        test_fp.close()
+
+        TEST_DIRNAME = "test_dir"
+        test_dirpath = os.path.join(self._TEST_DIRNAME, TEST_DIRNAME)
+        os.mkdir(test_dirpath)
+        test_fp = open(os.path.join(test_dirpath, "inner.txt"), "w")
+        test_fp.write("Inner text")
+        test_fp.close()
+
+        test_module = dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+        report = test_module.add_resources([
+                (test_filepath, "2.0", set(["dep1"])),
+                (test_dirpath, None, None),
+                (os.path.join(self._TEST_DIRNAME, "nonexistent"), None, None),
+                (test_filepath, "3.0", None)
+            ])
+
+        # Test per-item results
+        self.assertEqual(4, len(report))
+        self.assertEqual(TEST_FILENAME, report[0][1])
+        self.assertTrue(report[0][3] is None)
+        self.assertTrue(report[1][3] is None)
+        self.assertTrue(report[2][2] is None and report[2][3] is not None)
+        self.assertTrue(report[3][2] is None and report[3][3] is not None)
+
+        # Test index contents and data on disk
+        self.assertEqual(set([TEST_FILENAME, TEST_DIRNAME]), set(test_module.resources_set()))
+        self.assertEqual(set(["dep1"]), test_module.version_info(TEST_FILENAME, "2.0"))
+        self.assertTrue(os.path.isfile(os.path.join(report[1][2], TEST_DIRNAME, "inner.txt")))
+
+        # Test that the index was committed
+        reloaded_module = dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+        self.assertEqual(set([TEST_FILENAME, TEST_DIRNAME]), set(reloaded_module.resources_set()))
+
     def test_delete_resources(self):
         """Tests deletion of resources"""
         # Set up environment
@@ -148,6 +204,194 @@ class TestDropboxModule(unittest.TestCase):
         test_module.delete_version(TEST_FILENAME, COPY_VERSION)
         self.assertRaises(ValueError, test_module.change_current_version, TEST_FILENAME, COPY_VERSION)
 
+    def test_operation_logs(self):
+        """Tests that machines log changes separately and merge concurrent ones the same way, without a shared index write"""
+        def make_module(machine_id):
+            return dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME, machine_id=machine_id,
+                    view_dirpath=os.path.join(self._TEST_DIRNAME, "views_" + machine_id))
+        def merged_index(test_module):
+            return dict([(resource_name, (resource_info[1], sorted(resource_info[2]))) for resource_name, resource_info in test_module.iter_resources()])
+        test_filepath = os.path.join(self._TEST_DIRNAME, "vimrc")
+        open(test_filepath, "w").close()
+        first_module = make_module("first")
+        first_module.add_resource(test_filepath, version="1.0")
+        second_module = make_module("second")
+        self.assertEqual({ "vimrc" : ("1.0", ["1.0"]) }, merged_index(second_module))
+
+        # Concurrent changes to different versions both survive
+        first_module.copy_version("vimrc", "1.0", "2.0")
+        second_module.copy_version("vimrc", "1.0", "3.0")
+        self.assertEqual({ "vimrc" : ("1.0", ["1.0", "2.0", "3.0"]) }, merged_index(second_module))
+        first_module.change_current_version("vimrc", "2.0")
+        first_module.add_version_dependency("vimrc", "2.0", "dep1")
+        self.assertFalse(os.path.exists(os.path.join(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME, "index")))
+
+        # A change logged with an earlier timestamp, e.g. while offline, is merged in order by replaying every log
+        oplog_dirpath = os.path.join(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME, "oplog")
+        offline_fp = open(os.path.join(oplog_dirpath, "offline.log"), "w")
+        offline_fp.write(json.dumps({ "op" : "current", "resource" : "vimrc", "version" : "3.0", "seq" : 0, "ts" : 1.0 }) + "\n")
+        offline_fp.write('{ "op" : "current", "resource" : "vimrc"')
+        offline_fp.close()
+        expected_index = { "vimrc" : ("2.0", ["1.0", "2.0", "3.0"]) }
+        generation = second_module.index_generation()
+        for test_module in (make_module("first"), make_module("second"), make_module("third")):
+            self.assertEqual(expected_index, merged_index(test_module))
+            self.assertEqual(set(["dep1"]), test_module.version_info("vimrc", "2.0"))
+        self.assertTrue(make_module("third").index_generation() > generation)
+        self.assertRaises(ValueError, make_module, "../escape")
+
+        # Cached views stay on each machine, out of the synced log directory
+        self.assertEqual([], [filename for filename in os.listdir(oplog_dirpath) if filename.endswith(".view")])
+        self.assertEqual(1, len(os.listdir(os.path.join(self._TEST_DIRNAME, "views_third"))))
+
+        # When two machines create the same name, the first logged wins and the other's resource is removed, not grafted on
+        first_module, second_module = make_module("first"), make_module("second")
+        clash_filepath = os.path.join(self._TEST_DIRNAME, "clash")
+        open(clash_filepath, "w").close()
+        unbox_dirpath = os.path.join(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+        first_module.add_resource(clash_filepath, version="1.0")
+        unbox_entries = sorted(os.listdir(unbox_dirpath))
+        self.assertRaises(ValueError, second_module.add_resource, clash_filepath, "2.0")
+        self.assertEqual(unbox_entries, sorted(os.listdir(unbox_dirpath)))
+        for test_module in (second_module, make_module("third")):
+            self.assertEqual(["1.0"], test_module.sorted_versions("clash"))
+            self.assertEqual(os.path.realpath(test_module.resource_path("clash", "1.0")), os.path.realpath(test_module.resource_path("clash")))
+
+        # Enough merged operations are folded into a new index file, which machines then merge only later operations on top of
+        first_module = make_module("first")
+        first_module._OPLOG_COMPACT_OPS = 1
+        first_module.copy_version("clash", "1.0", "2.0")
+        self.assertTrue(os.path.isfile(os.path.join(unbox_dirpath, "index")))
+        expected_index, generation = merged_index(first_module), first_module.index_generation()
+        for test_module in (make_module("second"), make_module("fourth")):
+            self.assertEqual((expected_index, generation), (merged_index(test_module), test_module.index_generation()))
+
+        # A machine starts its log over once an index file holds all of it, and machines that read the old log follow along;
+        # merging a few operations doesn't rewrite the cached view
+        second_module = make_module("second")
+        second_view_filepath = os.path.join(self._TEST_DIRNAME, "views_second", os.listdir(os.path.join(self._TEST_DIRNAME, "views_second"))[0])
+        second_view_bytes = open(second_view_filepath, "rb").read()
+        first_module.copy_version("clash", "1.0", "3.0")
+        self.assertEqual(1, len(open(os.path.join(oplog_dirpath, "first.log")).readlines()))
+        second_module.add_version_dependency("clash", "1.0", "dep1")
+        self.assertEqual(second_view_bytes, open(second_view_filepath, "rb").read())
+        expected_index = merged_index(second_module)
+        self.assertEqual(["1.0", "2.0", "3.0"], second_module.sorted_versions("clash"))
+        for test_module in (make_module("first"), make_module("second"), make_module("fifth")):
+            self.assertEqual(expected_index, merged_index(test_module))
+            self.assertEqual(set(["dep1"]), test_module.version_info("clash", "1.0"))
+
+    def test_change_current_versions(self):
+        """Tests that bulk version switches apply to every resource or, on failure, to none"""
+        test_module = dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+        test_filenames = ["vimrc", "vim_plugins"]
+        for test_filename in test_filenames:
+            test_filepath = os.path.join(self._TEST_DIRNAME, test_filename)
+            open(test_filepath, "w").close()
+            test_module.add_resource(test_filepath, version="1.0")
+            test_module.copy_version(test_filename, "1.0", "2.0")
+
+        # Test that invalid changes leave everything untouched
+        self.assertRaises(ValueError, test_module.change_current_versions, [("vimrc", "2.0"), ("vim_plugins", "3.0")])
+        self.assertRaises(ValueError, test_module.change_current_versions, [("vimrc", "2.0"), ("vimrc", "1.0")])
+        self.assertEqual("1.0", test_module.resource_info("vimrc")[1])
+
+        # Test that a failed index commit rolls every 'current' link back
+        generation = test_module.index_generation()
+        def failing_write(changed_resources):
+            raise IOError("Simulated index write failure")
+        test_module._write_index = failing_write
+        self.assertRaises(IOError, test_module.change_current_versions, [(test_filename, "2.0") for test_filename in test_filenames])
+        del test_module._write_index
+        for test_filename in test_filenames:
+            self.assertEqual("1.0", test_module.resource_info(test_filename)[1])
+            self.assertEqual("1.0", os.path.basename(os.path.dirname(os.path.realpath(test_module.resource_path(test_filename)))))
+        self.assertEqual(generation, test_module.index_generation())
+
+        # Test that a commit failing after merging in another writer's delete still reports its own error
+        def merging_failing_write(changed_resources):
+            del test_module._dropbox_index["vimrc"]
+            raise IOError("Simulated index write failure after a merge")
+        test_module._write_index = merging_failing_write
+        self.assertRaises(IOError, test_module.change_current_versions, [(test_filename, "2.0") for test_filename in test_filenames])
+        self.assertEqual("1.0", test_module.resource_info("vim_plugins")[1])
+        test_module = dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+        for test_filename in test_filenames:
+            self.assertEqual("1.0", os.path.basename(os.path.dirname(os.path.realpath(test_module.resource_path(test_filename)))))
+
+        # Test a successful switch commits the index once and leaves no staged links behind
+        test_module.change_current_versions([(test_filename, "2.0") for test_filename in test_filenames])
+        self.assertEqual(generation + 1, test_module.index_generation())
+        reloaded_module = dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+        for test_filename in test_filenames:
+            self.assertEqual("2.0", reloaded_module.resource_info(test_filename)[1])
+            resource_dirpath = os.path.dirname(os.path.dirname(test_module.resource_path(test_filename)))
+            self.assertEqual("2.0", os.path.basename(os.path.realpath(os.path.join(resource_dirpath, "current"))))
+            self.assertEqual(sorted(["1.0", "2.0", "current"]), sorted(os.listdir(resource_dirpath)))
+
+    def test_resource_path_cache(self):
+        """Tests that memoized resource paths are dropped when their version or resource is deleted"""
+        TEST_FILENAME = "test.txt"
+        TEST_FILEPATH = os.path.join(self._TEST_DIRNAME, TEST_FILENAME)
+        test_fp = open(TEST_FILEPATH, "w")
+        test_fp.write("This is test text!")
+        test_fp.close()
+
+        test_module = dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+        test_module.add_resource(TEST_FILEPATH, version="1.0")
+        test_module.copy_version(TEST_FILENAME, "1.0", "2.0")
+
+        # Test that batch and single lookups agree
+        paths = test_module.resource_paths([(TEST_FILENAME, None), (TEST_FILENAME, "1.0"), (TEST_FILENAME, "2.0")])
+        self.assertEqual([test_module.resource_path(TEST_FILENAME), test_module.resource_path(TEST_FILENAME, "1.0"),
+                test_module.resource_path(TEST_FILENAME, "2.0")], paths)
+        self.assertTrue(all([os.path.isabs(path) and os.path.exists(path) for path in paths]))
+
+        # Test that deleted versions and resources no longer resolve
+        test_module.delete_version(TEST_FILENAME, "2.0")
+        self.assertEqual(paths[1], test_module.resource_path(TEST_FILENAME, "1.0"))
+        self.assertRaises(ValueError, test_module.resource_paths, [(TEST_FILENAME, "2.0")])
+        test_module.delete_resource(TEST_FILENAME)
+        self.assertRaises(ValueError, test_module.resource_path, TEST_FILENAME)
+        self.assertRaises(ValueError, test_module.resource_path, TEST_FILENAME, "1.0")
+
+    def test_diff_versions(self):
+        """Tests diffing two versions of a directory resource, reading only files whose metadata differs"""
+        TEST_DIRNAME = "test_dir"
+        test_dirpath = os.path.join(self._TEST_DIRNAME, TEST_DIRNAME)
+        os.mkdir(test_dirpath)
+        for filename in ("same.txt", "edited.txt", "removed.txt", "touched.txt"):
+            test_fp = open(os.path.join(test_dirpath, filename), "w")
+            test_fp.write("Text of " + filename)
+            test_fp.close()
+        test_module = dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+        test_module.add_resource(test_dirpath, version="1.0")
+        test_module.copy_version(TEST_DIRNAME, "current", "2.0")
+        self.assertEqual([], test_module.diff_versions(TEST_DIRNAME, "1.0", "2.0"))
+
+        # Change the new version: same-size edit, new and removed files, and a rewrite with identical content
+        version2_dirpath = test_module.resource_path(TEST_DIRNAME, "2.0")
+        test_fp = open(os.path.join(version2_dirpath, "edited.txt"), "w")
+        test_fp.write("Text of EDITED.txt")
+        test_fp.close()
+        os.remove(os.path.join(version2_dirpath, "removed.txt"))
+        os.mkdir(os.path.join(version2_dirpath, "added"))
+        os.utime(os.path.join(version2_dirpath, "touched.txt"), (0, 0))
+        os.utime(os.path.join(version2_dirpath, "edited.txt"), (1, 1))
+
+        expected_changes = [
+            (dropbox_module.DropboxModule.DIFF_ADDED, os.path.join(TEST_DIRNAME, "added")),
+            (dropbox_module.DropboxModule.DIFF_MODIFIED, os.path.join(TEST_DIRNAME, "edited.txt")),
+            (dropbox_module.DropboxModule.DIFF_REMOVED, os.path.join(TEST_DIRNAME, "removed.txt"))
+        ]
+        self.assertEqual(expected_changes, test_module.diff_versions(TEST_DIRNAME, "1.0", "2.0"))
+
+        # Test that only files with equal sizes and differing timestamps were hashed, and that hashes are reused
+        hashed_filenames = set([os.path.basename(filepath) for filepath in test_module._content_hashes])
+        self.assertEqual(set(["edited.txt", "touched.txt"]), hashed_filenames)
+        self.assertEqual(expected_changes, test_module.diff_versions(TEST_DIRNAME, "1.0", "2.0"))
+        self.assertRaises(ValueError, test_module.diff_versions, TEST_DIRNAME, "1.0", "3.0")
+
     def test_version_dependencies(self):
         """Adds and removes depedencies from a version"""
         # Set up environment
@@ -172,6 +416,104 @@ class TestDropboxModule(unittest.TestCase):
         self.assertTrue(TEST_DEPENDENCY not in dependencies)
         self.assertRaises(ValueError, test_module.delete_version_dependency, TEST_FILENAME, TEST_VERSION, "")
 
+    def test_concurrent_writers_merge(self):
+        """Tests that two modules writing the same index each keep the other's changes"""
+        test_filepaths = []
+        for test_filename in ["first.txt", "second.txt"]:
+            test_filepath = os.path.join(self._TEST_DIRNAME, test_filename)
+            test_fp = open(test_filepath, "w")
+            test_fp.write("This is test text!")
+            test_fp.close()
+            test_filepaths.append(test_filepath)
+
+        # Both modules read the index before either writes
+        first_module = dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+        second_module = dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+        first_module.add_resource(test_filepaths[0])
+        second_module.add_resource(test_filepaths[1])
+        self.assertEqual(set(["first.txt", "second.txt"]), set(second_module.resources_set()))
+        self.assertEqual(2, second_module.index_generation())
+
+        reloaded_module = dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+        self.assertEqual(set(["first.txt", "second.txt"]), set(reloaded_module.resources_set()))
+        self.assertEqual(2, reloaded_module.index_generation())
+
+        # Concurrent changes to different versions of one resource both survive
+        first_module.copy_version("first.txt", "1.0", "2.0")
+        second_module.copy_version("first.txt", "1.0", "3.0")
+        second_module.add_version_dependency("first.txt", "1.0", "dep1")
+        reloaded_module = dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+        self.assertEqual(["1.0", "2.0", "3.0"], reloaded_module.sorted_versions("first.txt"))
+        self.assertEqual(set(["dep1"]), reloaded_module.version_info("first.txt", "1.0"))
+
+        # A stale module's changes don't bring back a resource deleted since it last read the index
+        first_module.delete_resource("first.txt")
+        second_module.add_version_dependency("first.txt", "1.0", "dep2")
+        reloaded_module = dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+        self.assertEqual(["second.txt"], list(reloaded_module.resources_set()))
+
+        # A resource added under a name another writer took first is removed and reported, not grafted onto the other one
+        first_module = dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+        second_module = dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+        first_module.add_resource(test_filepaths[0], version="1.0")
+        unbox_entries = sorted(os.listdir(os.path.join(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)))
+        self.assertRaises(ValueError, second_module.add_resource, test_filepaths[0], "2.0")
+        self.assertEqual(unbox_entries, sorted(os.listdir(os.path.join(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME))))
+        for test_module in (second_module, dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)):
+            self.assertEqual(["1.0"], test_module.sorted_versions("first.txt"))
+            self.assertEqual(os.path.realpath(test_module.resource_path("first.txt", "1.0")), os.path.realpath(test_module.resource_path("first.txt")))
+
+        # An index written in the previous single-tuple format is still read, and a writer rewrites it in the header format
+        index_filepath = os.path.join(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME, dropbox_module.DropboxModule._INDEX_FILENAME)
+        generation, serialized_index, _ = second_module._read_index_file()
+        index_fp = open(index_filepath, "wb")
+        pickle.dump((dropbox_module.DropboxModule._LEGACY_INDEX_FORMAT_MARKER, generation, serialized_index), index_fp)
+        index_fp.close()
+        first_module = dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+        self.assertEqual(generation, first_module.index_generation())
+        self.assertEqual(set(["first.txt", "second.txt"]), set(first_module.resources_set()))
+        first_module.delete_resource("second.txt")
+        self.assertEqual((generation + 1, None, dict()), first_module._read_index_file(generation + 1))
+        self.assertEqual(["first.txt"], list(dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME).resources_set()))
+
+    def test_search_index(self):
+        """Tests glob, range and version queries against the maintained search index"""
+        # Set up environment
+        test_filepaths = []
+        for test_filename in [".vimrc", ".viminfo", ".bashrc"]:
+            test_filepath = os.path.join(self._TEST_DIRNAME, test_filename)
+            test_fp = open(test_filepath, "w")
+            test_fp.write("This is test text!")
+            test_fp.close()
+            test_filepaths.append(test_filepath)
+
+        test_module = dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+        test_module.add_resource(test_filepaths[0], version="2.9")
+        test_module.add_resource(test_filepaths[1], version="2.10")
+        test_module.add_resource(test_filepaths[2], version="1.0")
+        test_module.copy_version(".vimrc", "2.9", "3.0")
+
+        # Test name queries
+        self.assertEqual([".viminfo", ".vimrc"], test_module.find_resources(".vim*"))
+        self.assertEqual([".bashrc", ".viminfo", ".vimrc"], test_module.find_resources("*"))
+        self.assertEqual([".viminfo"], test_module.find_resources(".vim?nfo*"))
+        self.assertEqual([".bashrc"], test_module.find_resources(".bashrc"))
+        self.assertEqual([".bashrc", ".viminfo"], test_module.resources_in_range(".b", ".vimrc"))
+
+        # Test that an index loaded in bulk orders like one maintained incrementally
+        reloaded_module = dropbox_module.DropboxModule(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+        self.assertEqual(test_module._search_index._names, reloaded_module._search_index._names)
+        self.assertEqual(test_module._search_index._versions, reloaded_module._search_index._versions)
+
+        # Test version queries, including index maintenance on version deletion and resource deletion
+        self.assertEqual([(".vimrc", "2.9"), (".viminfo", "2.10")], test_module.find_versions("2.x"))
+        self.assertEqual(["2.9", "3.0"], test_module.sorted_versions(".vimrc"))
+        test_module.change_current_version(".vimrc", "3.0")
+        test_module.delete_version(".vimrc", "2.9")
+        test_module.delete_resource(".viminfo")
+        self.assertEqual([], test_module.find_versions("2"))
+        self.assertEqual([".vimrc"], test_module.find_resources(".vim*"))
+
     def tearDown(self):
         """Removes the test directories that were created"""
         shutil.rmtree(self._TEST_DIRNAME)
@@ -222,10 +564,848 @@ class TestLocalModule(unittest.TestCase):
         link_filename = "resource_link"
         resource_version = "1.0"
         link_filepath = os.path.join(self._TEST_DIRNAME, link_filename)
-        test_module.add_link(self._TEST_RESOURCE1_FILEPATH, resource_version, "test_resource", resource_version)
+        test_module.add_link(link_filepath, self._TEST_RESOURCE1_FILEPATH, "test_resource", resource_version)
 
         # Test for existence
         self.assertTrue(test_module.link_exists(link_filepath))
+        self.assertTrue(os.path.islink(link_filepath))
+
+    def test_concurrent_writers_merge(self):
+        """Tests that two modules writing the same local and backup indexes each keep the other's changes"""
+        first_module = local_module.LocalModule(self._TEST_LOCAL_UNBOX_DIRPATH)
+        second_module = local_module.LocalModule(self._TEST_LOCAL_UNBOX_DIRPATH)
+        link1_filepath = os.path.abspath(os.path.join(self._TEST_DIRNAME, "link1"))
+        link2_filepath = os.path.abspath(os.path.join(self._TEST_DIRNAME, "link2"))
+        first_module.add_link(link1_filepath, self._TEST_RESOURCE1_FILEPATH, "test_resource", "1.0")
+        second_module.add_link(link2_filepath, self._TEST_RESOURCE2_FILEPATH, "test_resource", "1.0")
+        first_module.backup_add(self._TEST_RESOURCE1_FILEPATH)
+        second_module.backup_add(self._TEST_RESOURCE2_FILEPATH)
+
+        reloaded_module = local_module.LocalModule(self._TEST_LOCAL_UNBOX_DIRPATH)
+        self.assertEqual(set([link1_filepath, link2_filepath]), set(reloaded_module.links_list()))
+        self.assertEqual(set([link1_filepath, link2_filepath]), reloaded_module.dependent_links("test_resource", "1.0"))
+        self.assertTrue(reloaded_module.backup_exists(os.path.abspath(self._TEST_RESOURCE1_FILEPATH)))
+        self.assertTrue(reloaded_module.backup_exists(os.path.abspath(self._TEST_RESOURCE2_FILEPATH)))
+
+        # Resources ignored or no longer ignored by either module stay that way
+        first_module.set_ignored("first_resource", True)
+        first_module.set_ignored("shared_resource", True)
+        second_module.set_ignored("second_resource", True)
+        second_module.set_ignored("shared_resource", True)
+        first_module.set_ignored("shared_resource", False)
+        self.assertEqual(["first_resource", "second_resource"], first_module.ignored_list())
+        self.assertEqual(["first_resource", "second_resource"], local_module.LocalModule(self._TEST_LOCAL_UNBOX_DIRPATH).ignored_list())
+
+    def test_dependent_links(self):
+        """Tests the reverse index from resource versions to links through adds, retargets and deletes"""
+        test_module = local_module.LocalModule(self._TEST_LOCAL_UNBOX_DIRPATH)
+        link1_filepath = os.path.abspath(os.path.join(self._TEST_DIRNAME, "link1"))
+        link2_filepath = os.path.abspath(os.path.join(self._TEST_DIRNAME, "link2"))
+        link3_filepath = os.path.abspath(os.path.join(self._TEST_DIRNAME, "link3"))
+        test_module.add_link(link1_filepath, self._TEST_RESOURCE1_FILEPATH, "test_resource", "1.0")
+        test_module.add_link(link2_filepath, self._TEST_RESOURCE1_FILEPATH, "test_resource", "1.0")
+        test_module.add_link(link3_filepath, self._TEST_RESOURCE2_FILEPATH, "test_resource", "2.0")
+
+        # Test lookups by resource and by version
+        self.assertEqual(set([link1_filepath, link2_filepath]), test_module.dependent_links("test_resource", "1.0"))
+        self.assertEqual(set([link1_filepath, link2_filepath, link3_filepath]), test_module.dependent_links("test_resource"))
+        self.assertEqual(set(), test_module.dependent_links("other_resource"))
+
+        # Test retargeting moves links between versions
+        test_module.retarget_links([link1_filepath], self._TEST_RESOURCE2_FILEPATH, "2.0")
+        self.assertEqual(os.path.abspath(self._TEST_RESOURCE2_FILEPATH), os.readlink(link1_filepath))
+        self.assertEqual(set([link1_filepath, link3_filepath]), test_module.dependent_links("test_resource", "2.0"))
+
+        # Test deletion and that the reverse index is rebuilt from the index file
+        test_module.delete_link(link2_filepath)
+        self.assertFalse(os.path.lexists(link2_filepath))
+        reloaded_module = local_module.LocalModule(self._TEST_LOCAL_UNBOX_DIRPATH)
+        self.assertEqual(set(), reloaded_module.dependent_links("test_resource", "1.0"))
+        self.assertEqual(set([link1_filepath, link3_filepath]), reloaded_module.dependent_links("test_resource", "2.0"))
+
+    def test_bulk_add_links(self):
+        """Tests adding a batch of links with relative targets, where some links cannot be created"""
+        test_module = local_module.LocalModule(self._TEST_LOCAL_UNBOX_DIRPATH, relative_links=True)
+        link_dirpath = os.path.abspath(os.path.join(self._TEST_DIRNAME, "links"))
+        os.mkdir(link_dirpath)
+        blocked_filepath = os.path.join(link_dirpath, "blocked")
+        open(blocked_filepath, 'w').close()
+        links = [(os.path.join(link_dirpath, "link" + str(idx)), self._TEST_RESOURCE1_FILEPATH, "test_resource", "1.0", False) for idx in range(20)]
+        links.append((blocked_filepath, self._TEST_RESOURCE2_FILEPATH, "test_resource", "2.0", False))
+        report = test_module.add_links(links)
+
+        # Test that the good links were made relative to their directory and the blocked one was left alone
+        self.assertEqual([link[0] for link in links], [link_path for link_path, _, _ in report])
+        self.assertEqual(20, len([error for _, _, error in report if error is None]))
+        self.assertIsNotNone(report[-1][2])
+        self.assertFalse(os.path.islink(blocked_filepath))
+        self.assertEqual(os.path.join("..", "test_dropbox", "test_resource1"), os.readlink(links[0][0]))
+        self.assertEqual("Resource 1's text is here!", open(links[0][0]).read())
+
+        # Test that only the created links were registered
+        reloaded_module = local_module.LocalModule(self._TEST_LOCAL_UNBOX_DIRPATH)
+        self.assertEqual(20, len(reloaded_module.links_list()))
+        self.assertEqual(os.path.abspath(self._TEST_RESOURCE1_FILEPATH), reloaded_module.link_info(links[0][0])[0])
+        self.assertFalse(reloaded_module.link_exists(blocked_filepath))
+
+        # Test that directory operations never move the working directory, which other threads share
+        cwd = os.getcwd()
+        dir_ops = unbox_backend.OS_BACKEND.dir_ops(link_dirpath)
+        try:
+            dir_ops.rename("link0", "renamed")
+            self.assertEqual(cwd, os.getcwd())
+            self.assertTrue(os.path.islink(os.path.join(link_dirpath, "renamed")))
+        finally:
+            dir_ops.close()
+        self.assertRaises(OSError, unbox_backend.OS_BACKEND.dir_ops, blocked_filepath)
+
+    def tearDown(self):
+        """Cleans up the test environment"""
+        shutil.rmtree(self._TEST_DIRNAME)
+
+class TestRecords(unittest.TestCase):
+    """Tests the slotted in-memory index records"""
+
+    def test_serialization_round_trip(self):
+        """Tests that records serialize to the nested-dict index formats and back"""
+        resource_info = {
+            "parent_dirname" : "abc",
+            "versions_info" : { "1.0" : { "dependencies" : set(["dep1"]) } },
+            "current_version" : "1.0"
+        }
+        resource_record = unbox_records.ResourceRecord.deserialize(resource_info)
+        self.assertEqual(resource_info, resource_record.serialize())
+        self.assertFalse(hasattr(resource_record, "__dict__"))
+        resource_info["template"] = True
+        self.assertEqual(resource_info, unbox_records.ResourceRecord.deserialize(resource_info).serialize())
+
+        link_info = {
+            "link_target" : "/unbox/abc/current/test.txt",
+            "resource_name" : u"test.txt",
+            "resource_version" : u"1.0",
+            "ignore_new_versions" : False
+        }
+        link_record = unbox_records.LinkRecord.deserialize(link_info)
+        self.assertEqual(link_info, link_record.serialize())
+        self.assertFalse(hasattr(link_record, "__dict__"))
+
+        self.assertEqual("abc", unbox_records.BackupRecord.deserialize("abc").serialize())
+
+    def test_interned_names(self):
+        """Tests that equal names read from separate sources share one string object"""
+        first_record = unbox_records.LinkRecord("/unbox/abc/current/test.txt", u"test.txt", u"1.0", False)
+        second_record = unbox_records.LinkRecord("/unbox/abc/current/test.txt", "".join(["test", ".txt"]), u"1.0", True)
+        self.assertTrue(first_record.resource_name is second_record.resource_name)
+        self.assertTrue(first_record._target_dirpath is second_record._target_dirpath)
+
+class TestRules(unittest.TestCase):
+    """Tests compiling link rules into combined matchers"""
+
+    def test_first_match_wins(self):
+        """Tests that rules apply in order like a shell 'case' statement, filling in templates from regex groups"""
+        rules = unbox_rules.parse_rules("""
+            # Editor and shell configs
+            .vimrc => ~/.vimrc
+            .bash* => ~/{name}
+            re:(?P<app>[a-z]+)-(\\d+)\\.conf => ~/.config/{app}/{2}.conf
+            * => ~/other/{0}
+        """)
+        self.assertEqual("~/.vimrc", rules.match(".vimrc"))
+        self.assertEqual("~/.bash_profile", rules.match(".bash_profile"))
+        self.assertEqual("~/.config/tmux/2.conf", rules.match("tmux-2.conf"))
+        self.assertEqual("~/other/README", rules.match("README"))
+        self.assertRaises(ValueError, unbox_rules.parse_rules, "no separator")
+        self.assertRaises(ValueError, unbox_rules.parse_rules, "re:( => ~/broken")
+        self.assertRaises(ValueError, unbox_rules.parse_rules, "re:(?i)readme => ~/readme\nREADME.md => ~/other")
+        self.assertEqual(None, unbox_rules.parse_rules(".vimrc => ~/.vimrc").match(".vimrc.bak"))
+
+    def test_chunked_rules(self):
+        """Tests that rule sets with more groups than one expression may hold, or clashing group names, still match in order"""
+        rules_text = "\n".join(["re:(?P<prefix>r" + str(idx) + ")-(a)(b) => {prefix}/" + str(idx) for idx in range(200)])
+        rules = unbox_rules.parse_rules(rules_text)
+        self.assertTrue(len(rules._chunks) > 1)
+        self.assertEqual("r150/150", rules.match("r150-ab"))
+        self.assertEqual({ "r0-ab" : "r0/0", "x" : None }, rules.map_names(["r0-ab", "x"]))
+
+class TestBackend(unittest.TestCase):
+    """Tests running the Dropbox and local modules on the in-memory filesystem backend"""
+
+    # Root of the in-memory test environment, which must never appear on disk
+    _TEST_ROOT = "/unbox-memory-test"
+
+    def setUp(self):
+        """Creates an in-memory Dropbox directory, and a file and a directory to add as resources"""
+        self._backend = unbox_backend.MemoryBackend()
+        self._dropbox_dirpath = os.path.join(self._TEST_ROOT, "Dropbox")
+        self._home_dirpath = os.path.join(self._TEST_ROOT, "home")
+        self._backend.makedirs(self._dropbox_dirpath)
+        self._backend.makedirs(os.path.join(self._home_dirpath, "conf"))
+        for path, contents in (("notes.txt", "notes"), ("conf/app.cfg", "debug = 0")):
+            test_fp = self._backend.open(os.path.join(self._home_dirpath, path), "w")
+            test_fp.write(contents)
+            test_fp.close()
+
+    def test_memory_round_trip(self):
+        """Tests adding, versioning and linking resources and reloading the indexes without touching the disk"""
+        test_dropbox = dropbox_module.DropboxModule(self._dropbox_dirpath, "Unbox", backend=self._backend)
+        report = test_dropbox.add_resources([(os.path.join(self._home_dirpath, "notes.txt"), "1.0"), (os.path.join(self._home_dirpath, "conf"), "1.0")])
+        self.assertEqual([None, None], [error for _, _, _, error in report])
+        test_dropbox.copy_version("conf", "1.0", "2.0")
+        app_cfg_fp = self._backend.open(os.path.join(test_dropbox.resource_path("conf", "2.0"), "app.cfg"), "w")
+        app_cfg_fp.write("debug = 1\nverbose = 1")
+        app_cfg_fp.close()
+        self.assertEqual([(test_dropbox.DIFF_MODIFIED, os.path.join("conf", "app.cfg"))], test_dropbox.diff_versions("conf", "1.0", "2.0"))
+        test_dropbox.change_current_version("conf", "2.0")
+
+        test_local = local_module.LocalModule(os.path.join(self._home_dirpath, ".unbox"), backend=self._backend)
+        notes_linkpath, conf_linkpath = os.path.join(self._home_dirpath, "notes"), os.path.join(self._home_dirpath, "conf-copy")
+        report = test_local.add_links([(notes_linkpath, test_dropbox.resource_path("notes.txt"), "notes.txt", "1.0", False),
+                (conf_linkpath, test_dropbox.resource_path("conf"), "conf", "2.0", False, unbox_links.STRATEGY_COPY)])
+        self.assertEqual([unbox_links.LINK_CREATED, unbox_links.LINK_CREATED], [outcome for _, outcome, _ in report])
+        self.assertEqual(test_dropbox.resource_path("notes.txt"), self._backend.readlink(notes_linkpath))
+        self.assertEqual(b"debug = 1\nverbose = 1", self._backend.open(os.path.join(conf_linkpath, "app.cfg"), "rb").read())
+
+        # Fresh modules read back what the first ones wrote, and the legacy core works the same way
+        reloaded_dropbox = dropbox_module.DropboxModule(self._dropbox_dirpath, "Unbox", backend=self._backend)
+        self.assertEqual(("2.0", ["1.0", "2.0"]), (reloaded_dropbox.resource_info("conf")[1], reloaded_dropbox.sorted_versions("conf")))
+        self.assertEqual(set([notes_linkpath, conf_linkpath]), set(local_module.LocalModule(os.path.join(self._home_dirpath, ".unbox"),
+                backend=self._backend).links_list()))
+        test_core = unbox_core.Core({ "resources directory" : self._dropbox_dirpath, "unbox directory" : os.path.join(self._home_dirpath, ".core") },
+                self._backend)
+        test_core.forge_links([(test_dropbox.resource_path("notes.txt"), os.path.join(self._home_dirpath, "notes.txt"))])
+        self.assertTrue(self._backend.lexists(os.path.join(self._home_dirpath, "notes.txt" + unbox_core.Core.BACKUP_SUFFIX)))
+
+        # Streamed links are created a batch at a time, before the rest are read
+        test_core.FORGE_BATCH_SIZE = 1
+        first_linkpath_existed = []
+        def streamed_links():
+            for link_name in ("first", "second"):
+                first_linkpath_existed.append(self._backend.lexists(os.path.join(self._home_dirpath, "first")))
+                yield (test_dropbox.resource_path("notes.txt"), os.path.join(self._home_dirpath, link_name))
+        test_core.forge_links(streamed_links())
+        self.assertEqual([False, True], first_linkpath_existed)
+        self.assertFalse(os.path.exists(self._TEST_ROOT))
+
+    def test_syscall_counts(self):
+        """Tests the syscalls made by operations whose cost is meant to stay fixed"""
+        test_dropbox = dropbox_module.DropboxModule(self._dropbox_dirpath, "Unbox", backend=self._backend)
+        test_dropbox.add_resources([(os.path.join(self._home_dirpath, "conf"), "1.0")])
+        test_dropbox.copy_version("conf", "1.0", "2.0")
+
+        # Switching versions stages one symlink and renames it in, then replaces the index file once
+        self._backend.reset_syscalls()
+        test_dropbox.change_current_version("conf", "2.0")
+        self.assertEqual({ "symlink" : 1, "readlink" : 1, "rename" : 2, "flock" : 1, "stat" : 1, "open" : 2, "fsync" : 1 }, self._backend.syscalls)
+
+        # Links into one directory open it once however many there are
+        links = [(test_dropbox.resource_path("conf"), os.path.join(self._home_dirpath, "link" + str(idx))) for idx in range(10)]
+        self._backend.reset_syscalls()
+        unbox_links.materialize_links(links, backend=self._backend)
+        self.assertEqual({ "open" : 1, "lstat" : 10, "symlink" : 10 }, self._backend.syscalls)
+
+        # Switching many resources together commits the Dropbox index and the local index once each
+        test_filesystem = unbox_filesystem.Filesystem(os.path.join(self._home_dirpath, ".unbox"), self._dropbox_dirpath, "Unbox", backend=self._backend)
+        test_dropbox = test_filesystem._dropbox_module
+        test_dropbox.add_resources([(os.path.join(self._home_dirpath, "notes.txt"), "1.0")])
+        test_dropbox.copy_version("notes.txt", "1.0", "2.0")
+        test_dropbox.change_current_version("conf", "1.0")
+        test_filesystem._local_module.add_links([(os.path.join(self._home_dirpath, resource_name + "-link"), test_dropbox.resource_path(resource_name),
+                resource_name, "1.0", False) for resource_name in ("conf", "notes.txt")])
+        self._backend.reset_syscalls()
+        test_filesystem.change_current_versions([("conf", "2.0"), ("notes.txt", "2.0")])
+        self.assertEqual((2, 2), (self._backend.syscalls["flock"], self._backend.syscalls["fsync"]))
+        self.assertEqual([("conf", "2.0"), ("notes.txt", "2.0")], sorted([test_filesystem._local_module.link_info(link_path)[1:3]
+                for link_path in test_filesystem._local_module.links_list()]))
+
+        # Status only reads copies whose stat signature changed since they were materialized
+        copy_linkpath = os.path.join(self._home_dirpath, "notes-copy")
+        test_filesystem._local_module.add_links([(copy_linkpath, test_dropbox.resource_path("notes.txt"), "notes.txt", "2.0", False,
+                unbox_links.STRATEGY_COPY)])
+        self._backend.reset_syscalls()
+        self.assertEqual([], test_filesystem.status())
+        self.assertFalse("open" in self._backend.syscalls)
+        copy_fp = self._backend.open(copy_linkpath, "w")
+        copy_fp.write("edited")
+        copy_fp.close()
+        self.assertEqual([(unbox_filesystem.Filesystem.DRIFT_MODIFIED, copy_linkpath)], [drift[:2] for drift in test_filesystem.status()])
+
+class TestFilesystem(unittest.TestCase):
+    """Tests the Unbox filesystem combining the Dropbox and local modules"""
+
+    # Test environment folder structure
+    _TEST_DIRNAME = "filesystem_test"
+    _TEST_DROPBOX_DIRPATH = os.path.join(_TEST_DIRNAME, "test_dropbox")
+    _TEST_DROPBOX_UNBOX_DIRNAME = "test_unbox"
+    _TEST_LOCAL_UNBOX_DIRPATH = os.path.join(_TEST_DIRNAME, "test_local_unbox")
+
+    # Fake resource in environment
+    _TEST_RESOURCE_FILENAME = "test.txt"
+    _TEST_RESOURCE_FILEPATH = os.path.join(_TEST_DIRNAME, _TEST_RESOURCE_FILENAME)
+
+    _log = logging.getLogger("TestFilesystem")
+
+    def setUp(self):
+        """Creates a test directory containing a test Dropbox directory and a resource to add"""
+        os.mkdir(self._TEST_DIRNAME)
+        os.mkdir(self._TEST_DROPBOX_DIRPATH)
+
+        resource_fp = open(self._TEST_RESOURCE_FILEPATH, 'w')
+        resource_fp.write("This is test text!")
+        resource_fp.close()
+
+    def _make_filesystem(self):
+        """Creates a filesystem in the test environment"""
+        return unbox_filesystem.Filesystem(self._TEST_LOCAL_UNBOX_DIRPATH, self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)
+
+    def test_lazy_indexes(self):
+        """Tests that the Dropbox and local modules are only loaded when first used"""
+        test_filesystem = self._make_filesystem()
+        self.assertFalse(os.path.exists(os.path.join(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)))
+        self.assertEqual([], test_filesystem.find_resources())
+        self.assertTrue(os.path.isdir(os.path.join(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME)))
+        self.assertFalse(os.path.exists(self._TEST_LOCAL_UNBOX_DIRPATH))
+        test_filesystem.load_indexes(dropbox_index=False)
+        self.assertTrue(os.path.isdir(self._TEST_LOCAL_UNBOX_DIRPATH))
+
+    def test_streaming_enumeration(self):
+        """Tests that resources, links and link choice files can be enumerated lazily with filters"""
+        test_filesystem = self._make_filesystem()
+        test_filesystem._dropbox_module.add_resource(self._TEST_RESOURCE_FILEPATH, version="1.0")
+        other_filepath = os.path.join(self._TEST_DIRNAME, "other.md")
+        open(other_filepath, 'w').close()
+        test_filesystem._dropbox_module.add_resource(other_filepath)
+        resources = test_filesystem.iter_resources("*.txt")
+        self.assertFalse(isinstance(resources, list))
+        self.assertEqual([self._TEST_RESOURCE_FILENAME], [resource_name for resource_name, _ in resources])
+        self.assertEqual(["1.0"], list(test_filesystem.iter_resources(self._TEST_RESOURCE_FILENAME))[0][1][2])
+
+        link_dirpath = os.path.abspath(os.path.join(self._TEST_DIRNAME, "links"))
+        os.mkdir(link_dirpath)
+        test_filesystem.add_link(self._TEST_RESOURCE_FILENAME, os.path.join(link_dirpath, "test"))
+        test_filesystem.add_link("other.md", os.path.join(os.path.abspath(self._TEST_DIRNAME), "other"))
+        self.assertEqual([os.path.join(link_dirpath, "test")], [link_path for link_path, _ in test_filesystem.iter_links(dirpath=link_dirpath)])
+        self.assertEqual(["other.md"], [link_info[1] for _, link_info in test_filesystem.iter_links(resource_name="other.md")])
+
+        # Test that link choice files round-trip one entry per line, with blank link paths read as empty
+        choices_filepath = os.path.join(self._TEST_DIRNAME, "choices.json")
+        choices_fp = open(choices_filepath, 'w')
+        self.assertEqual(2, unbox_core.write_link_choices(choices_fp, iter([(u"/dropbox/a \"b\"", u"~/a"), (u"/dropbox/c", None)])))
+        choices_fp.close()
+        choices_fp = open(choices_filepath)
+        self.assertEqual(u"~/a", json.load(choices_fp)[u"/dropbox/a \"b\""])
+        choices_fp.seek(0)
+        self.assertEqual([(u"/dropbox/a \"b\"", u"~/a"), (u"/dropbox/c", u"")], list(unbox_core.read_link_choices(choices_fp)))
+        choices_fp.close()
+        self.assertRaises(ValueError, list, unbox_core.read_link_choices(['{', '    "/dropbox/a" "~/a"', '}']))
+
+    def test_federated_roots(self):
+        """Tests that several roots are merged in priority order, reporting each resource's origin"""
+        extra_dropbox_dirpath = os.path.join(self._TEST_DIRNAME, "extra_dropbox")
+        os.mkdir(extra_dropbox_dirpath)
+        extra_dropbox = dropbox_module.DropboxModule(extra_dropbox_dirpath, "unbox")
+        extra_dropbox.add_resource(self._TEST_RESOURCE_FILEPATH, version="9.0")
+        other_filepath = os.path.join(self._TEST_DIRNAME, "other.md")
+        open(other_filepath, 'w').close()
+        extra_dropbox.add_resource(other_filepath)
+
+        test_filesystem = unbox_filesystem.Filesystem(self._TEST_LOCAL_UNBOX_DIRPATH, self._TEST_DROPBOX_DIRPATH,
+                self._TEST_DROPBOX_UNBOX_DIRNAME, extra_roots=[(extra_dropbox_dirpath, "unbox")])
+        primary_dirpath = os.path.abspath(os.path.join(self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME))
+        extra_dirpath = os.path.abspath(os.path.join(extra_dropbox_dirpath, "unbox"))
+        self.assertEqual(["other.md", self._TEST_RESOURCE_FILENAME], test_filesystem.find_resources())
+        self.assertEqual(extra_dirpath, test_filesystem.resource_origin(self._TEST_RESOURCE_FILENAME))
+        self.assertEqual([], test_filesystem.shadowed_resources())
+
+        # New resources go to the main root and shadow the extra root's resource of the same name
+        test_filesystem._dropbox_module.add_resource(self._TEST_RESOURCE_FILEPATH, version="1.0")
+        self.assertEqual(primary_dirpath, test_filesystem.resource_origin(self._TEST_RESOURCE_FILENAME))
+        self.assertEqual([(self._TEST_RESOURCE_FILENAME, extra_dirpath, primary_dirpath)], test_filesystem.shadowed_resources())
+        self.assertEqual([], test_filesystem.find_versions("9.x"))
+        self.assertEqual([self._TEST_RESOURCE_FILENAME], [resource_name for resource_name, _ in test_filesystem.iter_resources("*.txt")])
+
+        # Changes go to the root holding the resource
+        test_filesystem._dropbox_module.copy_version("other.md", "1.0", "2.0")
+        test_filesystem.change_current_versions([("other.md", "2.0")])
+        self.assertEqual("2.0", dropbox_module.DropboxModule(extra_dropbox_dirpath, "unbox").resource_info("other.md")[1])
+        self.assertTrue(test_filesystem._dropbox_module.resource_path("other.md").startswith(extra_dirpath))
+        self.assertRaises(ValueError, test_filesystem.resource_origin, "missing")
+
+        # The merged generation is the same in every process reading the same indexes, and changes with any root's
+        generation = test_filesystem._dropbox_module.index_generation()
+        self.assertEqual(generation, unbox_filesystem.Filesystem(self._TEST_LOCAL_UNBOX_DIRPATH, self._TEST_DROPBOX_DIRPATH,
+                self._TEST_DROPBOX_UNBOX_DIRNAME, extra_roots=[(extra_dropbox_dirpath, "unbox")])._dropbox_module.index_generation())
+        test_filesystem._dropbox_module.copy_version("other.md", "2.0", "3.0")
+        self.assertNotEqual(generation, test_filesystem._dropbox_module.index_generation())
+
+    def test_dropconfig_import(self):
+        """Tests that legacy .dropconfig files are linked in one pass, backing up files and skipping directories in the way"""
+        core = unbox_core.Core({ "resources directory" : self._TEST_DROPBOX_DIRPATH, "unbox directory" : self._TEST_LOCAL_UNBOX_DIRPATH })
+        target_path = os.path.abspath(self._TEST_RESOURCE_FILEPATH)
+        file_link_path = os.path.abspath(os.path.join(self._TEST_DIRNAME, "existing"))
+        open(file_link_path, 'w').close()
+        dir_link_path = os.path.abspath(os.path.join(self._TEST_DIRNAME, "directory"))
+        os.mkdir(dir_link_path)
+        new_link_path = os.path.abspath(os.path.join(self._TEST_DIRNAME, "new"))
+        dropconfig_lines = [
+            "# Comment",
+            "",
+            "  " + new_link_path + "   =>   " + target_path,
+            file_link_path + " => " + target_path,
+            dir_link_path + " => " + target_path,
+            "no separator here",
+            "~/.vimrc =>"
+        ]
+        self.assertEqual([(6, "no separator here"), (7, "~/.vimrc =>")], unbox_core.parse_dropconfig(dropconfig_lines)[1])
+        self.assertEqual((os.path.expanduser("~/x"), os.path.abspath("y")), unbox_core.parse_dropconfig(["y => ~/x"])[0][0])
+        estimate = core.estimate_import_dropconfig(dropconfig_lines)
+        self.assertEqual((2, 1), (estimate.links_to_change, estimate.backups_to_take))
+        self.assertFalse(os.path.lexists(new_link_path))
+        self.assertEqual((3, 2), core.import_dropconfig(dropconfig_lines))
+        self.assertEqual(target_path, os.readlink(new_link_path))
+        self.assertEqual(target_path, os.readlink(file_link_path))
+        self.assertTrue(os.path.isfile(file_link_path + unbox_core.Core.DROPCONFIG_BACKUP_SUFFIX))
+        self.assertFalse(os.path.islink(dir_link_path))
+
+    def test_autoversion(self):
+        """Tests that settled edits to a current version are kept as a version, and bursts of edits make only one"""
+        test_filesystem = self._make_filesystem()
+        test_filesystem._dropbox_module.add_resource(self._TEST_RESOURCE_FILEPATH, version="1.0")
+        link_path = os.path.abspath(os.path.join(self._TEST_DIRNAME, "link"))
+        test_filesystem.add_link(self._TEST_RESOURCE_FILENAME, link_path)
+        self.assertEqual([(self._TEST_RESOURCE_FILENAME, unbox_autoversion.AUTOVERSION_BASELINE, None)], test_filesystem.autoversion(["*"], 0))
+        os.utime(link_path, None)
+        self.assertEqual([(self._TEST_RESOURCE_FILENAME, unbox_autoversion.AUTOVERSION_UNCHANGED, None)], test_filesystem.autoversion(["*"], 0))
+
+        # Edit through the link; the edit is kept once it has settled
+        link_fp = open(link_path, 'w')
+        link_fp.write("Edited text")
+        link_fp.close()
+        self.assertEqual([(self._TEST_RESOURCE_FILENAME, unbox_autoversion.AUTOVERSION_PENDING, None)], test_filesystem.autoversion(["*"], 0))
+        self.assertEqual([(self._TEST_RESOURCE_FILENAME, unbox_autoversion.AUTOVERSION_SNAPSHOT, "1.0")], test_filesystem.autoversion(["*"], 0))
+        _, current_version, versions = test_filesystem._dropbox_module.resource_info(self._TEST_RESOURCE_FILENAME)
+        self.assertEqual(("1.1", ["1.0", "1.1"]), (current_version, sorted(versions)))
+        self.assertEqual([(self._TEST_RESOURCE_FILENAME, unbox_autoversion.AUTOVERSION_UNCHANGED, None)], test_filesystem.autoversion(["*"], 0))
+
+        # Saves keep postponing the snapshot until the contents stay the same for the quiet period
+        entry = unbox_autoversion.baseline_entry("1.0", { "a" : [1, 1.0, "old"] })
+        for now, content_hash in ((100, "v1"), (110, "v2"), (120, "v3")):
+            outcome, entry = unbox_autoversion.step(entry, "1.0", { "a" : [1, now, content_hash] }, now, 30)
+            self.assertEqual(unbox_autoversion.AUTOVERSION_PENDING, outcome)
+        self.assertEqual(unbox_autoversion.AUTOVERSION_PENDING, unbox_autoversion.step(entry, "1.0", { "a" : [1, 120, "v3"] }, 149, 30)[0])
+        self.assertEqual(unbox_autoversion.AUTOVERSION_SNAPSHOT, unbox_autoversion.step(entry, "1.0", { "a" : [1, 120, "v3"] }, 150, 30)[0])
+        self.assertEqual("2.10", unbox_autoversion.next_version("2.9", ["2.9"]))
+        self.assertEqual("beta.2", unbox_autoversion.next_version("beta", ["beta.1"]))
+
+    def test_cascading_version_operations(self):
+        """Tests that version changes and deletions carry dependent links along"""
+        test_filesystem = self._make_filesystem()
+        test_filesystem._dropbox_module.add_resource(self._TEST_RESOURCE_FILEPATH, version="1.0")
+        test_filesystem._dropbox_module.copy_version(self._TEST_RESOURCE_FILENAME, "1.0", "2.0")
+        following_link = os.path.abspath(os.path.join(self._TEST_DIRNAME, "following"))
+        pinned_link = os.path.abspath(os.path.join(self._TEST_DIRNAME, "pinned"))
+        test_filesystem.add_link(self._TEST_RESOURCE_FILENAME, following_link)
+        test_filesystem.add_link(self._TEST_RESOURCE_FILENAME, pinned_link, version="1.0", ignore_new=True)
+
+        # Only the link following the current version moves
+        moved = test_filesystem.change_current_version(self._TEST_RESOURCE_FILENAME, "2.0")
+        self.assertEqual(set([following_link]), moved)
+        self.assertTrue(os.path.exists(following_link))
+
+        # Deleting a version with dependents is refused unless a policy is given
+        self.assertRaises(ValueError, test_filesystem.delete_version, self._TEST_RESOURCE_FILENAME, "1.0")
+        retargeted = test_filesystem.delete_version(self._TEST_RESOURCE_FILENAME, "1.0", unbox_filesystem.Filesystem.DEPENDENTS_RETARGET)
+        self.assertEqual(set([pinned_link]), retargeted)
+        self.assertTrue(os.path.exists(pinned_link))
+
+        # Deleting the resource unlinks every dependent
+        self.assertRaises(ValueError, test_filesystem.delete_resource, self._TEST_RESOURCE_FILENAME)
+        test_filesystem.delete_resource(self._TEST_RESOURCE_FILENAME, unbox_filesystem.Filesystem.DEPENDENTS_UNLINK)
+        self.assertFalse(os.path.lexists(following_link))
+        self.assertFalse(os.path.lexists(pinned_link))
+
+    def test_materialization_strategies(self):
+        """Tests that hardlinked, cloned and copied links track resource content across version changes"""
+        test_filesystem = self._make_filesystem()
+        test_filesystem._dropbox_module.add_resource(self._TEST_RESOURCE_FILEPATH, version="1.0")
+        test_filesystem._dropbox_module.copy_version(self._TEST_RESOURCE_FILENAME, "1.0", "2.0")
+        version2_fp = open(test_filesystem._dropbox_module.resource_path(self._TEST_RESOURCE_FILENAME, "2.0"), 'w')
+        version2_fp.write("This is version 2 text!")
+        version2_fp.close()
+        link_paths = dict([(strategy, os.path.abspath(os.path.join(self._TEST_DIRNAME, strategy)))
+                for strategy in (unbox_links.STRATEGY_HARDLINK, unbox_links.STRATEGY_REFLINK, unbox_links.STRATEGY_COPY)])
+        for strategy, link_path in link_paths.items():
+            test_filesystem.add_link(self._TEST_RESOURCE_FILENAME, link_path, strategy=strategy)
+
+        # Test that each link is a regular file with the resource's content
+        resource_path = test_filesystem._dropbox_module.resource_path(self._TEST_RESOURCE_FILENAME)
+        for strategy, link_path in link_paths.items():
+            self.assertFalse(os.path.islink(link_path))
+            self.assertEqual("This is test text!", open(link_path).read())
+            self.assertEqual(unbox_links.content_hash(resource_path), test_filesystem._local_module.link_strategy(link_path)[1])
+        self.assertEqual(os.stat(resource_path).st_ino, os.stat(link_paths[unbox_links.STRATEGY_HARDLINK]).st_ino)
+        self.assertEqual([], test_filesystem.status())
+
+        # Test that changing versions rewrites the copies, and rewriting unchanged content is skipped
+        test_filesystem.change_current_version(self._TEST_RESOURCE_FILENAME, "2.0")
+        for link_path in link_paths.values():
+            self.assertEqual("This is version 2 text!", open(link_path).read())
+        copy_path = link_paths[unbox_links.STRATEGY_COPY]
+        copy_inode = os.stat(copy_path).st_ino
+        test_filesystem._local_module.retarget_links([copy_path], resource_path, "2.0")
+        self.assertEqual(copy_inode, os.stat(copy_path).st_ino)
+
+        # Test that local edits are reported, aren't overwritten by retargeting, and survive unlinking
+        copy_fp = open(copy_path, 'w')
+        copy_fp.write("Local edit")
+        copy_fp.close()
+        self.assertEqual([(unbox_filesystem.Filesystem.DRIFT_MODIFIED, copy_path)], [drift[:2] for drift in test_filesystem.status()])
+        self.assertRaises(ValueError, test_filesystem._local_module.retarget_links, [copy_path],
+                test_filesystem._dropbox_module.resource_path(self._TEST_RESOURCE_FILENAME, "1.0"), "1.0")
+        self.assertEqual("Local edit", open(copy_path).read())
+        self.assertEqual("2.0", test_filesystem._local_module.link_info(copy_path)[2])
+        test_filesystem.delete_resource(self._TEST_RESOURCE_FILENAME, unbox_filesystem.Filesystem.DEPENDENTS_UNLINK)
+        self.assertFalse(os.path.lexists(link_paths[unbox_links.STRATEGY_REFLINK]))
+        self.assertEqual("Local edit", open(copy_path).read())
+
+    def test_metrics(self):
+        """Tests that operations are counted and timed, and that totals accumulate across runs"""
+        unbox_metrics.REGISTRY.reset()
+        test_filesystem = self._make_filesystem()
+        test_filesystem.status()
+        self.assertFalse(unbox_metrics.REGISTRY.counted())
+        test_filesystem._dropbox_module.add_resource(self._TEST_RESOURCE_FILEPATH)
+        self.assertTrue(unbox_metrics.REGISTRY.counted())
+        link_path = os.path.abspath(os.path.join(self._TEST_DIRNAME, "link"))
+        test_filesystem.add_link(self._TEST_RESOURCE_FILENAME, link_path)
+        totals = test_filesystem.record_metrics()
+
+        # Test counters and the zeroing of this run's metrics
+        counter_values = dict([(counter.name, counter.value) for counter in totals.counters()])
+        self.assertEqual(1, counter_values["unbox_links_created_total"])
+        self.assertEqual(len("This is test text!"), counter_values["unbox_bytes_copied_total"])
+        self.assertTrue(counter_values["unbox_index_bytes_written_total"] > 0)
+        self.assertEqual(0, unbox_metrics.LINKS_CREATED.value)
+
+        # Test that a second run adds to the totals
+        test_filesystem.delete_resource(self._TEST_RESOURCE_FILENAME, unbox_filesystem.Filesystem.DEPENDENTS_UNLINK)
+        test_filesystem.record_metrics()
+        counter_values = dict([(counter.name, counter.value) for counter in test_filesystem.metrics_totals().counters()])
+        self.assertEqual(1, counter_values["unbox_links_created_total"])
+        self.assertEqual(1, counter_values["unbox_links_removed_total"])
+
+        # Test the Prometheus text format
+        textfile_path = os.path.join(self._TEST_DIRNAME, "unbox.prom")
+        unbox_metrics.write_textfile(test_filesystem.metrics_totals(), textfile_path)
+        textfile_lines = open(textfile_path).read().splitlines()
+        self.assertTrue("# TYPE unbox_links_created_total counter" in textfile_lines)
+        self.assertTrue("unbox_links_removed_total 1" in textfile_lines)
+        self.assertTrue('unbox_operation_duration_seconds_count{operation="add_resource"} 1' in textfile_lines)
+        self.assertTrue('unbox_operation_duration_seconds_bucket{operation="add_resource",le="+Inf"} 1' in textfile_lines)
+
+        # Test that the textfile is readable by others like any new file, and that rewriting it keeps its mode
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(0o666 & ~umask, os.stat(textfile_path).st_mode & 0o777)
+        os.chmod(textfile_path, 0o640)
+        unbox_metrics.write_textfile(test_filesystem.metrics_totals(), textfile_path)
+        self.assertEqual(0o640, os.stat(textfile_path).st_mode & 0o777)
+
+    def test_estimates(self):
+        """Tests that dry-run estimates predict the cost of adds, version copies and links without changing anything"""
+        test_filesystem = self._make_filesystem()
+        resource_size = len("This is test text!")
+
+        # Test that estimating an add changes nothing, and that invalid items are left out
+        add_estimate = test_filesystem.estimate_add_resources([(self._TEST_RESOURCE_FILEPATH, "1.0", None),
+                (os.path.join(self._TEST_DIRNAME, "nonexistent"), None, None)])
+        self.assertEqual(resource_size, add_estimate.bytes_to_copy)
+        self.assertEqual(4, add_estimate.files_to_create)
+        self.assertTrue(add_estimate.index_growth > 0)
+        self.assertEqual([], test_filesystem.find_resources())
+
+        # Test the version copy estimate
+        test_filesystem._dropbox_module.add_resource(self._TEST_RESOURCE_FILEPATH, version="1.0")
+        copy_estimate = test_filesystem.estimate_copy_version(self._TEST_RESOURCE_FILENAME, "1.0", "2.0")
+        self.assertEqual(resource_size, copy_estimate.bytes_to_copy)
+        self.assertEqual(2, copy_estimate.files_to_create)
+        self.assertRaises(ValueError, test_filesystem.estimate_copy_version, self._TEST_RESOURCE_FILENAME, "1.0", "1.0")
+
+        # Test that a file in the way of a link is counted as a backup, and copies count their data
+        blocked_path = os.path.abspath(os.path.join(self._TEST_DIRNAME, "blocked"))
+        open(blocked_path, 'w').close()
+        free_path = os.path.abspath(os.path.join(self._TEST_DIRNAME, "free"))
+        link_estimate = test_filesystem.estimate_add_links([(self._TEST_RESOURCE_FILENAME, blocked_path, unbox_links.STRATEGY_SYMLINK),
+                (self._TEST_RESOURCE_FILENAME, free_path, unbox_links.STRATEGY_COPY)])
+        self.assertEqual(2, link_estimate.links_to_change)
+        self.assertEqual(1, link_estimate.backups_to_take)
+        self.assertEqual(resource_size, link_estimate.bytes_to_copy)
+        self.assertFalse(os.path.lexists(free_path))
+
+        # Test that links already in place are free
+        test_filesystem.add_link(self._TEST_RESOURCE_FILENAME, free_path)
+        link_estimate = test_filesystem.estimate_add_links([(self._TEST_RESOURCE_FILENAME, free_path, unbox_links.STRATEGY_SYMLINK)])
+        self.assertEqual(0, link_estimate.links_to_change)
+        self.assertEqual(0, link_estimate.index_growth)
+
+    def test_profiles(self):
+        """Tests that profiles build on roles, are picked by hostname, and reuse their cached link plan"""
+        test_filesystem = self._make_filesystem()
+        test_filesystem._dropbox_module.add_resource(self._TEST_RESOURCE_FILEPATH, version="1.0")
+        link_dirpath = os.path.abspath(os.path.join(self._TEST_DIRNAME, "home"))
+        os.mkdir(link_dirpath)
+        custom_link_path = os.path.join(link_dirpath, "custom")
+        profiles = {
+            "base" : { "resources" : ["*.txt"], "link directory" : link_dirpath },
+            "laptop" : { "hosts" : ["laptop-host"], "roles" : ["base"], "links" : { "extra.txt" : custom_link_path } },
+            "loop" : { "roles" : ["loop"] }
+        }
+        self.assertEqual("laptop", unbox_profiles.select_profile(profiles, hostname="laptop-host"))
+        self.assertRaises(ValueError, unbox_profiles.select_profile, profiles, hostname="other-host")
+        self.assertRaises(ValueError, unbox_profiles.resolve_profile, profiles, "loop")
+
+        # Test that applying creates the planned links, and re-applying adds nothing
+        profile_name, report = test_filesystem.apply_profile(profiles, "laptop")
+        link_path = os.path.join(link_dirpath, self._TEST_RESOURCE_FILENAME)
+        self.assertEqual([(link_path, unbox_links.LINK_CREATED, None)], report)
+        self.assertTrue(os.path.islink(link_path))
+        self.assertEqual([], test_filesystem.apply_profile(profiles, "laptop")[1])
+
+        # Test that the cached plan is reused until the index changes
+        plan_filepath = test_filesystem._local_module.plan_filepath("laptop")
+        self.assertTrue(os.path.isfile(plan_filepath))
+        os.utime(plan_filepath, (0, 0))
+        self.assertEqual([(self._TEST_RESOURCE_FILENAME, link_path, unbox_links.STRATEGY_SYMLINK)], test_filesystem.link_plan(profiles, "laptop")[1])
+        self.assertEqual(0, os.stat(plan_filepath).st_mtime)
+        extra_filepath = os.path.join(self._TEST_DIRNAME, "extra.txt")
+        open(extra_filepath, 'w').close()
+        test_filesystem._dropbox_module.add_resource(extra_filepath)
+        self.assertEqual([("extra.txt", custom_link_path, unbox_links.STRATEGY_SYMLINK),
+                (self._TEST_RESOURCE_FILENAME, link_path, unbox_links.STRATEGY_SYMLINK)], test_filesystem.link_plan(profiles, "laptop")[1])
+        self.assertNotEqual(0, os.stat(plan_filepath).st_mtime)
+
+    def test_suggest_links(self):
+        """Tests that a rule file suggests link paths and that its mapping is cached until the rule file changes"""
+        test_filesystem = self._make_filesystem()
+        test_filesystem._dropbox_module.add_resource(self._TEST_RESOURCE_FILEPATH)
+        rules_filepath = os.path.join(self._TEST_DIRNAME, "rules")
+        rules_fp = open(rules_filepath, 'w')
+        rules_fp.write("*.txt => ~/text/{name}\n")
+        rules_fp.close()
+        self.assertEqual([(self._TEST_RESOURCE_FILENAME, os.path.expanduser("~/text/test.txt"))], test_filesystem.suggest_links(rules_filepath))
+        self.assertTrue(os.path.isfile(test_filesystem._local_module.rules_cache_filepath()))
+
+        rules_fp = open(rules_filepath, 'w')
+        rules_fp.write("*.md => ~/{name}\n")
+        rules_fp.close()
+        self.assertEqual([], test_filesystem.suggest_links(rules_filepath))
+
+    def test_scrub(self):
+        """Tests that scrubs record checksums, tell edits from corruption, and resume where they stopped"""
+        test_filesystem = self._make_filesystem()
+        test_filesystem._dropbox_module.add_resource(self._TEST_RESOURCE_FILEPATH, version="1.0")
+        backup_filepath = os.path.abspath(os.path.join(self._TEST_DIRNAME, "backed_up"))
+        open(backup_filepath, 'w').close()
+        test_filesystem._local_module.backup_add(backup_filepath)
+        version_label = "version:" + self._TEST_RESOURCE_FILENAME + ":1.0"
+
+        # Test that the first pass records checksums and the second finds nothing wrong
+        self.assertEqual([], test_filesystem.scrub(max_seconds=0))
+        self.assertEqual(sorted([unbox_scrub.SCRUB_RECORDED] * 2), sorted([outcome for _, outcome, _ in test_filesystem.scrub()]))
+        self.assertEqual([unbox_scrub.SCRUB_OK] * 2, [outcome for _, outcome, _ in test_filesystem.scrub()])
+        self.assertEqual(2, test_filesystem.scrub_results()[0])
+
+        # Test that silent changes are corruption, and edits that change the size are not
+        stored_filepath = test_filesystem._dropbox_module.resource_path(self._TEST_RESOURCE_FILENAME, "1.0")
+        stored_stat = os.stat(stored_filepath)
+        stored_fp = open(stored_filepath, 'w')
+        stored_fp.write("This is TEST text!")
+        stored_fp.close()
+        os.utime(stored_filepath, (stored_stat.st_atime, stored_stat.st_mtime))
+        scrubbed = dict([(label, (outcome, problems)) for label, outcome, problems in test_filesystem.scrub()])
+        self.assertEqual((unbox_scrub.SCRUB_CORRUPT, [(unbox_scrub.SCRUB_CORRUPT, self._TEST_RESOURCE_FILENAME)]), scrubbed[version_label])
+        stored_fp = open(stored_filepath, 'w')
+        stored_fp.write("Edited through a link")
+        stored_fp.close()
+        self.assertEqual(unbox_scrub.SCRUB_MODIFIED, dict([(label, outcome) for label, outcome, _ in test_filesystem.scrub()])[version_label])
+
+        # Test that checksums survive reloading the indexes
+        reloaded_filesystem = self._make_filesystem()
+        self.assertTrue(self._TEST_RESOURCE_FILENAME in reloaded_filesystem._dropbox_module.version_checksums(self._TEST_RESOURCE_FILENAME, "1.0"))
+        self.assertEqual(["backed_up"], list(reloaded_filesystem._local_module.backup_checksums(backup_filepath)))
+        self.assertEqual([unbox_scrub.SCRUB_OK] * 2, [outcome for _, outcome, _ in reloaded_filesystem.scrub()])
+
+        # Test that once another version is current, even a change to the size is corruption, and it isn't trusted afterwards
+        reloaded_filesystem._dropbox_module.copy_version(self._TEST_RESOURCE_FILENAME, "1.0", "2.0")
+        reloaded_filesystem.change_current_version(self._TEST_RESOURCE_FILENAME, "2.0")
+        reloaded_filesystem.scrub()
+        stored_fp = open(stored_filepath, 'w')
+        stored_fp.write("Truncated")
+        stored_fp.close()
+        for _ in range(2):
+            self.assertEqual(unbox_scrub.SCRUB_CORRUPT, dict([(label, outcome) for label, outcome, _ in reloaded_filesystem.scrub()])[version_label])
+
+    def test_scrub_throttle(self):
+        """Tests that the scrub throttle sleeps just enough to stay within its budget"""
+        clock = [100.0]
+        sleeps = []
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock[0] += seconds
+        throttle = unbox_scrub.Throttle(1000, clock=lambda: clock[0], sleep=sleep)
+        throttle.consume(500)
+        throttle.consume(500)
+        self.assertEqual([0.5, 0.5], sleeps)
+        clock[0] += 10
+        throttle.consume(100)
+        self.assertEqual(3, len(sleeps))
+        self.assertAlmostEqual(0.1, sleeps[2])
+
+    def test_templates(self):
+        """Tests that template resources are linked through incrementally rendered per-host copies"""
+        template_filepath = os.path.join(self._TEST_DIRNAME, "gitconfig")
+        template_fp = open(template_filepath, 'w')
+        template_fp.write("email = $email\nhost = ${hostname}, cost $$5\n")
+        template_fp.close()
+        test_filesystem = unbox_filesystem.Filesystem(self._TEST_LOCAL_UNBOX_DIRPATH, self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME,
+                template_variables={ "*" : { "email" : "a@example.com" }, "other-host" : { "email" : "b@example.com" } })
+        test_filesystem._dropbox_module.add_resource(template_filepath)
+        test_filesystem.set_template("gitconfig", True)
+        link_path = os.path.abspath(os.path.join(self._TEST_DIRNAME, "link"))
+        test_filesystem.add_link("gitconfig", link_path)
+        link_fp = open(link_path)
+        self.assertEqual("email = a@example.com\nhost = " + unbox_templates.host_variables(dict())["hostname"] + ", cost $5\n", link_fp.read())
+        link_fp.close()
+        rendered_path = os.path.realpath(link_path)
+        self.assertTrue(rendered_path.startswith(os.path.abspath(self._TEST_LOCAL_UNBOX_DIRPATH)))
+        self.assertEqual((0, set()), test_filesystem.render_templates())
+
+        # Changed variables render a new copy, retarget the link and drop the unused render
+        test_filesystem = unbox_filesystem.Filesystem(self._TEST_LOCAL_UNBOX_DIRPATH, self._TEST_DROPBOX_DIRPATH, self._TEST_DROPBOX_UNBOX_DIRNAME,
+                template_variables={ "*" : { "email" : "c@example.com" } })
+        self.assertEqual((1, set([link_path])), test_filesystem.render_templates())
+        self.assertFalse(os.path.exists(rendered_path))
+        link_fp = open(link_path)
+        self.assertTrue(link_fp.read().startswith("email = c@example.com\n"))
+        link_fp.close()
+
+        # Unflagged templates are linked straight to Dropbox again
+        test_filesystem.set_template("gitconfig", False)
+        self.assertEqual((0, set([link_path])), test_filesystem.render_templates())
+        self.assertEqual(test_filesystem._dropbox_module.resource_path("gitconfig", "1.0"), os.readlink(link_path))
+
+        # Snapshots carry the template flag, and imported links point at this machine's render
+        test_filesystem.set_template("gitconfig", True)
+        test_filesystem.render_templates()
+        snapshot_fp = io.BytesIO()
+        test_filesystem.export_snapshot(snapshot_fp)
+        test_filesystem._local_module.delete_link(link_path)
+        second_dropbox_dirpath = os.path.join(self._TEST_DIRNAME, "second_dropbox")
+        os.mkdir(second_dropbox_dirpath)
+        second_filesystem = unbox_filesystem.Filesystem(os.path.join(self._TEST_DIRNAME, "second_local_unbox"), second_dropbox_dirpath, "unbox",
+                template_variables={ "*" : { "email" : "d@example.com" } })
+        snapshot_fp.seek(0)
+        second_filesystem.import_snapshot(snapshot_fp)
+        self.assertTrue(second_filesystem._dropbox_module.is_template("gitconfig"))
+        link_fp = open(link_path)
+        self.assertTrue(link_fp.read().startswith("email = d@example.com\n"))
+        link_fp.close()
+        self.assertEqual(0, second_filesystem.estimate_add_links([("gitconfig", link_path, unbox_links.STRATEGY_SYMLINK)]).links_to_change)
+
+        self.assertRaises(ValueError, unbox_templates.render_text, "$missing", dict())
+
+    def test_snapshot_round_trip(self):
+        """Tests that a streamed snapshot provisions a second Unbox root with resources and links"""
+        test_filesystem = self._make_filesystem()
+        test_filesystem._dropbox_module.add_resource(self._TEST_RESOURCE_FILEPATH, version="1.0", dependencies=set(["dep1"]))
+        test_filesystem._dropbox_module.copy_version(self._TEST_RESOURCE_FILENAME, "1.0", "2.0")
+        test_filesystem.change_current_version(self._TEST_RESOURCE_FILENAME, "2.0")
+        link_path = os.path.abspath(os.path.join(self._TEST_DIRNAME, "link"))
+        test_filesystem.add_link(self._TEST_RESOURCE_FILENAME, link_path)
+
+        # Export, then clear the link so the import has to recreate it
+        snapshot_fp = io.BytesIO()
+        self.assertEqual([self._TEST_RESOURCE_FILENAME], test_filesystem.export_snapshot(snapshot_fp))
+        test_filesystem._local_module.delete_link(link_path)
+
+        # Import into a fresh Unbox root
+        second_dropbox_dirpath = os.path.join(self._TEST_DIRNAME, "second_dropbox")
+        os.mkdir(second_dropbox_dirpath)
+        second_filesystem = unbox_filesystem.Filesystem(os.path.join(self._TEST_DIRNAME, "second_local_unbox"), second_dropbox_dirpath, "unbox")
+        snapshot_fp.seek(0)
+        imported, created_links = second_filesystem.import_snapshot(snapshot_fp)
+        self.assertEqual([self._TEST_RESOURCE_FILENAME], imported)
+        self.assertEqual([link_path], created_links)
+
+        # Only the current version travels, with its dependencies
+        _, current_version, versions = second_filesystem._dropbox_module.resource_info(self._TEST_RESOURCE_FILENAME)
+        self.assertEqual("2.0", current_version)
+        self.assertEqual(["2.0"], list(versions))
+        self.assertEqual(set(["dep1"]), second_filesystem._dropbox_module.version_info(self._TEST_RESOURCE_FILENAME, "2.0"))
+        link_fp = open(link_path)
+        self.assertEqual("This is test text!", link_fp.read())
+        link_fp.close()
+
+    def test_snapshot_rejects_escaping_symlinks(self):
+        """Tests that archive symlinks can't point outside their resource or have later members written through them"""
+        test_filesystem = self._make_filesystem()
+        victim_dirpath = os.path.abspath(os.path.join(self._TEST_DIRNAME, "victim"))
+        os.mkdir(victim_dirpath)
+        manifest_data = json.dumps({ "resources" : { "evil" : { "version" : "1.0", "dependencies" : [] } }, "links" : [] }).encode("utf-8")
+
+        def make_snapshot(symlink_target, member_name):
+            snapshot_fp = io.BytesIO()
+            snapshot_tar = tarfile.open(fileobj=snapshot_fp, mode="w")
+            manifest_tarinfo = tarfile.TarInfo("manifest.json")
+            manifest_tarinfo.size = len(manifest_data)
+            snapshot_tar.addfile(manifest_tarinfo, io.BytesIO(manifest_data))
+            symlink_tarinfo = tarfile.TarInfo("resources/evil/esc")
+            symlink_tarinfo.type = tarfile.SYMTYPE
+            symlink_tarinfo.linkname = symlink_target
+            snapshot_tar.addfile(symlink_tarinfo)
+            owned_tarinfo = tarfile.TarInfo(member_name)
+            owned_tarinfo.size = 5
+            snapshot_tar.addfile(owned_tarinfo, io.BytesIO(b"owned"))
+            snapshot_tar.close()
+            snapshot_fp.seek(0)
+            return snapshot_fp
+
+        for symlink_target in (victim_dirpath, "../../victim", "inside"):
+            self.assertRaises(ValueError, test_filesystem.import_snapshot, make_snapshot(symlink_target, "resources/evil/esc/owned.txt"))
+            self.assertEqual([], os.listdir(victim_dirpath))
+            self.assertFalse(test_filesystem._dropbox_module.resource_exists("evil"))
+
+        # Symlinks staying inside the resource are still imported
+        imported, _ = test_filesystem.import_snapshot(make_snapshot("inside", "resources/evil/inside"))
+        self.assertEqual(["evil"], imported)
+
+    def test_status(self):
+        """Tests that status reports each kind of drift without modifying anything"""
+        test_filesystem = self._make_filesystem()
+        test_filesystem._dropbox_module.add_resource(self._TEST_RESOURCE_FILEPATH, version="1.0")
+        self.assertEqual([(unbox_filesystem.Filesystem.DRIFT_UNTRACKED, self._TEST_RESOURCE_FILENAME, "resource is neither linked nor ignored")],
+                test_filesystem.status())
+
+        # Set up a clean state
+        following_link = os.path.abspath(os.path.join(self._TEST_DIRNAME, "following"))
+        foreign_link = os.path.abspath(os.path.join(self._TEST_DIRNAME, "foreign"))
+        test_filesystem.add_link(self._TEST_RESOURCE_FILENAME, following_link)
+        test_filesystem.add_link(self._TEST_RESOURCE_FILENAME, foreign_link)
+        self.assertEqual([], test_filesystem.status())
+
+        # Introduce drift: a removed link, a replaced link and a version change behind Unbox's back
+        os.remove(following_link)
+        os.remove(foreign_link)
+        foreign_fp = open(foreign_link, "w")
+        foreign_fp.write("Not a link")
+        foreign_fp.close()
+        test_filesystem._dropbox_module.copy_version(self._TEST_RESOURCE_FILENAME, "1.0", "2.0")
+        test_filesystem._dropbox_module.change_current_version(self._TEST_RESOURCE_FILENAME, "2.0")
+
+        drift_kinds = [(drift_kind, subject) for drift_kind, subject, _ in test_filesystem.status()]
+        self.assertTrue((unbox_filesystem.Filesystem.DRIFT_MISSING, following_link) in drift_kinds)
+        self.assertTrue((unbox_filesystem.Filesystem.DRIFT_FOREIGN, foreign_link) in drift_kinds)
+        self.assertTrue((unbox_filesystem.Filesystem.DRIFT_STALE_VERSION, following_link) in drift_kinds)
+        self.assertTrue(os.path.isfile(foreign_link))
 
     def tearDown(self):
         """Cleans up the test environment"""
@@ -236,4 +1416,5 @@ if __name__ == "__main__":
     logging.basicConfig(stream = sys.stderr)
     logging.getLogger("TestDropboxModule").setLevel(logging.DEBUG)
     logging.getLogger("TestLocalModule").setLevel(logging.DEBUG)
+    logging.getLogger("TestFilesystem").setLevel(logging.DEBUG)
     unittest.main(verbosity=2)
@@ -1,78 +1,398 @@
 #!/usr/bin/python
 
 # Import python libraries
+# NOTE: Everything else, including the Unbox modules, is imported by the commands that use it, so trivial commands start fast
 import sys
-import os.path
-import tempfile
-import json
-import subprocess
-import time
-import optparse
 
-# Import custom libraries
-import unbox_core
+""" ======== STATE ======== """
 
+# Kinds of state a command can need; each command declares its needs and only those are loaded
+STATE_CONFIG = "config"                 # Settings in 'config.json'
+STATE_DROPBOX_INDEX = "dropbox index"   # Index of resources and versions in Dropbox
+STATE_LOCAL_INDEX = "local index"       # Indexes of links and backups on this machine
+STATE_REMOTE_SCAN = "remote scan"       # Legacy Core, which enumerates every file in the resources directory
 
+"""
+State shared by the commands of a run, loaded lazily so a command only pays for what it uses
+"""
+class State:
+    def __init__(self):
+        self._config = None
+        self._filesystem = None
+        self._core = None
 
-""" ======== MAIN ======== """
+    """
+    Loads the given kinds of state up front, so a command fails before doing anything if one can't be loaded
+    - needs: iterable of STATE_* constants
+    """
+    def load(self, needs):
+        if STATE_CONFIG in needs:
+            self.config()
+        if STATE_DROPBOX_INDEX in needs or STATE_LOCAL_INDEX in needs:
+            self.filesystem().load_indexes(STATE_DROPBOX_INDEX in needs, STATE_LOCAL_INDEX in needs)
+        if STATE_REMOTE_SCAN in needs:
+            self.core()
+
+    """
+    Reads the settings in 'config.json' once per run
+    - RETURN: dict of settings
+    """
+    def config(self):
+        if self._config is None:
+            import json
+            try:
+                config_fp = open("config.json")
+            except IOError:
+                print("Unable to find 'config.json'")
+                sys.exit(1)
+            self._config = json.load(config_fp)
+            config_fp.close()
+        return self._config
+
+    """
+    Builds the Unbox filesystem from the directories named in 'config.json'; its indexes are read on first use
+    NOTE: The run's metrics are added to this machine's totals when the script exits, and written in Prometheus format
+    to the file named by the 'metrics textfile' setting if there is one, unless the run changed nothing
+    - RETURN: Filesystem object
+    """
+    def filesystem(self):
+        if self._filesystem is None:
+            import atexit
+            import os.path
+            import unbox_filesystem
+            config_obj = self.config()
+            dropbox_dirpath, dropbox_unbox_dirname = os.path.split(unbox_filesystem.abs_path(config_obj["resources directory"]))
+            extra_roots = [os.path.split(unbox_filesystem.abs_path(extra_dirpath))
+                    for extra_dirpath in config_obj.get("extra resources directories", [])]
+            self._filesystem = unbox_filesystem.Filesystem(config_obj["unbox directory"], dropbox_dirpath, dropbox_unbox_dirname,
+                    config_obj.get("relative links", False), extra_roots, config_obj.get("template variables"), config_obj.get("machine id"))
+            atexit.register(record_metrics, self._filesystem, config_obj.get("metrics textfile"))
+        return self._filesystem
+
+    """
+    Builds the legacy Core, which enumerates every file in the resources directory
+    - RETURN: unbox_core.Core object
+    """
+    def core(self):
+        if self._core is None:
+            import unbox_core
+            self._core = unbox_core.Core(self.config())
+        return self._core
+
+"""
+Adds the run's metrics to this machine's totals and exports the totals for a node-exporter textfile collector
+NOTE: Runs that counted nothing, such as read-only commands, are skipped, so they never take the totals file's lock or write to it
+- filesystem: Filesystem the run used
+- textfile_path: path of the Prometheus textfile to write, or None to skip it
+"""
+def record_metrics(filesystem, textfile_path):
+    import unbox_filesystem
+    import unbox_metrics
+    if not unbox_metrics.REGISTRY.counted():
+        return
+    totals = filesystem.record_metrics()
+    if textfile_path is not None:
+        unbox_metrics.write_textfile(totals, unbox_filesystem.abs_path(textfile_path))
 
-# Ensure config exists
-try:
-    config_file = open("config.json")
-except IOError:
-    print("Unable to find 'config.json'")
-    sys.exit()
 
-# Load state of application
-config_file = open("config.json")
-core = unbox_core.Core(config_file)
-core.clean_lists()
 
-# Parse user arguments
-#parser = OptionParser()
-#parser.add_option("-f", "--fresh", help="configure Unbox from scratch"
-command_arg = sys.argv[1]
+""" ======== COMMANDS ======== """
 
+# Maps command name -> (function taking a State and the command's arguments, tuple of STATE_* needs, usage, description)
+# Functions return the script's exit code, or None for success
+_COMMANDS = dict()
+
+"""
+Registers a function as a subcommand
+- name: name of the subcommand
+- needs: tuple of STATE_* constants the command uses
+- usage: arguments the command takes, for help output
+- description: one-line description for help output
+- RETURN: decorator
+"""
+def command(name, needs, usage, description):
+    def register(function):
+        _COMMANDS[name] = (function, needs, usage, description)
+        return function
+    return register
+
+@command("fresh", (STATE_CONFIG, STATE_REMOTE_SCAN), "", "Configure Unbox from scratch, choosing link paths in an editor")
+def fresh_command(state, args):
+    import os
+    import subprocess
+    import tempfile
+    import unbox_core
+
+    # Load state of application
+    core = state.core()
+    core.clean_lists()
 
-# Perform fresh install
-if command_arg == "fresh":
-    
     resource_link_dict = core.resource_link_dict
     core.remove_links(resource_link_dict.keys())
     core.ignored_resources = []
-    remote_resources = core.remote_resources
-    
-    # Write out resources in Dropbox folder in temp file
-    json_obj = dict.fromkeys(remote_resources, " ")
-    tempfile = tempfile.NamedTemporaryFile(delete=False)
-    json.dump(json_obj, tempfile, indent=4, separators=(",", "\t:\t"))
-    tempfile.flush()
+
+    # Stream resources in Dropbox folder into temp file, suggesting link paths from the rule file if there is one
+    suggest_link = lambda resource_path: None
+    rules_filepath = state.config().get("link rules")
+    if rules_filepath is not None:
+        import unbox_filesystem
+        import unbox_rules
+        rules = unbox_rules.load_rules(unbox_filesystem.abs_path(rules_filepath))[1]
+        suggest_link = lambda resource_path: rules.match(os.path.relpath(resource_path, core.remote_resource_dir_path))
+    editor_fp = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    unbox_core.write_link_choices(editor_fp, ((resource_path, suggest_link(resource_path)) for resource_path in core.iter_remote_resources()))
+    editor_fp.close()
 
     # Open editor to let user set what should be installed
     editor = os.environ.get("EDITOR", "vim")
-    return_code = subprocess.call([editor, tempfile.name]) 
-    tempfile.seek(0)
-    desired_links = json.load(tempfile)
-    tempfile.close()
-
-    # Process user's decisions
-    resources_to_ignore = [resource for resource in desired_links.keys() if resource not in remote_resources]
-    core.ignored_resources.append(resources_to_ignore)
-    core.forge_links(desired_links)
-# Print help
-elif command_arg == "help":
-    printHelp()
-else:
-    usage()
-
-    
-
-core.write_lists()
-    # remove any existing links
-    # clear the ignore list
-    # gather all resources
-    # display list of resources to user
-    # add list of resources user did not map to ignore list
-
-    
+    return_code = subprocess.call([editor, editor_fp.name])
+
+    # Process user's decisions as they are read, ignoring resources left without a link path
+    def chosen_links(choices_fp):
+        for resource_path, link_path in unbox_core.read_link_choices(choices_fp):
+            if len(link_path) == 0:
+                core.ignored_resources.append(resource_path)
+            else:
+                yield (resource_path, link_path)
+    choices_fp = open(editor_fp.name)
+    try:
+        core.forge_links(chosen_links(choices_fp))
+    finally:
+        choices_fp.close()
+        os.remove(editor_fp.name)
+    core.write_lists()
+
+@command("dropconfig", (STATE_CONFIG, STATE_REMOTE_SCAN), "[file]", "Create the links a legacy .dropconfig file (default: ~/.dropconfig) lists")
+def dropconfig_command(state, args):
+    import os.path
+    core = state.core()
+    dropconfig_fp = open(os.path.expanduser(args[0] if len(args) > 0 else "~/.dropconfig"))
+    try:
+        num_links, num_bad_lines = core.import_dropconfig(dropconfig_fp)
+    finally:
+        dropconfig_fp.close()
+    core.write_lists()
+    print("Processed " + str(num_links) + " links, " + str(num_bad_lines) + " unreadable lines")
+    if num_bad_lines > 0:
+        return 1
+
+@command("list", (STATE_DROPBOX_INDEX,), "[--origin] [pattern]",
+        "List resources, optionally filtered by a glob pattern; --origin also shows which resources directory each comes from")
+def list_command(state, args):
+    show_origin = len(args) > 0 and args[0] == "--origin"
+    if show_origin:
+        args = args[1:]
+    pattern = args[0] if len(args) > 0 else None
+    filesystem = state.filesystem()
+    for resource_name in filesystem.find_resources(pattern):
+        print(resource_name + "\t" + filesystem.resource_origin(resource_name) if show_origin else resource_name)
+    if show_origin:
+        for resource_name, shadowed_dirpath, origin_dirpath in filesystem.shadowed_resources():
+            sys.stderr.write("Shadowed: " + resource_name + " in " + shadowed_dirpath + " by " + origin_dirpath + "\n")
+
+@command("versions", (STATE_DROPBOX_INDEX,), "<spec>", "List resource versions matching a version query (e.g. 2.x)")
+def versions_command(state, args):
+    if len(args) != 1:
+        return usage()
+    for resource_name, version in state.filesystem().find_versions(args[0]):
+        print(resource_name + "\t" + version)
+
+@command("status", (STATE_DROPBOX_INDEX, STATE_LOCAL_INDEX), "", "Report drift between the desired state and this machine, exiting nonzero if there is any")
+def status_command(state, args):
+    drift = state.filesystem().status()
+    drift_counts = dict()
+    for drift_kind, subject, detail in drift:
+        print(drift_kind + "\t" + subject + "\t" + detail)
+        drift_counts[drift_kind] = drift_counts.get(drift_kind, 0) + 1
+    if len(drift) == 0:
+        print("No drift")
+        return None
+    print(", ".join([str(count) + " " + drift_kind for drift_kind, count in sorted(drift_counts.items())]))
+    return 1
+
+@command("switch", (STATE_DROPBOX_INDEX, STATE_LOCAL_INDEX), "<resource>=<version>...", "Change the current versions of resources together, all or none")
+def switch_command(state, args):
+    changes = [arg.split("=", 1) for arg in args]
+    if len(changes) == 0 or any([len(change) != 2 for change in changes]):
+        return usage()
+    retargeted = state.filesystem().change_current_versions([tuple(change) for change in changes])
+    print("Switched " + str(len(changes)) + " resources and retargeted " + str(len(retargeted)) + " links")
+
+@command("export", (STATE_DROPBOX_INDEX,), "[pattern...]", "Stream a snapshot of resources matching the glob patterns (default: all) to stdout")
+def export_command(state, args):
+    filesystem = state.filesystem()
+    resource_names = None
+    if len(args) > 0:
+        resource_names = set()
+        for pattern in args:
+            resource_names.update(filesystem.find_resources(pattern))
+    filesystem.export_snapshot(getattr(sys.stdout, "buffer", sys.stdout), resource_names)
+
+@command("import", (STATE_DROPBOX_INDEX, STATE_LOCAL_INDEX), "[snapshot file]", "Provision this machine from a snapshot file, or stdin if none is given")
+def import_command(state, args):
+    if len(args) > 0 and args[0] != "-":
+        snapshot_fp = open(args[0], "rb")
+    else:
+        snapshot_fp = getattr(sys.stdin, "buffer", sys.stdin)
+    imported, created_links = state.filesystem().import_snapshot(snapshot_fp)
+    print("Imported " + str(len(imported)) + " resources and created " + str(len(created_links)) + " links")
+
+@command("diff", (STATE_DROPBOX_INDEX,), "<resource> <old version> <new version>", "List what changed between two versions of a resource, exiting nonzero if anything did")
+def diff_command(state, args):
+    if len(args) != 3:
+        return usage()
+    changes = state.filesystem().diff_versions(*args)
+    for change_kind, relative_path in changes:
+        print(change_kind + "\t" + relative_path)
+    if len(changes) > 0:
+        return 1
+
+@command("estimate", (STATE_DROPBOX_INDEX,), "add <path>... | copy <resource> <source> <new> | apply [profile] | dropconfig [file]",
+        "Predict the cost of adding resources, copying a version, applying a profile or creating a legacy .dropconfig file's links")
+def estimate_command(state, args):
+    filesystem = state.filesystem()
+    if len(args) > 1 and args[0] == "add":
+        estimate = filesystem.estimate_add_resources([(path, None, None) for path in args[1:]])
+    elif len(args) == 4 and args[0] == "copy":
+        estimate = filesystem.estimate_copy_version(*args[1:])
+    elif len(args) in (1, 2) and args[0] == "apply":
+        _, plan = filesystem.link_plan(state.config().get("profiles", dict()), args[1] if len(args) > 1 else None)
+        estimate = filesystem.estimate_add_links(plan)
+    elif len(args) in (1, 2) and args[0] == "dropconfig":
+        import os.path
+        dropconfig_fp = open(os.path.expanduser(args[1] if len(args) > 1 else "~/.dropconfig"))
+        try:
+            estimate = state.core().estimate_import_dropconfig(dropconfig_fp)
+        finally:
+            dropconfig_fp.close()
+    else:
+        print("Unknown operation to estimate: " + " ".join(args))
+        return 1
+    for description, value in estimate.items():
+        print(description + "\t" + str(value))
+
+@command("suggest", (STATE_CONFIG, STATE_DROPBOX_INDEX), "[rule file]", "Print the link paths a rule file (default: the 'link rules' setting) suggests for resources")
+def suggest_command(state, args):
+    rules_filepath = args[0] if len(args) > 0 else state.config().get("link rules")
+    if rules_filepath is None:
+        print("No rule file given and no 'link rules' setting in 'config.json'")
+        return 1
+    for resource_name, link_path in state.filesystem().suggest_links(rules_filepath):
+        print(resource_name + "\t" + link_path)
+
+@command("plan", (STATE_CONFIG, STATE_DROPBOX_INDEX), "[profile]", "Print the links a profile (default: the one listing this host) wants")
+def plan_command(state, args):
+    profile_name, plan = state.filesystem().link_plan(state.config().get("profiles", dict()), args[0] if len(args) > 0 else None)
+    print("Profile: " + profile_name)
+    for resource_name, link_path, strategy in plan:
+        print(resource_name + "\t" + link_path + "\t" + strategy)
+
+@command("apply", (STATE_CONFIG, STATE_DROPBOX_INDEX, STATE_LOCAL_INDEX), "[profile]", "Create the links a profile (default: the one listing this host) wants, exiting nonzero if any fail")
+def apply_command(state, args):
+    profile_name, report = state.filesystem().apply_profile(state.config().get("profiles", dict()), args[0] if len(args) > 0 else None)
+    failures = [(link_path, error) for link_path, outcome, error in report if error is not None]
+    for link_path, error in failures:
+        print("Failed\t" + link_path + "\t" + error)
+    print("Applied profile '" + profile_name + "': " + str(len(report) - len(failures)) + " links added, " + str(len(failures)) + " failed")
+    if len(failures) > 0:
+        return 1
+
+@command("autoversion", (STATE_CONFIG, STATE_DROPBOX_INDEX, STATE_LOCAL_INDEX), "[--watch <seconds>]",
+        "Keep settled edits to resources matching the 'autoversion' patterns as new versions, once or every few seconds")
+def autoversion_command(state, args):
+    import time
+    if len(args) not in (0, 2) or (len(args) == 2 and args[0] != "--watch"):
+        return usage()
+    config_obj = state.config()
+    filesystem = state.filesystem()
+    while True:
+        for resource_name, outcome, snapshot_version in filesystem.autoversion(config_obj.get("autoversion", []),
+                config_obj.get("autoversion quiet seconds", 60)):
+            if snapshot_version is not None:
+                print("Kept edits to " + resource_name + " as version " + snapshot_version)
+        if len(args) == 0:
+            return None
+        time.sleep(float(args[1]))
+
+@command("template", (STATE_CONFIG, STATE_DROPBOX_INDEX), "<resource> on|off",
+        "Flag a resource as a template, rendered with this host's 'template variables' before being linked, or unflag it")
+def template_command(state, args):
+    if len(args) != 2 or args[1] not in ("on", "off"):
+        return usage()
+    state.filesystem().set_template(args[0], args[1] == "on")
+
+@command("render", (STATE_CONFIG, STATE_DROPBOX_INDEX, STATE_LOCAL_INDEX), "",
+        "Re-render linked template resources whose content or 'template variables' changed, and point their links at the renders")
+def render_command(state, args):
+    num_rendered, retargeted = state.filesystem().render_templates()
+    print("Rendered " + str(num_rendered) + " templates and retargeted " + str(len(retargeted)) + " links")
+
+@command("scrub", (STATE_CONFIG, STATE_DROPBOX_INDEX, STATE_LOCAL_INDEX), "[seconds | --results]",
+        "Verify stored versions and backups within the 'scrub bandwidth' budget (bytes per second), resuming where the last scrub stopped")
+def scrub_command(state, args):
+    import unbox_scrub
+    filesystem = state.filesystem()
+    if len(args) > 0 and args[0] == "--results":
+        passes, results = filesystem.scrub_results()
+        print(str(passes) + " full passes")
+        for label, outcome, scrub_time, problems in results:
+            print(outcome + "\t" + label + "\t" + ", ".join([problem_outcome + " " + relative_path for problem_outcome, relative_path in problems]))
+        return None
+    max_seconds = float(args[0]) if len(args) > 0 else None
+    scrubbed = filesystem.scrub(state.config().get("scrub bandwidth"), max_seconds)
+    problems = [(label, outcome) for label, outcome, _ in scrubbed if outcome in (unbox_scrub.SCRUB_CORRUPT, unbox_scrub.SCRUB_MISSING)]
+    for label, outcome in problems:
+        print(outcome + "\t" + label)
+    print("Scrubbed " + str(len(scrubbed)) + " items, " + str(len(problems)) + " damaged")
+    if len(problems) > 0:
+        return 1
+
+@command("stats", (STATE_LOCAL_INDEX,), "[--prometheus]", "Print this machine's metric totals, or write them in Prometheus format")
+def stats_command(state, args):
+    totals = state.filesystem().metrics_totals()
+    if len(args) > 0 and args[0] == "--prometheus":
+        sys.stdout.write(totals.to_prometheus())
+        return None
+    for counter in totals.counters():
+        print(counter.name + "\t" + str(counter.value))
+    for histogram in totals.histograms():
+        for operation, (_, observation_sum, observation_count) in sorted(histogram.series.items()):
+            print(histogram.name + "\t" + operation + "\t" + str(observation_count) + " calls, "
+                    + "%.3f" % (observation_sum / observation_count) + "s mean")
+
+@command("help", (), "", "Print this help")
+def help_command(state, args):
+    print("Usage: unbox.py <command> [arguments]")
+    print("")
+    for name in sorted(_COMMANDS):
+        _, _, command_usage, description = _COMMANDS[name]
+        print("  " + (name + " " + command_usage).strip())
+        print("      " + description)
+
+"""
+Prints short usage
+- RETURN: exit code for a usage error
+"""
+def usage():
+    print("Usage: unbox.py <command> [arguments]; run 'unbox.py help' for the list of commands")
+    return 2
+
+
+
+""" ======== MAIN ======== """
+
+"""
+Runs the subcommand named by the script's arguments
+- argv: script arguments, including the script name
+- RETURN: exit code
+"""
+def main(argv):
+    if len(argv) < 2 or argv[1] not in _COMMANDS:
+        return usage()
+    function, needs, _, _ = _COMMANDS[argv[1]]
+    state = State()
+    state.load(needs)
+    return function(state, argv[2:]) or 0
 
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,145 @@
+import json
+import os
+import stat
+
+import unbox_lock
+import unbox_scrub
+
+# Outcomes of checking a resource's current version for edits
+AUTOVERSION_BASELINE = "baseline"       # Current version wasn't fingerprinted yet, so its contents were recorded
+AUTOVERSION_UNCHANGED = "unchanged"     # Contents match the recorded fingerprint, even if timestamps changed
+AUTOVERSION_PENDING = "pending"         # Contents were edited, but not long enough ago to be sure the edits are done
+AUTOVERSION_SNAPSHOT = "snapshot"       # Edits settled, so the edited contents were kept as a version and a new current version was made
+
+# Keys in each resource's entry in the autoversion state file
+_ENTRY_KEY_VERSION = "version"
+_ENTRY_KEY_FINGERPRINT = "fingerprint"
+_ENTRY_KEY_PENDING = "pending"
+_ENTRY_KEY_CHANGED_AT = "changed at"
+
+"""
+Fingerprints the regular files of a resource, only hashing files whose size or mtime changed since an earlier fingerprint
+- path: path to resource file or directory
+- previous: fingerprint from an earlier call to reuse hashes from, or None
+- RETURN: dict of relative file paths -> [size, mtime, hex digest]
+"""
+def fingerprint(path, previous=None):
+    previous = previous or dict()
+    if os.path.isdir(path):
+        filepaths = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            filepaths.extend([os.path.join(dirpath, filename) for filename in filenames])
+        filepaths = [(os.path.relpath(filepath, path), filepath) for filepath in filepaths]
+    else:
+        filepaths = [(os.path.basename(path), path)]
+    file_fingerprints = dict()
+    for relative_path, filepath in filepaths:
+        file_stat = os.lstat(filepath)
+        if not stat.S_ISREG(file_stat.st_mode):
+            continue
+        previous_entry = previous.get(relative_path)
+        if previous_entry is not None and previous_entry[:2] == [file_stat.st_size, file_stat.st_mtime]:
+            file_fingerprints[relative_path] = previous_entry
+        else:
+            file_fingerprints[relative_path] = [file_stat.st_size, file_stat.st_mtime, unbox_scrub.file_hash(filepath)]
+    return file_fingerprints
+
+"""
+Checks if two fingerprints describe different contents, ignoring timestamps
+- first_fingerprint: fingerprint from fingerprint()
+- second_fingerprint: fingerprint from fingerprint()
+- RETURN: True if a file was added, removed or changed, False otherwise
+"""
+def contents_differ(first_fingerprint, second_fingerprint):
+    return (dict([(relative_path, entry[2]) for relative_path, entry in first_fingerprint.items()])
+            != dict([(relative_path, entry[2]) for relative_path, entry in second_fingerprint.items()]))
+
+"""
+Decides what to do about a resource's current version, debouncing bursts of edits
+NOTE: A snapshot is only due once the contents have stayed the same for quiet_seconds, so a burst of saves makes one version
+- entry: the resource's entry from the autoversion state, or None if it has none
+- version: name of the resource's current version
+- current_fingerprint: fingerprint of the current version's contents
+- now: current unix time
+- quiet_seconds: how long edited contents must stay unchanged before being snapshotted
+- RETURN: tuple of (AUTOVERSION_* outcome, new entry); on AUTOVERSION_SNAPSHOT the caller must replace the entry with one for the new version
+"""
+def step(entry, version, current_fingerprint, now, quiet_seconds):
+    if entry is None or entry[_ENTRY_KEY_VERSION] != version:
+        return (AUTOVERSION_BASELINE, baseline_entry(version, current_fingerprint))
+    if not contents_differ(entry[_ENTRY_KEY_FINGERPRINT], current_fingerprint):
+        return (AUTOVERSION_UNCHANGED, baseline_entry(version, current_fingerprint))
+    pending = entry.get(_ENTRY_KEY_PENDING)
+    new_entry = dict(entry)
+    new_entry[_ENTRY_KEY_PENDING] = current_fingerprint
+    if pending is None or contents_differ(pending, current_fingerprint):
+        new_entry[_ENTRY_KEY_CHANGED_AT] = now
+        return (AUTOVERSION_PENDING, new_entry)
+    if now - entry[_ENTRY_KEY_CHANGED_AT] < quiet_seconds:
+        return (AUTOVERSION_PENDING, new_entry)
+    return (AUTOVERSION_SNAPSHOT, new_entry)
+
+"""
+Builds a state entry recording a version's contents as unedited
+- version: name of version
+- version_fingerprint: fingerprint of the version's contents
+- RETURN: state entry
+"""
+def baseline_entry(version, version_fingerprint):
+    return { _ENTRY_KEY_VERSION : version, _ENTRY_KEY_FINGERPRINT : version_fingerprint, _ENTRY_KEY_PENDING : None, _ENTRY_KEY_CHANGED_AT : None }
+
+"""
+Gets the fingerprint to reuse hashes from when fingerprinting a resource again
+- entry: the resource's entry from the autoversion state, or None if it has none
+- RETURN: the most recent fingerprint in the entry, or None
+"""
+def latest_fingerprint(entry):
+    if entry is None:
+        return None
+    return entry.get(_ENTRY_KEY_PENDING) or entry[_ENTRY_KEY_FINGERPRINT]
+
+"""
+Names the version after a given one, by counting up its last numeric component until the name is free
+- version: name of version, e.g. "1.2"
+- existing_versions: collection of names already in use
+- RETURN: new version name, e.g. "1.3", or the version with ".1" appended if it has no numeric component
+"""
+def next_version(version, existing_versions):
+    components = version.split(".")
+    numeric_idxs = [idx for idx, component in enumerate(components) if component.isdigit()]
+    if len(numeric_idxs) == 0:
+        components.append("0")
+        numeric_idxs = [len(components) - 1]
+    last_numeric_idx = numeric_idxs[-1]
+    while True:
+        components[last_numeric_idx] = str(int(components[last_numeric_idx]) + 1)
+        candidate = ".".join(components)
+        if candidate not in existing_versions:
+            return candidate
+
+"""
+Reads the autoversion state, holding each watched resource's fingerprints and pending edits
+- state_filepath: path to the autoversion state file
+- RETURN: dict of resource names -> state entries
+"""
+def load_state(state_filepath):
+    state = dict()
+    with unbox_lock.shared_lock(state_filepath):
+        if os.path.isfile(state_filepath):
+            state_fp = open(state_filepath)
+            try:
+                state = json.load(state_fp)
+            except ValueError:
+                pass
+            finally:
+                state_fp.close()
+    return state
+
+"""
+Writes the autoversion state
+- state_filepath: path to the autoversion state file
+- state: dict of resource names -> state entries
+"""
+def save_state(state_filepath, state):
+    with unbox_lock.exclusive_lock(state_filepath):
+        unbox_lock.atomic_write(state_filepath, lambda state_fp: state_fp.write(json.dumps(state, sort_keys=True).encode("utf-8")))
@@ -1,16 +1,36 @@
 # Import python libraries
+import fnmatch
+import itertools
 import json
 import sys
 import os
-import shutil
 
-import unbox_config
+import unbox_backend
+import unbox_estimate
 import unbox_filesystem
+import unbox_links
 
 """
 Main processing engine for the script
 """
 class Core:
+    """ ====== Constants ======== """
+
+    # Files in the local Unbox directory holding the links created and the resources the user chose to ignore
+    LINK_FILENAME = "links.json"
+    IGNORED_FILENAME = "ignored.json"
+
+    # Suffix appended to file objects found where a link should go
+    BACKUP_SUFFIX = ".unbox_bak"
+
+    # Suffix dropconfig.sh appended to file objects found where a link should go, kept when importing its config files
+    DROPCONFIG_BACKUP_SUFFIX = ".conf_bak"
+
+    # Most links forge_links holds at once; each batch's links are created a directory at a time
+    FORGE_BATCH_SIZE = 512
+
+
+
     """ ====== Variables ======== """
 
     # Information about items in Dropbox
@@ -39,24 +59,32 @@ class Core:
 
     # Mapping of 
     terminal_text_color_codes = None
+
+    # Filesystem backend every file operation goes through
+    backend = None
     
 
 
     """ ====== Functions ======== """
     """
     Constructor method
-     - config_fp: filepointer to the Unbox config file
-     - script_args: arguments passed to the script
+    NOTE: Resources aren't gathered up front; iterate over them with iter_remote_resources
+     - config_obj: dict of settings from the Unbox config file
+     - backend: unbox_backend filesystem backend to perform every file operation through, or None for the real filesystem
     """
-    def __init__(self, config_fp):
-        self._validate_dropbox_unbox(DROPBOX_DIRPATH, DROPBOX_UNBOX_DIRNAME)
-        self._validate_local_unbox(LOCAL_UNBOX_DIRPATH)
-
+    def __init__(self, config_obj, backend=None):
+        self.backend = backend or unbox_backend.OS_BACKEND
+        self.remote_resource_dir_path = unbox_filesystem.abs_path(config_obj["resources directory"])
+        if not self.backend.isdir(self.remote_resource_dir_path):
+            raise ValueError("Cannot load Unbox; resources directory " + self.remote_resource_dir_path + " does not exist")
+        self.unbox_dir_path = unbox_filesystem.abs_path(config_obj["unbox directory"])
+        if not self.backend.isdir(self.unbox_dir_path):
+            self.backend.makedirs(self.unbox_dir_path)
 
         # Load rules from files detailing what links should be made
         resource_link_dict_filepath = os.path.join(self.unbox_dir_path, self.LINK_FILENAME)
-        if os.path.exists(resource_link_dict_filepath):
-            resource_link_dict_file = open(resource_link_dict_filepath, 'r+')
+        if self.backend.exists(resource_link_dict_filepath):
+            resource_link_dict_file = self.backend.open(resource_link_dict_filepath, 'r+')
             self.resource_link_dict = json.load(resource_link_dict_file)
             resource_link_dict_file.close()
         else:
@@ -64,57 +92,144 @@ class Core:
         
         # Load which resources should be ignored
         ignored_resources_filepath = os.path.join(self.unbox_dir_path, self.IGNORED_FILENAME)
-        if os.path.exists(ignored_resources_filepath):
-            ignored_resources_file = open(ignored_resources_filepath, 'r+')
+        if self.backend.exists(ignored_resources_filepath):
+            ignored_resources_file = self.backend.open(ignored_resources_filepath, 'r+')
             self.ignored_resources = json.load(ignored_resources_file)
             ignored_resources_file.close()
         else:
-            self.ignored_resources = dict()
+            self.ignored_resources = list()
 
-        # Gather resources
-        self.remote_resources = []
-        for dirpath, dirnames, filenames in os.walk(self.remote_resource_dir_path):
-            for filename in filenames:
-                self.remote_resources.append(os.path.join(dirpath, filename))
+        self.terminal_text_color_codes = config_obj.get("terminal text color codes", dict())
 
-        self.terminal_text_color_codes = config_obj["terminal text color codes"]
 
+    """
+    Lazily yields the paths of files in the resources directory, walking it one directory at a time
+     - pattern: glob pattern that paths relative to the resources directory must match, or None for all files
+     - RETURN: generator of absolute resource paths, in sorted order within each directory
+    """
+    def iter_remote_resources(self, pattern=None):
+        for dirpath, dirnames, filenames in self.backend.walk(self.remote_resource_dir_path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                resource_path = os.path.join(dirpath, filename)
+                if pattern is None or fnmatch.fnmatchcase(os.path.relpath(resource_path, self.remote_resource_dir_path), pattern):
+                    yield resource_path
 
     """
-    If possible, creates the desired links
-     - links_to_create: mapping of (resource path : link path) that user wants to create
+    Checks if a path is a file in the resources directory, without walking it
+     - resource_path: absolute path to check
+     - RETURN: True if the path is a remote resource, False otherwise
     """
-    def forge_links(self, links_to_create):
-        for resource_path in links_to_create.keys():
+    def remote_resource_exists(self, resource_path):
+        return resource_path.startswith(os.path.join(self.remote_resource_dir_path, "")) and self.backend.isfile(resource_path)
+
+    """
+    Resolves the desired links to absolute paths, skipping ones with empty or nonexistent paths
+     - links_to_create: mapping of (resource path : link path), or iterable of (resource path, link path) tuples, that user wants to create
+     - RETURN: generator of (absolute resource path, absolute link path) tuples, resolved as they are read
+    """
+    def _resolve_links(self, links_to_create):
+        if hasattr(links_to_create, "items"):
+            links_to_create = links_to_create.items()
+        for resource_path, link_path in links_to_create:
             resource_path = resource_path.strip()
 
             # Check resource path validity
             if len(resource_path.strip()) == 0:
                 print "-- Skipping empty resource path"
                 continue
-            full_resource_path = os.path.expanduser(os.path.normpath(resource_path))
-            if not os.path.exists(full_resource_path):
+            full_resource_path = os.path.abspath(os.path.expanduser(os.path.normpath(resource_path)))
+            if not self.backend.exists(full_resource_path):
                 print "!! No resource at path " + resource_path + " exists"
                 continue
 
             # Check link path validity
-            link_path = links_to_create[full_resource_path].strip()
-            full_link_path = os.path.expanduser(os.path.normpath(link_path))
+            link_path = link_path.strip()
             if len(link_path.strip()) == 0:
                 print "-- Skipping empty link path"
                 continue
+            full_link_path = os.path.abspath(os.path.expanduser(os.path.normpath(link_path)))
+            yield (full_resource_path, full_link_path)
+
+    """
+    If possible, creates the desired links
+    NOTE: Links are read and created in batches of FORGE_BATCH_SIZE, so a streamed iterable is never held in memory whole
+     - links_to_create: mapping of (resource path : link path), or iterable of (resource path, link path) tuples, that user wants to create
+     - backup_suffix: suffix to append to file objects in the way, or None for BACKUP_SUFFIX
+    """
+    def forge_links(self, links_to_create, backup_suffix=None):
+        resolved_links = self._resolve_links(links_to_create)
+        backup_suffix = backup_suffix or self.BACKUP_SUFFIX
+        links = list(itertools.islice(resolved_links, self.FORGE_BATCH_SIZE))
+        while len(links) > 0:
+            # Create the batch's links a directory at a time, backing up any files in the way
+            for (full_resource_path, full_link_path), (_, outcome, error) in zip(links, unbox_links.materialize_links(links, backup_suffix=backup_suffix, backend=self.backend)):
+                if outcome == unbox_links.LINK_FAILED:
+                    print "!! Unable to link " + full_link_path + " to " + full_resource_path + ": " + error
+                    continue
+                if outcome == unbox_links.LINK_BACKED_UP:
+                    print "-- " + full_link_path + " already exists; appended " + backup_suffix
+                print "++ Link from " + full_link_path + " to " + full_resource_path + " created successfully!"
+                self.resource_link_dict[full_resource_path] = full_link_path
+            links = list(itertools.islice(resolved_links, self.FORGE_BATCH_SIZE))
+
+    """
+    Creates the links listed in a legacy .dropconfig file, reading it in a single pass
+    NOTE: As with dropconfig.sh, file objects in the way get the '.conf_bak' suffix, and links whose path is a directory are skipped
+     - in_fp: text file object or iterable of lines of the .dropconfig file
+     - RETURN: tuple of (number of links the file asks for, number of lines that couldn't be read)
+    """
+    def import_dropconfig(self, in_fp):
+        links, bad_lines = parse_dropconfig(in_fp)
+        for line_number, line in bad_lines:
+            print "!! Error with input line " + str(line_number) + ": " + line
+        self.forge_links(self._forgeable_dropconfig_links(links, True), self.DROPCONFIG_BACKUP_SUFFIX)
+        return (len(links), len(bad_lines))
+
+    """
+    Predicts the cost of import_dropconfig without changing anything
+     - in_fp: text file object or iterable of lines of the .dropconfig file
+     - RETURN: unbox_estimate.CostEstimate for the links the file asks for
+    """
+    def estimate_import_dropconfig(self, in_fp):
+        links, _ = parse_dropconfig(in_fp)
+        return self.estimate_forge_links(self._forgeable_dropconfig_links(links, False))
 
-            # If a link exists at the link path, remove it
-            if os.path.islink(full_link_path):
-                os.remove(full_link_path)
+    """
+    Filters out the links from a .dropconfig file whose path is already a directory, which dropconfig.sh skips
+     - links: list of (target path, link path) tuples, as from parse_dropconfig
+     - report: whether to print the links skipped
+     - RETURN: list of (target path, link path) tuples to forge
+    """
+    def _forgeable_dropconfig_links(self, links, report):
+        to_forge = []
+        for target_path, link_path in links:
+            if self.backend.isdir(link_path) and not self.backend.islink(link_path):
+                if report:
+                    print "!! Skipping link " + link_path + " because it's already a directory"
+                continue
+            to_forge.append((target_path, link_path))
+        return to_forge
 
-            # If a file exists at the link path, back it up
-            if os.path.exists(full_link_path):
-                print "-- " + full_link_path + " already exists; appending " + self.BACKUP_SUFFIX
-                os.rename(full_link_path, full_link_path + self.BACKUP_SUFFIX)
-            os.symlink(full_resource_path, full_link_path)
-            print "++ Link from " + link_path + " to " + full_resource_path + " created successfully!"
-            self.resource_link_dict[full_resource_path] = link_path
+    """
+    Predicts the cost of forge_links without changing anything
+     - links_to_create: mapping of (resource path : link path), or iterable of (resource path, link path) tuples, that user wants to create
+     - RETURN: unbox_estimate.CostEstimate for the links
+    """
+    def estimate_forge_links(self, links_to_create):
+        stat_cache = unbox_filesystem.StatCache(self.backend)
+        estimate = unbox_estimate.CostEstimate()
+        for full_resource_path, full_link_path in self._resolve_links(links_to_create):
+            link_stat = stat_cache.lstat(full_link_path)
+            if link_stat is not None and stat_cache.link_target(full_link_path) == full_resource_path:
+                continue
+            if link_stat is not None and stat_cache.readlink(full_link_path) is None:
+                estimate.backups_to_take += 1
+            estimate.links_to_change += 1
+            estimate.files_to_create += 1
+            if full_resource_path not in self.resource_link_dict:
+                estimate.index_growth += len(json.dumps({ full_resource_path : full_link_path })) - len(json.dumps(dict()))
+        return estimate
 
 
     """
@@ -122,10 +237,10 @@ class Core:
     """
     def clean_lists(self):
         # Remove dead resources and restore from backup if possible
-        dead_link_resources = [resource for resource in self.resource_link_dict.keys() if resource not in self.remote_resources]
+        dead_link_resources = [resource for resource in self.resource_link_dict.keys() if not self.remote_resource_exists(resource)]
         self.remove_links(dead_link_resources)
 
-        dead_ignored_resources = [resource for resource in self.ignored_resources if resource not in self.remote_resources]
+        dead_ignored_resources = [resource for resource in self.ignored_resources if not self.remote_resource_exists(resource)]
         self.ignored_resources = list(set(self.ignored_resources) - set(dead_ignored_resources))
         # for dead_ignored_resource in dead_ignored_resources:
         #     self.ignored_resources.remove(dead_ignored_resource)
@@ -137,20 +252,20 @@ class Core:
     def remove_links(self, resources):
         for resource_to_remove in resources:
             link_path = self.resource_link_dict[resource_to_remove]
-            if not os.path.exists(link_path):
+            if not self.backend.exists(link_path):
                 continue
             print "Removing dead link " + link_path + " pointing to nonexistent resource " + resource_to_remove
             backup_path = link_path + self.BACKUP_SUFFIX
-            if os.path.exists(backup_path):
+            if self.backend.exists(backup_path):
                 try:
-                    shutil.copyfile(backup_path, link_path)
-                    os.remove(backup_path)
+                    self.backend.copyfile(backup_path, link_path)
+                    self.backend.remove(backup_path)
                     print "-- Found and successfully restored backup"
                 except IOError:
                     print "!! Found backup at " + backup_path + " but could not restore"
             else:
                 try:
-                    os.remove(link_path)
+                    self.backend.remove(link_path)
                     print "-- No backup found; link successfully removed"
                 except IOError:
                     print "!! No backup found; could not remove link"
@@ -166,14 +281,87 @@ class Core:
 
         # Write list of resources
         resource_link_dict_filepath = os.path.join(self.unbox_dir_path, self.LINK_FILENAME)
-        resource_link_dict_file = open(resource_link_dict_filepath, 'w')
+        resource_link_dict_file = self.backend.open(resource_link_dict_filepath, 'w')
         json.dump(self.resource_link_dict, resource_link_dict_file)
         resource_link_dict_file.close()
 
         ignored_resources_filepath = os.path.join(self.unbox_dir_path, self.IGNORED_FILENAME)
-        ignored_resources_file = open (ignored_resources_filepath, 'w')
+        ignored_resources_file = self.backend.open(ignored_resources_filepath, 'w')
         json.dump(self.ignored_resources, ignored_resources_file)
         ignored_resources_file.close()
 
 
         
+
+
+
+""" ====== Legacy .dropconfig files ======== """
+
+# Separator between a link path and its target in a .dropconfig file
+_DROPCONFIG_SEPARATOR = "=>"
+
+"""
+Parses the 'LINK => TARGET' lines of a legacy .dropconfig file, skipping blank lines and '#' comments
+NOTE: Paths starting with '~' are expanded to the home directory
+ - in_fp: text file object or iterable of lines to read from
+ - RETURN: tuple of (list of (absolute target path, absolute link path) tuples in file order,
+   list of (line number, line) tuples for lines that aren't comments or 'LINK => TARGET' entries)
+"""
+def parse_dropconfig(in_fp):
+    links = []
+    bad_lines = []
+    for line_number, line in enumerate(in_fp, 1):
+        line = line.strip()
+        if len(line) == 0 or line.startswith("#"):
+            continue
+        link_path, separator, target_path = line.partition(_DROPCONFIG_SEPARATOR)
+        link_path, target_path = link_path.strip(), target_path.strip()
+        if len(separator) == 0 or len(link_path) == 0 or len(target_path) == 0:
+            bad_lines.append((line_number, line))
+            continue
+        links.append((unbox_filesystem.abs_path(target_path), unbox_filesystem.abs_path(link_path)))
+    return (links, bad_lines)
+
+
+
+""" ====== Link choice files ======== """
+
+# Separator between a resource path and its link path in a link choice file
+_CHOICE_SEPARATOR = "\t:\t"
+
+"""
+Writes a link choice file for the user to edit, with one '"resource path" : "link path"' entry per line
+NOTE: Entries are written as they are produced, so the file is valid JSON without every entry being held in memory
+ - out_fp: text file object to write to
+ - choices: iterable of (resource path, suggested link path or None) tuples
+ - RETURN: number of entries written
+"""
+def write_link_choices(out_fp, choices):
+    out_fp.write("{")
+    num_choices = 0
+    for resource_path, link_path in choices:
+        out_fp.write(("," if num_choices > 0 else "") + "\n    " + json.dumps(resource_path) + _CHOICE_SEPARATOR + json.dumps(link_path or " "))
+        num_choices += 1
+    out_fp.write("\n}\n")
+    return num_choices
+
+"""
+Reads an edited link choice file one line at a time
+ - in_fp: text file object to read from
+ - RETURN: generator of (resource path, link path) tuples; the link path is empty if the user left it blank
+"""
+def read_link_choices(in_fp):
+    decoder = json.JSONDecoder()
+    for line_number, line in enumerate(in_fp, 1):
+        line = line.strip().rstrip(",").strip()
+        if line in ("", "{", "}"):
+            continue
+        try:
+            resource_path, end_idx = decoder.raw_decode(line)
+            separator_and_link = line[end_idx:].strip()
+            if not separator_and_link.startswith(":"):
+                raise ValueError("no ':' after resource path")
+            link_path, _ = decoder.raw_decode(separator_and_link[1:].strip())
+        except ValueError as e:
+            raise ValueError("Cannot read link choices; line " + str(line_number) + " is not a '\"resource\" : \"link\"' entry: " + str(e))
+        yield (resource_path, (link_path or "").strip())
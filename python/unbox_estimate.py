@@ -0,0 +1,60 @@
+import os
+import stat
+
+class CostEstimate(object):
+    """Predicted cost of a planned operation, worked out without changing anything"""
+
+    __slots__ = ("bytes_to_copy", "files_to_create", "links_to_change", "backups_to_take", "index_growth")
+
+    def __init__(self):
+        """Instantiates an estimate of nothing"""
+        self.bytes_to_copy = 0          # Bytes of data to copy
+        self.files_to_create = 0        # Files, directories and symlinks to create
+        self.links_to_change = 0        # Links to create or replace
+        self.backups_to_take = 0        # File objects in the way of links, to move into the backup system
+        self.index_growth = 0           # Bytes the index files will grow by
+
+    def add(self, other):
+        """Adds another estimate to this one
+
+        Keyword Args:
+        other -- CostEstimate to add
+        """
+        for field in self.__slots__:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def items(self):
+        """Gets the estimate's fields
+
+        Return:
+        List of (description, value) tuples
+        """
+        return [
+            ("bytes to copy", self.bytes_to_copy),
+            ("files to create", self.files_to_create),
+            ("links to change", self.links_to_change),
+            ("backups to take", self.backups_to_take),
+            ("index growth in bytes", self.index_growth)
+        ]
+
+"""
+Gets the size and number of entries of a file object, walking directories through a stat cache
+NOTE: Symlinks are counted as entries but not followed, matching how resources are copied
+- stat_cache: unbox_filesystem.StatCache to read file information through
+- path: path of file object
+- RETURN: tuple of (total bytes of regular files, number of file objects including the path itself)
+"""
+def tree_cost(stat_cache, path):
+    path_stat = stat_cache.lstat(path)
+    if path_stat is None:
+        return (0, 0)
+    if stat.S_ISLNK(path_stat.st_mode):
+        return (0, 1)
+    if not stat.S_ISDIR(path_stat.st_mode):
+        return (path_stat.st_size, 1)
+    total_bytes, total_files = 0, 1
+    for name in stat_cache.listdir(path):
+        entry_bytes, entry_files = tree_cost(stat_cache, os.path.join(path, name))
+        total_bytes += entry_bytes
+        total_files += entry_files
+    return (total_bytes, total_files)
@@ -0,0 +1,156 @@
+import hashlib
+import json
+
+import unbox_search
+
+class FederatedDropbox(object):
+    """Merged view over several Dropbox Unbox roots, exposing the DropboxModule interface
+    NOTE: Where roots share a resource name, the highest-priority root's resource is used and the others are shadowed.
+    New resources are added to the highest-priority root; changes to a resource go to the root holding it
+    """
+
+    # DropboxModule methods taking a resource name first, routed to the root holding that resource
+    _ROUTED_BY_RESOURCE = frozenset([
+        "version_exists", "resource_info", "resource_path", "resource_origin", "version_info", "sorted_versions",
+        "delete_resource", "copy_version", "add_version_dependency", "delete_version_dependency", "change_current_version",
+        "delete_version", "diff_versions", "estimate_copy_version", "version_checksums", "is_template", "set_template"
+    ])
+
+    # DropboxModule methods creating resources, routed to the highest-priority root
+    _ROUTED_TO_PRIMARY = frozenset([
+        "add_resource", "add_resources", "stage_resource", "commit_staged_resources", "abort_staged_resources",
+        "estimate_add_resources", "unbox_dirpath"
+    ])
+
+    def __init__(self, roots):
+        """Instantiates a merged view
+
+        Keyword Args:
+        roots -- list of DropboxModules in priority order, highest first
+        """
+        if len(roots) == 0:
+            raise ValueError("Cannot federate Unbox roots; no roots given")
+        self._roots = list(roots)
+
+        # Index generations of the roots the combined index was built from, or None if it hasn't been built
+        self._namespace_generations = None
+
+        # Combined index, rebuilt when any root's index changes
+        # Maps resource name -> DropboxModule holding the resource used for that name
+        self._owners = dict()
+        # Sorted name and version indexes over the merged namespace
+        self._search_index = unbox_search.ResourceSearchIndex()
+        # List of (resource name, shadowed DropboxModule) tuples
+        self._shadowed = []
+
+    def _namespace(self):
+        """Gets the combined index, rebuilding it if any root's index changed since it was built
+
+        Return:
+        Tuple of (dict of resource name -> owning DropboxModule, ResourceSearchIndex over the merged namespace)
+        """
+        generations = tuple([root.index_generation() for root in self._roots])
+        if generations != self._namespace_generations:
+            owners = dict()
+            owned_resources = []
+            shadowed = []
+            for root in self._roots:
+                for resource_name, (_, _, versions) in root.iter_resources():
+                    if resource_name in owners:
+                        shadowed.append((resource_name, root))
+                        continue
+                    owners[resource_name] = root
+                    owned_resources.append((resource_name, versions))
+            search_index = unbox_search.ResourceSearchIndex(owned_resources)
+            self._owners, self._search_index, self._shadowed = owners, search_index, shadowed
+            self._namespace_generations = generations
+        return (self._owners, self._search_index)
+
+    def _owner(self, resource_name):
+        """Gets the root holding a resource, or the highest-priority root if none does, so it reports the missing resource"""
+        return self._namespace()[0].get(resource_name, self._roots[0])
+
+    def __getattr__(self, name):
+        """Routes the rest of the DropboxModule interface to the root it applies to"""
+        if name in self._ROUTED_BY_RESOURCE:
+            return lambda resource_name, *args, **kwargs: getattr(self._owner(resource_name), name)(resource_name, *args, **kwargs)
+        if name in self._ROUTED_TO_PRIMARY:
+            return getattr(self._roots[0], name)
+        raise AttributeError(name)
+
+    def roots(self):
+        """Gets the paths of the Unbox directories of the roots in priority order"""
+        return [root.unbox_dirpath() for root in self._roots]
+
+    def shadowed_resources(self):
+        """Gets resources hidden by a resource of the same name in a higher-priority root
+
+        Return:
+        Sorted list of (resource name, path of the shadowed root's Unbox directory, path of the Unbox directory used instead) tuples
+        """
+        owners, _ = self._namespace()
+        return sorted([(resource_name, root.unbox_dirpath(), owners[resource_name].unbox_dirpath()) for resource_name, root in self._shadowed])
+
+    def index_generation(self):
+        """Gets a generation for the merged namespace, which changes whenever any root's index changes
+        NOTE: This is a digest of each root's path and generation rather than a count, so it stays stable across processes
+        for use as a cache key, and changes to different roots can't cancel out
+        """
+        generations = [(root.unbox_dirpath(), root.index_generation()) for root in self._roots]
+        return hashlib.sha256(json.dumps(generations).encode("utf-8")).hexdigest()
+
+    def resource_exists(self, resource):
+        """Checks if a resource is in any root"""
+        return resource in self._namespace()[0]
+
+    def resources_set(self):
+        """Gets the names of resources in the merged namespace"""
+        return self._namespace()[0].keys()
+
+    def find_resources(self, pattern=None):
+        """Finds resources in the merged namespace whose names match a glob pattern, returning a sorted list"""
+        _, search_index = self._namespace()
+        if pattern is None:
+            return search_index.names_in_range()
+        return search_index.names_matching(pattern)
+
+    def iter_resources(self, pattern=None):
+        """Lazily yields (resource name, resource info) tuples in name order from the root each name resolves to"""
+        owners, search_index = self._namespace()
+        for resource_name in search_index.iter_names(pattern):
+            yield (resource_name, owners[resource_name].resource_info(resource_name))
+
+    def resources_in_range(self, start=None, end=None):
+        """Gets resources in the merged namespace whose names fall in the half-open range [start, end)"""
+        return self._namespace()[1].names_in_range(start, end)
+
+    def find_versions(self, spec):
+        """Finds versions of resources in the merged namespace matching a version query, in semantic-version order"""
+        return self._namespace()[1].versions_matching(spec)
+
+    def resource_paths(self, resources):
+        """Gets the full paths to many resource versions, each from the root holding it"""
+        return [self._owner(resource).resource_path(resource, version) for resource, version in resources]
+
+    def change_current_versions(self, changes):
+        """Changes the current versions of many resources, atomically within each root
+        NOTE: Roots are switched one after another, so a failure in a later root leaves earlier roots switched
+        """
+        for root, root_changes in self._group_by_root(changes, lambda change: change[0]):
+            root.change_current_versions(root_changes)
+
+    def record_version_checksums(self, updates):
+        """Records scrub checksums for many versions with one index commit per root"""
+        for root, root_updates in self._group_by_root(updates, lambda update: update[0]):
+            root.record_version_checksums(root_updates)
+
+    def _group_by_root(self, items, resource_name_of):
+        """Splits items by the root holding each one's resource, keeping roots in priority order
+
+        Return:
+        List of (DropboxModule, list of items) tuples
+        """
+        items_by_root = dict()
+        for item in items:
+            items_by_root.setdefault(id(self._owner(resource_name_of(item))), []).append(item)
+        return [(root, items_by_root[id(root)]) for root in self._roots if id(root) in items_by_root]
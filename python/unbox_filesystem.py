@@ -1,9 +1,21 @@
 import os
+import stat
 import shutil
 import json
+import time
 import uuid
 import dropbox_module
 import local_module
+import unbox_autoversion
+import unbox_backend
+import unbox_federation
+import unbox_links
+import unbox_metrics
+import unbox_profiles
+import unbox_rules
+import unbox_scrub
+import unbox_snapshot
+import unbox_templates
 
 """
 Gets the user-expanded, normalized, absolute path to a file object
@@ -16,35 +28,694 @@ def abs_path(path):
         raise ValueError("Cannot find absolute path; string is empty")
     return os.path.abspath(os.path.expanduser(os.path.normpath(path)))
 
+"""
+Gets the total size of the regular files in a file object, without following symlinks
+- path: path to file or directory tree
+- backend: unbox_backend filesystem backend to read through, or None for the real filesystem
+- RETURN: size in bytes
+"""
+def file_object_size(path, backend=None):
+    backend = backend or unbox_backend.OS_BACKEND
+    if backend.islink(path):
+        return 0
+    if not backend.isdir(path):
+        return backend.getsize(path)
+    total_size = 0
+    for dirpath, dirnames, filenames in backend.walk(path):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            if not backend.islink(filepath):
+                total_size += backend.lstat(filepath).st_size
+    return total_size
+
+"""
+Memoizes lstat, readlink and listdir results so that a pass over the filesystem touches each path at most once
+"""
+class StatCache:
+    """
+    Instantiates an empty cache
+    - backend: unbox_backend filesystem backend to read through, or None for the real filesystem
+    """
+    def __init__(self, backend=None):
+        self._backend = backend or unbox_backend.OS_BACKEND
+
+        # Maps paths -> lstat result, or None if nothing exists at the path
+        self._lstat_results = dict()
+
+        # Maps symlink paths -> symlink target
+        self._readlink_results = dict()
+
+        # Maps directory paths -> sorted list of entry names
+        self._listdir_results = dict()
+
+    """
+    Gets the lstat result for a path
+    - path: path to stat
+    - RETURN: stat result, or None if nothing exists at the path
+    """
+    def lstat(self, path):
+        if path not in self._lstat_results:
+            try:
+                self._lstat_results[path] = self._backend.lstat(path)
+            except OSError:
+                self._lstat_results[path] = None
+        return self._lstat_results[path]
+
+    """
+    Gets the stat result for a path, following symlinks
+    - path: path to stat
+    - RETURN: stat result, or None if nothing exists at the path or a symlink along it is broken
+    """
+    def stat(self, path):
+        link_stat = self.lstat(path)
+        if link_stat is None or not stat.S_ISLNK(link_stat.st_mode):
+            return link_stat
+        target = self.readlink(path)
+        return self.stat(os.path.join(os.path.dirname(path), target))
+
+    """
+    Gets the target of a symlink
+    - path: path of symlink
+    - RETURN: symlink target, or None if the path is not a symlink
+    """
+    def readlink(self, path):
+        link_stat = self.lstat(path)
+        if link_stat is None or not stat.S_ISLNK(link_stat.st_mode):
+            return None
+        if path not in self._readlink_results:
+            self._readlink_results[path] = self._backend.readlink(path)
+        return self._readlink_results[path]
+
+    """
+    Gets the absolute target of a symlink, resolving targets relative to the symlink's directory
+    - path: path of symlink
+    - RETURN: normalized absolute symlink target, or None if the path is not a symlink
+    """
+    def link_target(self, path):
+        target = self.readlink(path)
+        if target is None:
+            return None
+        return os.path.normpath(os.path.join(os.path.dirname(path), target))
+
+    """
+    Gets the names of the entries in a directory
+    - path: path of directory
+    - RETURN: sorted list of entry names
+    """
+    def listdir(self, path):
+        if path not in self._listdir_results:
+            self._listdir_results[path] = sorted(self._backend.listdir(path))
+        return self._listdir_results[path]
+
 """
 Class to manage all resources in the Unbox filesystem
 """
 class Filesystem:
-    # Module to manage the Dropbox Unbox directory
-    _dropbox_module = None
+    # Ways of handling links that depend on a resource version being removed or changed
+    DEPENDENTS_WARN = "warn"            # Refuse the operation if any links depend on the version
+    DEPENDENTS_UNLINK = "unlink"        # Delete the dependent links
+    DEPENDENTS_RETARGET = "retarget"    # Point the dependent links at the resource's current version
+
+    # Kinds of stored items a scrub verifies
+    SCRUB_TARGET_BACKUP = "backup"      # Backed-up file object, identified by its original local path
+    SCRUB_TARGET_VERSION = "version"    # Resource version in Dropbox, identified by resource name and version
+
+    # Kinds of drift between the desired state and the filesystem reported by status()
+    DRIFT_MISSING = "missing"                   # Tracked link, its target, or its resource no longer exists
+    DRIFT_FOREIGN = "foreign"                   # Something other than the tracked link sits at the link path
+    DRIFT_STALE_VERSION = "stale version"       # Link follows new versions but points at an old one
+    DRIFT_UNTRACKED = "untracked"               # Resource in Dropbox that is neither linked nor ignored
+    DRIFT_MISSING_BACKUP = "missing backup"     # Backed-up file object is gone from the backup directory
+    DRIFT_STALE_IGNORE = "stale ignore"         # Ignored resource no longer exists in Dropbox
+    DRIFT_MODIFIED = "modified"                 # Hardlinked, cloned or copied resource was changed at the link path
+    DRIFT_STALE_COPY = "stale copy"             # Resource changed since it was hardlinked, cloned or copied to the link path
+
+    # Name of directory in the local Unbox directory caching each Dropbox root's merged operation logs
+    _OPLOG_VIEWS_DIRNAME = "oplog_views"
 
-    # Module to manage the local Unbox directory
-    _local_module = None
+    # Module to manage the Dropbox Unbox directory, or None until it is first used
+    _loaded_dropbox_module = None
+
+    # Module to manage the local Unbox directory, or None until it is first used
+    _loaded_local_module = None
+
+    # Cache of template resources rendered with this machine's variables, or None until it is first used
+    _loaded_render_cache = None
 
 
 
 
     """
     Instantiates a Filesystem object to handle Unbox's file operations
+    NOTE: The Dropbox and local modules, and the indexes they read, are only loaded when first used
+    - relative_links: whether to create symlinks with targets relative to the link's directory
+    - extra_roots: list of (Dropbox directory path, Unbox directory name) tuples of further roots to mount below the main one,
+    in priority order; resources in the main root shadow same-named resources in these, and new resources go to the main root
+    - template_variables: dict of hostname or '*' -> dict of variables to render template resources with on that host,
+    as in the 'template variables' setting
+    - machine_id: name unique to this machine to log Dropbox index changes under, instead of rewriting the shared index file
+    - backend: unbox_backend filesystem backend the Dropbox and local modules work through, or None for the real filesystem
     - RETURNS: 
     """
-    def __init__(self, local_unbox_dirpath, dropbox_dirpath, dropbox_unbox_dirname):
-        self._dropbox_module = dropbox_module.DropboxModule(dropbox_dirpath, unbox_dirname)
-        self._local_module = local_module.LocalModule(local_unbox_dirpath)
+    def __init__(self, local_unbox_dirpath, dropbox_dirpath, dropbox_unbox_dirname, relative_links=False, extra_roots=None, template_variables=None,
+            machine_id=None, backend=None):
+        self._backend = backend or unbox_backend.OS_BACKEND
+        views_dirpath = os.path.join(abs_path(local_unbox_dirpath), self._OPLOG_VIEWS_DIRNAME)
+        self._dropbox_module_args = [(dropbox_dirpath, dropbox_unbox_dirname, machine_id, views_dirpath)] + [tuple(root) + (machine_id, views_dirpath)
+                for root in extra_roots or []]
+        self._local_module_args = (local_unbox_dirpath, relative_links)
+        self._template_variables = unbox_templates.host_variables(template_variables or dict())
+
+    """
+    Gets the module managing the Dropbox Unbox directory, reading the Dropbox index on first use
+    NOTE: With extra roots mounted, this is a FederatedDropbox merging every root's resources behind the DropboxModule interface
+    - RETURN: DropboxModule or unbox_federation.FederatedDropbox
+    """
+    @property
+    def _dropbox_module(self):
+        if self._loaded_dropbox_module is None:
+            roots = [dropbox_module.DropboxModule(*root_args, backend=self._backend) for root_args in self._dropbox_module_args]
+            self._loaded_dropbox_module = roots[0] if len(roots) == 1 else unbox_federation.FederatedDropbox(roots)
+        return self._loaded_dropbox_module
+
+    """
+    Gets the module managing the local Unbox directory, reading the local indexes on first use
+    - RETURN: LocalModule
+    """
+    @property
+    def _local_module(self):
+        if self._loaded_local_module is None:
+            self._loaded_local_module = local_module.LocalModule(*self._local_module_args, backend=self._backend)
+        return self._loaded_local_module
+
+    """
+    Gets the cache of template resources rendered with this machine's variables
+    - RETURN: unbox_templates.RenderCache
+    """
+    @property
+    def _render_cache(self):
+        if self._loaded_render_cache is None:
+            self._loaded_render_cache = unbox_templates.RenderCache(self._local_module.render_cache_dirpath())
+        return self._loaded_render_cache
+
+    """
+    Gets the path links to a resource version should point at: the resource in Dropbox, or its render for template resources
+    - resource_name: name of resource
+    - version: version of resource, or None for the current version
+    - RETURN: absolute path
+    """
+    def _link_target(self, resource_name, version=None):
+        if not self._dropbox_module.is_template(resource_name):
+            return self._dropbox_module.resource_path(resource_name, version)
+        if version is None:
+            _, version, _ = self._dropbox_module.resource_info(resource_name)
+        rendered_path, _ = self._render_cache.render(self._dropbox_module.resource_path(resource_name, version), self._template_variables)
+        self._render_cache.save()
+        return rendered_path
+
+    """
+    Loads indexes up front rather than on first use, e.g. so a command fails early if one is unreadable
+    - dropbox_index: whether to load the Dropbox index
+    - local_index: whether to load the local link and backup indexes
+    """
+    def load_indexes(self, dropbox_index=True, local_index=True):
+        if dropbox_index:
+            self._dropbox_module
+        if local_index:
+            self._local_module
+
+    """
+    Finds resources in Dropbox whose names match a glob pattern
+    - pattern: glob pattern to match, or None for all resources
+    - RETURN: sorted list of matching resource names
+    """
+    def find_resources(self, pattern=None):
+        return self._dropbox_module.find_resources(pattern)
+
+    """
+    Lazily yields resources in Dropbox with their index entries, only visiting names that can match the pattern
+    - pattern: glob pattern to match, or None for all resources
+    - RETURN: generator of (resource name, (resource dirname, current version, list of version names)) tuples in name order
+    """
+    def iter_resources(self, pattern=None):
+        return self._dropbox_module.iter_resources(pattern)
+
+    """
+    Gets which mounted root a resource resolves to
+    - resource_name: name of resource
+    - RETURN: path to the Dropbox Unbox directory holding the resource
+    """
+    def resource_origin(self, resource_name):
+        return self._dropbox_module.resource_origin(resource_name)
+
+    """
+    Gets resources hidden by a same-named resource in a higher-priority root
+    - RETURN: sorted list of (resource name, path of the hidden resource's Unbox directory, path of the Unbox directory used instead) tuples
+    """
+    def shadowed_resources(self):
+        if len(self._dropbox_module_args) == 1:
+            return []
+        return self._dropbox_module.shadowed_resources()
+
+    """
+    Lazily yields tracked links with their info
+    - resource_name: only yield links to this resource, or None for links to any resource
+    - dirpath: only yield links inside this directory, or None for links anywhere
+    - RETURN: generator of (link path, (link target path, resource name, resource version, ignore_new flag)) tuples
+    """
+    def iter_links(self, resource_name=None, dirpath=None):
+        return self._local_module.iter_links(resource_name, dirpath)
+
+    """
+    Finds resource versions in Dropbox matching a version query
+    - spec: version prefix, optionally ending in an 'x' or '*' component (e.g. "2.x")
+    - RETURN: list of (resource name, version name) tuples in semantic-version order
+    """
+    def find_versions(self, spec):
+        return self._dropbox_module.find_versions(spec)
+
+    """
+    Links a resource in Dropbox to a local path and tracks the link
+    - resource_name: name of resource in Dropbox
+    - link_path: local path to place the link at
+    - version: version to pin the link to, or None to follow the resource's current version
+    - ignore_new: whether the link shouldn't care about new resource versions
+    - strategy: how to materialize the resource at the link path; one of the unbox_links.STRATEGY_* constants
+    """
+    def add_link(self, resource_name, link_path, version=None, ignore_new=False, strategy=unbox_links.STRATEGY_SYMLINK):
+        resource_path = self._link_target(resource_name, version)
+        if version is None:
+            _, version, _ = self._dropbox_module.resource_info(resource_name)
+        self._local_module.add_link(link_path, resource_path, resource_name, version, ignore_new, strategy)
 
+    """
+    Applies a dependents policy to links that would be left pointing at a removed resource or version
+    - dependents: set of paths of affected links
+    - dependents_policy: one of the DEPENDENTS_* constants
+    - resource_name: name of the affected resource
+    - RETURN: set of paths of links that were unlinked or retargeted
+    """
+    def _handle_dependents(self, dependents, dependents_policy, resource_name):
+        if len(dependents) == 0:
+            return dependents
+        if dependents_policy == self.DEPENDENTS_WARN:
+            raise ValueError("Links still depend on resource '" + resource_name + "': " + ", ".join(sorted(dependents)))
+        elif dependents_policy == self.DEPENDENTS_UNLINK:
+            self._local_module.delete_links(dependents)
+        elif dependents_policy == self.DEPENDENTS_RETARGET:
+            _, current_version, _ = self._dropbox_module.resource_info(resource_name)
+            self._local_module.retarget_links(dependents, self._link_target(resource_name, current_version), current_version)
+        else:
+            raise ValueError("Unknown policy for dependent links: " + str(dependents_policy))
+        return dependents
 
+    """
+    Changes the current version of a resource, moving along every link that follows the current version
+    - resource_name: name of resource
+    - version: version to make current
+    - RETURN: set of paths of links that were moved to the new version
+    """
+    def change_current_version(self, resource_name, version):
+        _, old_version, _ = self._dropbox_module.resource_info(resource_name)
+        self._dropbox_module.change_current_version(resource_name, version)
+        following = set([link_path for link_path in self._local_module.dependent_links(resource_name, old_version)
+                if not self._local_module.link_info(link_path)[3]])
+        if len(following) > 0:
+            self._local_module.retarget_links(following, self._link_target(resource_name), version)
+        return following
 
+    """
+    Changes the current versions of many resources together, pointing the links that follow new versions at them
+    NOTE: The resources are switched all at once or not at all, with a single Dropbox index commit
+    - changes: iterable of (resource name, version) tuples
+    - RETURN: set of paths of links that were retargeted
+    """
+    def change_current_versions(self, changes):
+        changes = list(changes)
+        old_versions = dict([(resource_name, self._dropbox_module.resource_info(resource_name)[1])
+                for resource_name, _ in changes if self._dropbox_module.resource_exists(resource_name)])
+        self._dropbox_module.change_current_versions(changes)
+        retargeted = set()
+        retargets = []
+        for resource_name, version in changes:
+            following = set([link_path for link_path in self._local_module.dependent_links(resource_name, old_versions[resource_name])
+                    if not self._local_module.link_info(link_path)[3]])
+            if len(following) > 0:
+                retargets.append((following, self._link_target(resource_name), version))
+                retargeted.update(following)
+        if len(retargets) > 0:
+            self._local_module.retarget_link_groups(retargets)
+        return retargeted
 
+    """
+    Deletes a version of a resource, handling the links that point to it
+    - resource_name: name of resource
+    - version: version to delete
+    - dependents_policy: what to do with links to the version (default: refuse if any exist)
+    - RETURN: set of paths of links that were unlinked or retargeted
+    """
+    def delete_version(self, resource_name, version, dependents_policy=DEPENDENTS_WARN):
+        if not self._dropbox_module.version_exists(resource_name, version):
+            raise ValueError("Cannot delete resource version; cannot find version")
+        _, current_version, _ = self._dropbox_module.resource_info(resource_name)
+        if version == current_version:
+            raise ValueError("Cannot delete resource version; version is current version -- change current version first")
+        dependents = self._local_module.dependent_links(resource_name, version)
+        handled = self._handle_dependents(dependents, dependents_policy, resource_name)
+        self._dropbox_module.delete_version(resource_name, version)
+        return handled
+
+    """
+    Deletes a resource and all its versions, handling the links that point to it
+    - resource_name: name of resource
+    - dependents_policy: what to do with links to the resource; retargeting is not possible (default: refuse if any exist)
+    - RETURN: set of paths of links that were unlinked
+    """
+    def delete_resource(self, resource_name, dependents_policy=DEPENDENTS_WARN):
+        if dependents_policy == self.DEPENDENTS_RETARGET:
+            raise ValueError("Cannot retarget links to a deleted resource")
+        if not self._dropbox_module.resource_exists(resource_name):
+            raise ValueError("Cannot delete resource; cannot find resource")
+        dependents = self._local_module.dependent_links(resource_name)
+        handled = self._handle_dependents(dependents, dependents_policy, resource_name)
+        self._dropbox_module.delete_resource(resource_name)
+        return handled
 
+    """
+    Streams a tar archive of the current versions of resources, their index entries and their link plan
+    - out_fp: binary file object to write the archive to
+    - resource_names: names of resources to export, or None for every resource
+    - RETURN: sorted list of names of exported resources
+    """
+    def export_snapshot(self, out_fp, resource_names=None):
+        return unbox_snapshot.export_snapshot(self._dropbox_module, self._local_module, out_fp, resource_names)
 
+    """
+    Extracts a snapshot archive into Dropbox and forges its planned links in one sequential read
+    - in_fp: binary file object to read the archive from
+    - create_links: whether to forge the links in the snapshot's link plan
+    - RETURN: tuple of (sorted list of imported resource names, sorted list of created link paths)
+    """
+    def import_snapshot(self, in_fp, create_links=True):
+        return unbox_snapshot.import_snapshot(self._dropbox_module, self._local_module, in_fp, create_links, self._link_target)
 
+    """
+    Compares two versions of a resource
+    - resource_name: name of resource
+    - old_version: version to compare from; 'current' for the current version
+    - new_version: version to compare to; 'current' for the current version
+    - RETURN: list of (change kind, path relative to the version directory) tuples in tree order
+    """
+    def diff_versions(self, resource_name, old_version, new_version):
+        return self._dropbox_module.diff_versions(resource_name, old_version, new_version)
+
+    """
+    Predicts the cost of adding resources to Dropbox without copying anything
+    - resources: iterable of (local path, version, dependencies) tuples; version and dependencies may be None
+    - RETURN: unbox_estimate.CostEstimate for the resources that would pass validation
+    """
+    def estimate_add_resources(self, resources):
+        return self._dropbox_module.estimate_add_resources(resources, StatCache(self._backend))
+
+    """
+    Predicts the cost of copying a resource version without copying anything
+    - resource_name: name of resource
+    - source_version: version to copy
+    - new_version: name of the new version
+    - RETURN: unbox_estimate.CostEstimate for the copy
+    """
+    def estimate_copy_version(self, resource_name, source_version, new_version):
+        return self._dropbox_module.estimate_copy_version(resource_name, source_version, new_version, StatCache(self._backend))
+
+    """
+    Predicts the cost of linking resources to local paths without changing any links or resources
+    NOTE: Templates are estimated against their renders, which are rendered into the cache if they aren't there yet
+    - links: iterable of (resource name, link path, strategy) tuples, each linking the resource's current version
+    - RETURN: unbox_estimate.CostEstimate for the links
+    """
+    def estimate_add_links(self, links):
+        local_links = []
+        for resource_name, link_path, strategy in links:
+            _, current_version, _ = self._dropbox_module.resource_info(resource_name)
+            local_links.append((link_path, self._link_target(resource_name), resource_name, current_version, False, strategy))
+        return self._local_module.estimate_add_links(local_links, StatCache(self._backend))
+
+    """
+    Adds the metrics recorded by this process to this machine's totals
+    NOTE: Call once per process, after its operations; the recorded metrics are zeroed so they aren't added twice
+    - RETURN: MetricsRegistry holding the new totals
+    """
+    def record_metrics(self):
+        return unbox_metrics.accumulate_totals(self._local_module.metrics_filepath())
+
+    """
+    Gets this machine's metric totals without adding this process's metrics
+    - RETURN: MetricsRegistry holding the totals
+    """
+    def metrics_totals(self):
+        return unbox_metrics.load_totals(self._local_module.metrics_filepath())
+
+    """
+    Suggests link paths for resources from a rule file of '<glob or re:regex> => <link destination template>' lines
+    - rules_filepath: path to the rule file
+    - resource_names: iterable of names of resources to map, or None for all resources
+    - RETURN: sorted list of (resource name, absolute link path) tuples for the resources a rule matches
+    """
+    def suggest_links(self, rules_filepath, resource_names=None):
+        if resource_names is None:
+            resource_names = self._dropbox_module.find_resources()
+        mappings = unbox_rules.map_resources(abs_path(rules_filepath), resource_names, self._local_module.rules_cache_filepath())
+        return sorted([(resource_name, abs_path(link_path)) for resource_name, link_path in mappings.items() if link_path is not None])
+
+    """
+    Gets the links a profile wants on this machine, reusing the cached plan unless the Dropbox index or the profile changed
+    - profiles: mapping of profile names -> profile settings, as in the 'profiles' section of config.json
+    - profile_name: name of profile, or None for the profile listing this machine's hostname
+    - RETURN: tuple of (name of profile used, list of (resource name, link path, strategy) tuples)
+    """
+    def link_plan(self, profiles, profile_name=None):
+        profile_name = unbox_profiles.select_profile(profiles, profile_name)
+        resolved = unbox_profiles.resolve_profile(profiles, profile_name)
+        fingerprint = unbox_profiles.profile_fingerprint(resolved)
+        generation = self._dropbox_module.index_generation()
+        plan_filepath = self._local_module.plan_filepath(profile_name)
+        plan = unbox_profiles.load_link_plan(plan_filepath, generation, fingerprint)
+        if plan is None:
+            plan = unbox_profiles.compile_link_plan(self._dropbox_module, resolved)
+            unbox_profiles.save_link_plan(plan_filepath, generation, fingerprint, plan)
+        return (profile_name, plan)
+
+    """
+    Creates the links a profile wants that aren't already tracked, following each resource's current version
+    NOTE: Links tracked for other resources are left alone and reported as failed
+    - profiles: mapping of profile names -> profile settings, as in the 'profiles' section of config.json
+    - profile_name: name of profile, or None for the profile listing this machine's hostname
+    - RETURN: tuple of (name of profile used, list of (link path, outcome, error message) tuples for the links it tried to add)
+    """
+    @unbox_metrics.timed("apply_profile")
+    def apply_profile(self, profiles, profile_name=None):
+        profile_name, plan = self.link_plan(profiles, profile_name)
+        to_add = []
+        for resource_name, link_path, strategy in plan:
+            if self._local_module.link_exists(link_path) and self._local_module.link_info(link_path)[1] == resource_name:
+                continue
+            to_add.append((resource_name, link_path, strategy))
+        resource_paths = self._dropbox_module.resource_paths([(resource_name, None) for resource_name, _, _ in to_add])
+        local_links = []
+        for (resource_name, link_path, strategy), resource_path in zip(to_add, resource_paths):
+            _, current_version, _ = self._dropbox_module.resource_info(resource_name)
+            if self._dropbox_module.is_template(resource_name):
+                resource_path = self._link_target(resource_name, current_version)
+            local_links.append((link_path, resource_path, resource_name, current_version, False, strategy))
+        return (profile_name, self._local_module.add_links(local_links))
+
+    """
+    Keeps edits made through links to resources' current versions as versions of their own
+    NOTE: Edited contents are detected with cached fingerprints, so only files whose size or mtime changed are read. Once the
+    contents have settled for quiet_seconds, the edited version is kept as it is and a copy of it becomes the new current version
+    - patterns: glob patterns of resources to watch
+    - quiet_seconds: how long edited contents must stay unchanged before being snapshotted
+    - resource_names: only check these resources, e.g. the ones a file watcher saw change, or None to check every watched resource
+    - RETURN: list of (resource name, AUTOVERSION_* outcome, version snapshotted or None) tuples for the resources checked, sorted
+    """
+    @unbox_metrics.timed("autoversion")
+    def autoversion(self, patterns, quiet_seconds=60, resource_names=None):
+        state_filepath = self._local_module.autoversion_state_filepath()
+        state = unbox_autoversion.load_state(state_filepath)
+        watched = set()
+        for pattern in patterns:
+            watched.update(self._dropbox_module.find_resources(pattern))
+        if resource_names is None:
+            state = dict([(resource_name, entry) for resource_name, entry in state.items() if resource_name in watched])
+        else:
+            watched.intersection_update(resource_names)
+
+        now = time.time()
+        report = []
+        for resource_name in sorted(watched):
+            _, current_version, versions = self._dropbox_module.resource_info(resource_name)
+            entry = state.get(resource_name)
+            current_fingerprint = unbox_autoversion.fingerprint(self._dropbox_module.resource_path(resource_name, current_version),
+                    unbox_autoversion.latest_fingerprint(entry))
+            outcome, state[resource_name] = unbox_autoversion.step(entry, current_version, current_fingerprint, now, quiet_seconds)
+            snapshot_version = None
+            if outcome == unbox_autoversion.AUTOVERSION_SNAPSHOT:
+                snapshot_version = current_version
+                new_version = unbox_autoversion.next_version(current_version, versions)
+                self._dropbox_module.copy_version(resource_name, current_version, new_version)
+                self.change_current_version(resource_name, new_version)
+                state[resource_name] = unbox_autoversion.baseline_entry(new_version,
+                        unbox_autoversion.fingerprint(self._dropbox_module.resource_path(resource_name, new_version), current_fingerprint))
+            report.append((resource_name, outcome, snapshot_version))
+        unbox_autoversion.save_state(state_filepath, state)
+        return report
+
+    """
+    Flags or unflags a resource as a template, rendered with each machine's template variables before being linked
+    NOTE: Existing links are moved to or from renders by the next render_templates
+    - resource_name: name of resource
+    - template: whether the resource is a template
+    """
+    def set_template(self, resource_name, template):
+        self._dropbox_module.set_template(resource_name, template)
+
+    """
+    Brings every link to a template resource up to date with this machine's template variables, and links to resources
+    no longer flagged as templates back to Dropbox
+    NOTE: Renders are keyed by template content and variables, so only new or changed templates are rendered; renders
+    no link uses any more are removed
+    - RETURN: tuple of (number of templates rendered, set of paths of links retargeted)
+    """
+    @unbox_metrics.timed("render_templates")
+    def render_templates(self):
+        render_cache_dirpath = self._local_module.render_cache_dirpath() + os.sep
+        num_rendered = 0
+        used_renders = []
+        retargets = dict()
+        for link_path, (link_target, resource_name, resource_version, _) in self._local_module.iter_links():
+            if not self._dropbox_module.resource_exists(resource_name) or not self._dropbox_module.version_exists(resource_name, resource_version):
+                continue
+            if self._dropbox_module.is_template(resource_name):
+                target, rendered = self._render_cache.render(self._dropbox_module.resource_path(resource_name, resource_version), self._template_variables)
+                num_rendered += 1 if rendered else 0
+                used_renders.append(target)
+            elif link_target.startswith(render_cache_dirpath):
+                target = self._dropbox_module.resource_path(resource_name, resource_version)
+            else:
+                continue
+            if target != link_target:
+                retargets.setdefault((target, resource_version), []).append(link_path)
+        for (target, resource_version), link_paths in sorted(retargets.items()):
+            self._local_module.retarget_links(link_paths, target, resource_version)
+        self._render_cache.prune(used_renders)
+        self._render_cache.save()
+        return (num_rendered, set([link_path for link_paths in retargets.values() for link_path in link_paths]))
+
+    """
+    Verifies stored resource versions and backups against the checksums recorded by earlier scrubs, within an I/O budget
+    NOTE: Each run resumes where the last one stopped, so short runs add up to full passes; see unbox_scrub for the outcomes.
+    Only current versions may be edited through their links; any change to a backup or an older version is corruption
+    - bytes_per_second: bandwidth budget for reading files, or None for no limit
+    - max_seconds: stop starting new items after this long, or None to finish the current pass
+    - RETURN: list of (target label, outcome, list of (outcome, relative path) problems) tuples for the items scrubbed
+    """
+    @unbox_metrics.timed("scrub")
+    def scrub(self, bytes_per_second=None, max_seconds=None):
+        targets = [(self.SCRUB_TARGET_BACKUP, path) for path in self._local_module.backup_list()]
+        for resource_name, (_, _, versions) in self._dropbox_module.iter_resources():
+            targets.extend([(self.SCRUB_TARGET_VERSION, resource_name, version) for version in versions])
+        targets.sort()
+        throttle = unbox_scrub.Throttle(bytes_per_second)
+        version_updates = []
+        backup_updates = []
+
+        def scrub_target(target):
+            if target[0] == self.SCRUB_TARGET_BACKUP:
+                path = target[1]
+                outcome, checksums, problems = unbox_scrub.scrub_tree(self._local_module.backup_dirpath(path),
+                        self._local_module.backup_checksums(path), throttle)
+                backup_updates.append((path, checksums))
+            else:
+                _, resource_name, version = target
+                _, current_version, _ = self._dropbox_module.resource_info(resource_name)
+                outcome, checksums, problems = unbox_scrub.scrub_tree(os.path.dirname(self._dropbox_module.resource_path(resource_name, version)),
+                        self._dropbox_module.version_checksums(resource_name, version), throttle, version == current_version)
+                version_updates.append((resource_name, version, checksums))
+            return (outcome, problems)
+
+        def commit():
+            self._dropbox_module.record_version_checksums([update for update in version_updates if update[2] is not None])
+            self._local_module.record_backup_checksums([update for update in backup_updates if update[1] is not None])
+            del version_updates[:]
+            del backup_updates[:]
+
+        scrubbed = unbox_scrub.run(self._local_module.scrub_state_filepath(), targets, scrub_target, commit, max_seconds)
+        return [(unbox_scrub.target_label(target), outcome, problems) for target, outcome, problems in scrubbed]
+
+    """
+    Gets the latest scrub result for every stored resource version and backup
+    - RETURN: tuple of (number of completed scrub passes, sorted list of (target label, outcome, unix time, problems) tuples)
+    """
+    def scrub_results(self):
+        return unbox_scrub.results(self._local_module.scrub_state_filepath())
+
+    """
+    Compares the desired state against the filesystem without modifying anything
+    - RETURN: list of (drift kind, link path or resource name, detail) tuples, sorted; empty if there is no drift
+    """
+    @unbox_metrics.timed("status")
+    def status(self):
+        stat_cache = StatCache(self._backend)
+        drift = []
+        linked_resources = set()
 
+        # Check tracked links
+        for link_path in self._local_module.links_list():
+            link_target, resource_name, resource_version, ignore_new = self._local_module.link_info(link_path)
+            strategy, content_hash = self._local_module.link_strategy(link_path)
+            linked_resources.add(resource_name)
+            # Materialized content is only hashed when its stat signature changed since it was placed
+            content_stats = None
+            if strategy != unbox_links.STRATEGY_SYMLINK:
+                content_stats = self._local_module.link_content_stats(link_path) or [None, None]
+            if stat_cache.lstat(link_path) is None:
+                drift.append((self.DRIFT_MISSING, link_path, "link does not exist"))
+            elif strategy != unbox_links.STRATEGY_SYMLINK:
+                if stat.S_ISLNK(stat_cache.lstat(link_path).st_mode):
+                    drift.append((self.DRIFT_FOREIGN, link_path, "expected " + strategy + " of " + link_target))
+                elif (unbox_links.stat_signature(link_path, self._backend) != content_stats[0]
+                        and unbox_links.content_hash(link_path, self._backend) != content_hash):
+                    drift.append((self.DRIFT_MODIFIED, link_path, "content differs from the " + strategy + " of " + link_target))
+                elif stat_cache.stat(link_target) is None:
+                    drift.append((self.DRIFT_MISSING, link_path, "link target " + link_target + " does not exist"))
+                elif (unbox_links.stat_signature(link_target, self._backend) != content_stats[1]
+                        and unbox_links.content_hash(link_target, self._backend) != content_hash):
+                    drift.append((self.DRIFT_STALE_COPY, link_path, "resource at " + link_target + " changed since it was materialized"))
+            elif stat_cache.link_target(link_path) != link_target:
+                drift.append((self.DRIFT_FOREIGN, link_path, "expected link to " + link_target))
+            elif stat_cache.stat(link_path) is None:
+                drift.append((self.DRIFT_MISSING, link_path, "link target " + link_target + " does not exist"))
+            if not self._dropbox_module.resource_exists(resource_name):
+                drift.append((self.DRIFT_MISSING, link_path, "resource '" + resource_name + "' is not in Dropbox"))
+                continue
+            _, current_version, _ = self._dropbox_module.resource_info(resource_name)
+            if not ignore_new and resource_version != current_version:
+                drift.append((self.DRIFT_STALE_VERSION, link_path, "at version " + resource_version + ", current is " + current_version))
 
+        # Check backups
+        for backup_path in self._local_module.backup_list():
+            backup_filepath = os.path.join(self._local_module.backup_dirpath(backup_path), os.path.basename(backup_path))
+            if stat_cache.lstat(backup_filepath) is None:
+                drift.append((self.DRIFT_MISSING_BACKUP, backup_path, "expected at " + backup_filepath))
 
-        
+        # Check ignored and untracked resources
+        ignored_resources = set(self._local_module.ignored_list())
+        for resource_name in ignored_resources:
+            if not self._dropbox_module.resource_exists(resource_name):
+                drift.append((self.DRIFT_STALE_IGNORE, resource_name, "ignored resource is not in Dropbox"))
+        for resource_name in self._dropbox_module.resources_set():
+            if resource_name not in linked_resources and resource_name not in ignored_resources:
+                drift.append((self.DRIFT_UNTRACKED, resource_name, "resource is neither linked nor ignored"))
 
+        drift.sort()
+        return drift
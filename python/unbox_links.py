@@ -0,0 +1,272 @@
+import hashlib
+import os
+import stat
+import uuid
+
+import unbox_backend
+import unbox_metrics
+
+# Outcomes of materializing a single link
+LINK_CREATED = "created"            # Nothing was at the link path
+LINK_REPLACED = "replaced"          # A symlink at the link path was replaced
+LINK_BACKED_UP = "backed up"        # A file object at the link path was renamed with the backup suffix
+LINK_UNCHANGED = "unchanged"        # The link already pointed at the target
+LINK_FAILED = "failed"              # The link could not be created; see the error message
+
+"""
+Creates many symlinks, grouped by parent directory so each directory is checked once
+NOTE: Each link's path is still resolved from the root for every operation on it, since Python 2 has no dir_fd variants
+- links: iterable of (target path, link path) tuples; paths must be absolute
+- relative: whether to create symlinks whose targets are relative to the link's directory, so trees survive relocation
+- backup_suffix: suffix to rename non-symlink file objects at a link path with, or None to fail those links instead
+- backend: unbox_backend filesystem backend to create the links through, or None for the real filesystem
+- RETURN: list of (link path, outcome, error message) tuples in input order; error message is None unless outcome is LINK_FAILED
+"""
+def materialize_links(links, relative=False, backup_suffix=None, backend=None):
+    backend = backend or unbox_backend.OS_BACKEND
+    links = list(links)
+    results = [None] * len(links)
+
+    # Group links by parent directory so each directory is checked only once
+    links_by_dirpath = dict()
+    for idx, (target_path, link_path) in enumerate(links):
+        dirpath, link_name = os.path.split(link_path)
+        links_by_dirpath.setdefault(dirpath, []).append((idx, target_path, link_name))
+
+    for dirpath, dir_links in links_by_dirpath.items():
+        try:
+            dir_ops = backend.dir_ops(dirpath)
+        except OSError as e:
+            for idx, _, link_name in dir_links:
+                results[idx] = (links[idx][1], LINK_FAILED, "Cannot open link directory: " + str(e))
+            continue
+        try:
+            for idx, target_path, link_name in dir_links:
+                link_target = os.path.relpath(target_path, dirpath) if relative else target_path
+                try:
+                    results[idx] = (links[idx][1], _materialize_link(dir_ops, link_target, link_name, backup_suffix), None)
+                except (OSError, ValueError) as e:
+                    results[idx] = (links[idx][1], LINK_FAILED, str(e))
+        finally:
+            dir_ops.close()
+    return results
+
+"""
+Creates a single symlink in a directory checked by dir_ops
+- dir_ops: directory operations for the link's parent directory, from the backend's dir_ops
+- link_target: what the symlink should contain
+- link_name: name of the symlink in the directory
+- backup_suffix: suffix to rename a non-symlink file object at the link path with, or None to refuse
+- RETURN: outcome of the operation
+"""
+def _materialize_link(dir_ops, link_target, link_name, backup_suffix):
+    link_stat = dir_ops.lstat(link_name)
+    if link_stat is None:
+        dir_ops.symlink(link_target, link_name)
+        return LINK_CREATED
+    if stat.S_ISLNK(link_stat.st_mode):
+        if dir_ops.readlink(link_name) == link_target:
+            return LINK_UNCHANGED
+        dir_ops.unlink(link_name)
+        dir_ops.symlink(link_target, link_name)
+        return LINK_REPLACED
+    if backup_suffix is None:
+        raise ValueError("File already exists at link path")
+    dir_ops.rename(link_name, link_name + backup_suffix)
+    dir_ops.symlink(link_target, link_name)
+    return LINK_BACKED_UP
+
+
+
+""" ======= Copy-based materialization ======= """
+
+# Ways of materializing a resource at a link path
+STRATEGY_SYMLINK = "symlink"        # Symlink to the resource in Dropbox
+STRATEGY_HARDLINK = "hardlink"      # Hardlinks to the resource's files; must be on the same filesystem as Dropbox
+STRATEGY_REFLINK = "reflink"        # Copy-on-write clone of the resource's files, falling back to a copy where unsupported
+STRATEGY_COPY = "copy"              # Plain copy of the resource
+STRATEGIES = (STRATEGY_SYMLINK, STRATEGY_HARDLINK, STRATEGY_REFLINK, STRATEGY_COPY)
+
+# Size of the chunks files are read in when hashing
+_HASH_CHUNK_SIZE = 1 << 16
+
+"""
+Converts a path or other text to bytes for hashing
+- value: text or bytes
+- RETURN: bytes
+"""
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode("utf-8")
+
+"""
+Feeds a file's contents into a digest
+- digest: hashlib digest to update
+- filepath: path of file to read
+- backend: unbox_backend filesystem backend to read the file through
+"""
+def _hash_file_into(digest, filepath, backend):
+    with backend.open(filepath, "rb") as file_fp:
+        chunk = file_fp.read(_HASH_CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = file_fp.read(_HASH_CHUNK_SIZE)
+
+"""
+Gets a digest of a file object's content, following a symlink at the path itself
+NOTE: Directories are hashed over the relative paths of their entries, file contents and the targets of symlinks inside them
+- path: path of file object to hash
+- backend: unbox_backend filesystem backend to read the file object through, or None for the real filesystem
+- RETURN: hex digest string
+"""
+def content_hash(path, backend=None):
+    backend = backend or unbox_backend.OS_BACKEND
+    digest = hashlib.sha256()
+    if not backend.isdir(path):
+        _hash_file_into(digest, path, backend)
+        return digest.hexdigest()
+    for dirpath, dirnames, filenames in backend.walk(path):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            entry_path = os.path.join(dirpath, name)
+            relative_path = _to_bytes(os.path.relpath(entry_path, path))
+            if backend.islink(entry_path):
+                digest.update(b"L" + relative_path + b"\0" + _to_bytes(backend.readlink(entry_path)) + b"\0")
+            elif backend.isdir(entry_path):
+                digest.update(b"D" + relative_path + b"\0")
+            else:
+                digest.update(b"F" + relative_path + b"\0")
+                _hash_file_into(digest, entry_path, backend)
+    return digest.hexdigest()
+
+"""
+Gets a signature of a file object's content from its metadata alone, following a symlink at the path itself, so a content
+hash only needs recomputing when the signature changes
+NOTE: Directories combine the total size of the files and symlinks inside them with the latest modification time of the
+directory or any entry inside it
+- path: path of file object
+- backend: unbox_backend filesystem backend to stat the file object through, or None for the real filesystem
+- RETURN: [size, modification time] list, which survives a round trip through the JSON local index unchanged
+"""
+def stat_signature(path, backend=None):
+    backend = backend or unbox_backend.OS_BACKEND
+    path_stat = backend.stat(path)
+    if not stat.S_ISDIR(path_stat.st_mode):
+        return [path_stat.st_size, path_stat.st_mtime]
+    size, mtime = 0, path_stat.st_mtime
+    for dirpath, dirnames, filenames in backend.walk(path):
+        for name in dirnames + filenames:
+            entry_stat = backend.lstat(os.path.join(dirpath, name))
+            if not stat.S_ISDIR(entry_stat.st_mode):
+                size += entry_stat.st_size
+            mtime = max(mtime, entry_stat.st_mtime)
+    return [size, mtime]
+
+"""
+Hardlinks a file
+- backend: unbox_backend filesystem backend to link the file through
+- source_path: path of file to link
+- dest_path: path of new link
+"""
+def _hardlink_file(backend, source_path, dest_path):
+    backend.link(source_path, dest_path)
+
+"""
+Clones a file so both files share their data until one is written, copying it if cloning is unsupported
+- backend: unbox_backend filesystem backend to clone the file through
+- source_path: path of file to clone
+- dest_path: path of new file
+"""
+def _reflink_file(backend, source_path, dest_path):
+    if not backend.reflink(source_path, dest_path):
+        unbox_metrics.BYTES_COPIED.inc(backend.getsize(dest_path))
+
+"""
+Copies a file with its permission bits and timestamps
+- backend: unbox_backend filesystem backend to copy the file through
+- source_path: path of file to copy
+- dest_path: path of new file
+"""
+def _copy_file(backend, source_path, dest_path):
+    backend.copy2(source_path, dest_path)
+    unbox_metrics.BYTES_COPIED.inc(backend.getsize(dest_path))
+
+# Functions placing a single file for each copy-based strategy
+_FILE_PLACERS = {
+    STRATEGY_HARDLINK : _hardlink_file,
+    STRATEGY_REFLINK : _reflink_file,
+    STRATEGY_COPY : _copy_file
+}
+
+"""
+Recreates a file object at a new path, placing each regular file with the given function and copying symlinks as symlinks
+- source_path: path of file object to recreate
+- dest_path: path to recreate it at; must not exist
+- place_file: function taking a backend, source path and destination path that places a regular file
+- backend: unbox_backend filesystem backend to recreate the file object through
+"""
+def _place_tree(source_path, dest_path, place_file, backend):
+    if backend.islink(source_path):
+        backend.symlink(backend.readlink(source_path), dest_path)
+    elif backend.isdir(source_path):
+        backend.mkdir(dest_path)
+        for name in sorted(backend.listdir(source_path)):
+            _place_tree(os.path.join(source_path, name), os.path.join(dest_path, name), place_file, backend)
+        backend.copystat(source_path, dest_path)
+    else:
+        place_file(backend, source_path, dest_path)
+
+"""
+Materializes a resource at a link path by hardlinking, cloning or copying it, skipping the work if its content is unchanged
+NOTE: The new file object is built beside the link path and renamed into place, so a failed attempt leaves the old one intact
+- target_path: absolute path of the resource
+- link_path: absolute path to materialize the resource at
+- strategy: one of the copy-based STRATEGY_* constants
+- known_hash: content hash recorded when the link path was last materialized, or None if Unbox hasn't materialized it
+- backup_suffix: suffix to rename an unmanaged or locally edited file object at the link path with, or None to refuse
+- backend: unbox_backend filesystem backend to materialize the resource through, or None for the real filesystem
+- RETURN: tuple of (outcome, content hash of the resource)
+"""
+def materialize_content(target_path, link_path, strategy, known_hash=None, backup_suffix=None, backend=None):
+    backend = backend or unbox_backend.OS_BACKEND
+    if strategy not in _FILE_PLACERS:
+        raise ValueError("Cannot materialize link; unknown strategy '" + str(strategy) + "'")
+    new_hash = content_hash(target_path, backend)
+    link_stat = backend.lstat(link_path) if backend.lexists(link_path) else None
+    is_materialized = link_stat is not None and not stat.S_ISLNK(link_stat.st_mode) and known_hash is not None
+    if is_materialized and known_hash == new_hash:
+        return (LINK_UNCHANGED, new_hash)
+
+    # Only a materialized file object still holding what was placed may be replaced; local edits are kept like any other file
+    is_managed = is_materialized and content_hash(link_path, backend) == known_hash
+    if link_stat is not None and not stat.S_ISLNK(link_stat.st_mode) and not is_managed and backup_suffix is None:
+        if is_materialized:
+            raise ValueError("File at link path was edited since it was materialized")
+        raise ValueError("File already exists at link path")
+
+    # Build the new file object beside the link path
+    dirpath, link_name = os.path.split(link_path)
+    temp_path = os.path.join(dirpath, "." + link_name + ".unbox-" + uuid.uuid4().hex)
+    try:
+        _place_tree(backend.realpath(target_path), temp_path, _FILE_PLACERS[strategy], backend)
+    except:
+        if backend.isdir(temp_path) and not backend.islink(temp_path):
+            backend.rmtree(temp_path)
+        elif backend.lexists(temp_path):
+            backend.remove(temp_path)
+        raise
+
+    # Move whatever is at the link path out of the way and swap the new file object in
+    outcome = LINK_CREATED
+    if link_stat is not None:
+        outcome = LINK_REPLACED
+        if not stat.S_ISLNK(link_stat.st_mode) and not is_managed:
+            backend.rename(link_path, link_path + backup_suffix)
+            outcome = LINK_BACKED_UP
+        elif stat.S_ISDIR(link_stat.st_mode):
+            backend.rmtree(link_path)
+        elif backend.isdir(temp_path):
+            backend.remove(link_path)
+    backend.rename(temp_path, link_path)
+    return (outcome, new_hash)
@@ -0,0 +1,78 @@
+import contextlib
+import fcntl
+import os
+import stat
+import tempfile
+
+# Suffix of the sidecar file locked in place of an index file, so the index itself can be replaced atomically
+_LOCK_FILE_SUFFIX = ".lock"
+
+"""
+Holds an fcntl lock on the sidecar lock file of an index file for the duration of a with-block
+- index_filepath: path to the index file to lock
+- operation: fcntl.LOCK_SH or fcntl.LOCK_EX
+"""
+@contextlib.contextmanager
+def _index_lock(index_filepath, operation):
+    lock_fd = os.open(index_filepath + _LOCK_FILE_SUFFIX, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock_fd, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+    finally:
+        os.close(lock_fd)
+
+"""
+Takes a shared lock on an index file; any number of readers may hold it at once
+- index_filepath: path to the index file to lock
+"""
+def shared_lock(index_filepath):
+    return _index_lock(index_filepath, fcntl.LOCK_SH)
+
+"""
+Takes an exclusive lock on an index file, waiting for all readers and writers to finish
+- index_filepath: path to the index file to lock
+"""
+def exclusive_lock(index_filepath):
+    return _index_lock(index_filepath, fcntl.LOCK_EX)
+
+"""
+Gets the permission bits a replacement for a file should have, since temporary files are created readable only by their owner
+- filepath: path to the file being replaced
+- RETURN: the existing file's permission bits, or those a newly created file would get under the current umask
+"""
+def _replacement_mode(filepath):
+    try:
+        return stat.S_IMODE(os.stat(filepath).st_mode)
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+"""
+Replaces a file's contents atomically, so readers only ever see the old or the new contents, keeping the file's permissions
+- filepath: path to the file to write
+- write_function: function taking a binary file object and writing the new contents to it
+- RETURN: number of bytes written
+"""
+def atomic_write(filepath, write_function):
+    dirpath, filename = os.path.split(filepath)
+    temp_fd, temp_filepath = tempfile.mkstemp(prefix="." + filename + ".", dir=dirpath)
+    try:
+        temp_fp = os.fdopen(temp_fd, "wb")
+        try:
+            os.fchmod(temp_fp.fileno(), _replacement_mode(filepath))
+            write_function(temp_fp)
+            temp_fp.flush()
+            os.fsync(temp_fp.fileno())
+            bytes_written = temp_fp.tell()
+        finally:
+            temp_fp.close()
+        os.rename(temp_filepath, filepath)
+        return bytes_written
+    except:
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        raise
@@ -0,0 +1,314 @@
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+
+import unbox_lock
+
+# Upper bounds in seconds of the buckets operation latencies are counted in
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Keys in the persisted metrics totals
+_STATE_KEY_COUNTERS = "counters"
+_STATE_KEY_HISTOGRAMS = "histograms"
+_HISTOGRAM_KEY_BUCKETS = "buckets"
+_HISTOGRAM_KEY_SUM = "sum"
+_HISTOGRAM_KEY_COUNT = "count"
+
+class Counter(object):
+    """Monotonically increasing count, safe to increment from several threads"""
+
+    def __init__(self, name, description):
+        """Instantiates a counter at zero
+
+        Keyword Args:
+        name -- metric name in Prometheus format (e.g. "unbox_links_created_total")
+        description -- one-line description of what is counted
+        """
+        self.name = name
+        self.description = description
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Adds to the counter
+
+        Keyword Args:
+        amount -- amount to add (default: 1)
+        """
+        with self._lock:
+            self.value += amount
+
+class Histogram(object):
+    """Distribution of observed values, kept separately for each value of a single label"""
+
+    def __init__(self, name, description, label_name, buckets):
+        """Instantiates an empty histogram
+
+        Keyword Args:
+        name -- metric name in Prometheus format
+        description -- one-line description of what is observed
+        label_name -- name of the label observations are split by
+        buckets -- sorted upper bounds of the buckets observations are counted in
+        """
+        self.name = name
+        self.description = description
+        self.label_name = label_name
+        self.buckets = tuple(buckets)
+
+        # Maps label value -> [list of per-bucket counts with a final +Inf bucket, sum of observations, number of observations]
+        self.series = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        """Records an observation
+
+        Keyword Args:
+        label_value -- value of the histogram's label for the observation
+        value -- observed value
+        """
+        with self._lock:
+            series = self.series.setdefault(label_value, [[0] * (len(self.buckets) + 1), 0.0, 0])
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+class MetricsRegistry(object):
+    """Set of named counters and histograms, with persistence and Prometheus text exposition"""
+
+    def __init__(self):
+        """Instantiates an empty registry"""
+        # Metrics in registration order, so output is stable
+        self._counters = []
+        self._histograms = []
+
+    def counter(self, name, description):
+        """Registers a counter
+
+        Keyword Args:
+        name -- metric name in Prometheus format
+        description -- one-line description of what is counted
+
+        Return:
+        The new Counter
+        """
+        counter = Counter(name, description)
+        self._counters.append(counter)
+        return counter
+
+    def histogram(self, name, description, label_name, buckets=_LATENCY_BUCKETS):
+        """Registers a histogram
+
+        Keyword Args:
+        name -- metric name in Prometheus format
+        description -- one-line description of what is observed
+        label_name -- name of the label observations are split by
+        buckets -- sorted upper bounds of the buckets observations are counted in (default: latency buckets in seconds)
+
+        Return:
+        The new Histogram
+        """
+        histogram = Histogram(name, description, label_name, buckets)
+        self._histograms.append(histogram)
+        return histogram
+
+    def counters(self):
+        """Gets the registered counters in registration order"""
+        return list(self._counters)
+
+    def histograms(self):
+        """Gets the registered histograms in registration order"""
+        return list(self._histograms)
+
+    def state(self):
+        """Gets the values of every metric in a JSON-serializable form
+
+        Return:
+        Dict of metric values that add_state accepts
+        """
+        histograms = dict()
+        for histogram in self._histograms:
+            histograms[histogram.name] = dict([(label_value, {
+                _HISTOGRAM_KEY_BUCKETS : list(bucket_counts),
+                _HISTOGRAM_KEY_SUM : observation_sum,
+                _HISTOGRAM_KEY_COUNT : observation_count
+            }) for label_value, (bucket_counts, observation_sum, observation_count) in histogram.series.items()])
+        return {
+            _STATE_KEY_COUNTERS : dict([(counter.name, counter.value) for counter in self._counters]),
+            _STATE_KEY_HISTOGRAMS : histograms
+        }
+
+    def add_state(self, state):
+        """Adds previously-saved metric values to this registry's values
+        NOTE: Saved values for metrics that aren't registered, or histograms with different buckets, are dropped
+
+        Keyword Args:
+        state -- dict of metric values from state()
+        """
+        counter_values = state.get(_STATE_KEY_COUNTERS, dict())
+        for counter in self._counters:
+            counter.inc(counter_values.get(counter.name, 0))
+        histogram_states = state.get(_STATE_KEY_HISTOGRAMS, dict())
+        for histogram in self._histograms:
+            for label_value, series_state in histogram_states.get(histogram.name, dict()).items():
+                if len(series_state[_HISTOGRAM_KEY_BUCKETS]) != len(histogram.buckets) + 1:
+                    continue
+                with histogram._lock:
+                    series = histogram.series.setdefault(label_value, [[0] * (len(histogram.buckets) + 1), 0.0, 0])
+                    series[0] = [count + saved_count for count, saved_count in zip(series[0], series_state[_HISTOGRAM_KEY_BUCKETS])]
+                    series[1] += series_state[_HISTOGRAM_KEY_SUM]
+                    series[2] += series_state[_HISTOGRAM_KEY_COUNT]
+
+    def counted(self):
+        """Checks whether any counter has moved from zero; latency observations alone don't count
+
+        Return:
+        True if any counter is nonzero, False otherwise
+        """
+        return any(counter.value != 0 for counter in self._counters)
+
+    def reset(self):
+        """Sets every metric back to zero"""
+        for counter in self._counters:
+            with counter._lock:
+                counter.value = 0
+        for histogram in self._histograms:
+            with histogram._lock:
+                histogram.series = dict()
+
+    def copy(self):
+        """Gets a new registry with the same metrics and values"""
+        registry_copy = MetricsRegistry()
+        for counter in self._counters:
+            registry_copy.counter(counter.name, counter.description)
+        for histogram in self._histograms:
+            registry_copy.histogram(histogram.name, histogram.description, histogram.label_name, histogram.buckets)
+        registry_copy.add_state(self.state())
+        return registry_copy
+
+    def to_prometheus(self):
+        """Formats every metric in the Prometheus text exposition format
+
+        Return:
+        Exposition text, ending in a newline
+        """
+        lines = []
+        for counter in self._counters:
+            lines.append("# HELP " + counter.name + " " + counter.description)
+            lines.append("# TYPE " + counter.name + " counter")
+            lines.append(counter.name + " " + _format_value(counter.value))
+        for histogram in self._histograms:
+            lines.append("# HELP " + histogram.name + " " + histogram.description)
+            lines.append("# TYPE " + histogram.name + " histogram")
+            for label_value, (bucket_counts, observation_sum, observation_count) in sorted(histogram.series.items()):
+                label = histogram.label_name + "=\"" + _escape_label_value(label_value) + "\""
+                cumulative_count = 0
+                for upper_bound, bucket_count in zip(histogram.buckets + (float("inf"),), bucket_counts):
+                    cumulative_count += bucket_count
+                    lines.append(histogram.name + "_bucket{" + label + ",le=\"" + _format_value(upper_bound) + "\"} " + str(cumulative_count))
+                lines.append(histogram.name + "_sum{" + label + "} " + _format_value(observation_sum))
+                lines.append(histogram.name + "_count{" + label + "} " + str(observation_count))
+        return "\n".join(lines) + "\n"
+
+"""
+Formats a metric value or bucket bound for Prometheus
+- value: number
+- RETURN: string form of the number
+"""
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+"""
+Escapes a label value for Prometheus
+- value: label value
+- RETURN: escaped label value
+"""
+def _escape_label_value(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+
+""" ======= Unbox metrics ======= """
+
+# Registry holding every metric the Unbox modules record during this process
+REGISTRY = MetricsRegistry()
+
+LINKS_CREATED = REGISTRY.counter("unbox_links_created_total", "Links created, including hardlinks, clones and copies")
+LINKS_REMOVED = REGISTRY.counter("unbox_links_removed_total", "Links removed")
+LINKS_RETARGETED = REGISTRY.counter("unbox_links_retargeted_total", "Links pointed at a new resource version")
+BACKUPS_TAKEN = REGISTRY.counter("unbox_backups_taken_total", "File objects moved into the backup system")
+BACKUPS_RESTORED = REGISTRY.counter("unbox_backups_restored_total", "File objects restored from the backup system")
+BYTES_COPIED = REGISTRY.counter("unbox_bytes_copied_total", "Bytes of resource data copied")
+INDEX_BYTES_WRITTEN = REGISTRY.counter("unbox_index_bytes_written_total", "Bytes written to index files")
+OPERATION_SECONDS = REGISTRY.histogram("unbox_operation_duration_seconds", "Duration of Unbox operations", "operation")
+
+"""
+Decorates a function so that each call's duration is observed in the operation latency histogram
+- operation: name of the operation, used as the histogram label
+- RETURN: decorator
+"""
+def timed(operation):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start_time = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                OPERATION_SECONDS.observe(operation, time.time() - start_time)
+        return wrapper
+    return decorator
+
+"""
+Reads persisted metric totals
+NOTE: The caller must hold a lock on the totals file
+- filepath: path to the totals file
+- RETURN: dict of metric values, empty if there is no totals file
+"""
+def _read_totals_file(filepath):
+    if not os.path.isfile(filepath):
+        return dict()
+    totals_fp = open(filepath)
+    totals = json.load(totals_fp)
+    totals_fp.close()
+    return totals
+
+"""
+Gets the metric totals persisted across runs, without adding this process's metrics
+- filepath: path to the totals file
+- RETURN: MetricsRegistry holding the totals
+"""
+def load_totals(filepath):
+    totals = REGISTRY.copy()
+    totals.reset()
+    with unbox_lock.shared_lock(filepath):
+        totals.add_state(_read_totals_file(filepath))
+    return totals
+
+"""
+Adds this process's metrics to the totals persisted across runs, then zeroes them so they are only added once
+- filepath: path to the totals file
+- RETURN: MetricsRegistry holding the new totals
+"""
+def accumulate_totals(filepath):
+    with unbox_lock.exclusive_lock(filepath):
+        totals = REGISTRY.copy()
+        totals.add_state(_read_totals_file(filepath))
+        unbox_lock.atomic_write(filepath, lambda totals_fp: totals_fp.write(json.dumps(totals.state(), sort_keys=True).encode("utf-8")))
+        REGISTRY.reset()
+    return totals
+
+"""
+Writes metrics in the Prometheus text exposition format for a node-exporter textfile collector
+NOTE: The file is replaced atomically, so the collector never reads a partial file
+- registry: MetricsRegistry to write
+- filepath: path of the file to write; the collector only reads files ending in '.prom'
+"""
+def write_textfile(registry, filepath):
+    unbox_lock.atomic_write(filepath, lambda textfile_fp: textfile_fp.write(registry.to_prometheus().encode("utf-8")))
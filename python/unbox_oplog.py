@@ -0,0 +1,518 @@
+import copy
+import json
+import os
+import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import unbox_backend
+import unbox_records
+import unbox_search
+
+# Suffix of each machine's append-only log of its index changes, one JSON operation per line, in the operation log directory
+_LOG_SUFFIX = ".log"
+
+# Kinds of operation in a log
+_OP_CREATE = "create"                   # Resource was added; ignored, with later operations on it, if a resource of that name already exists
+_OP_DELETE = "delete"                   # Resource was deleted
+_OP_PUT_VERSION = "put version"         # Version was added or its dependencies or checksums changed
+_OP_DELETE_VERSION = "delete version"   # Version was deleted
+_OP_CURRENT = "current"                 # Current version changed; ignored if the version no longer exists
+_OP_TEMPLATE = "template"               # Template flag changed
+
+# Keys in a logged operation
+_OP_KEY_KIND = "op"
+_OP_KEY_RESOURCE = "resource"
+_OP_KEY_VERSION = "version"
+_OP_KEY_VALUE = "value"
+_OP_KEY_PARENT = "parent"       # Parent directory of the resource an operation other than a create applies to
+_OP_KEY_SEQUENCE = "seq"
+_OP_KEY_TIMESTAMP = "ts"
+
+# Smallest step a machine moves its clock past the latest merged operation, so its own operations sort after everything it has seen
+_MIN_CLOCK_STEP = 0.001
+
+# Number of operations merged since the cached view was last saved after which it is saved again; a load merges any
+# operations logged after the last save again
+_VIEW_SAVE_INTERVAL = 256
+
+"""
+Converts a serialized resource entry to plain JSON types, so entries compare equal however they were built
+- resource_info: dict of serialized resource info, as from ResourceRecord.serialize
+- RETURN: new dict with dependency sets as sorted lists
+"""
+def _normalize(resource_info):
+    resource_info = dict(resource_info)
+    versions_info = dict()
+    for version, version_info in resource_info[unbox_records._RSRC_INFO_KEY_VERSIONS_INFO].items():
+        version_info = dict(version_info)
+        version_info[unbox_records._VERSION_INFO_KEY_DEPENDENCIES] = sorted(version_info[unbox_records._VERSION_INFO_KEY_DEPENDENCIES])
+        versions_info[version] = version_info
+    resource_info[unbox_records._RSRC_INFO_KEY_VERSIONS_INFO] = versions_info
+    if not resource_info.get(unbox_records._RSRC_INFO_KEY_TEMPLATE, False):
+        resource_info.pop(unbox_records._RSRC_INFO_KEY_TEMPLATE, None)
+    return resource_info
+
+"""
+Parses the complete operations in bytes read from a machine's log
+NOTE: A last line without a newline is still being written or synced, so it is left for the next read
+- machine_id: id of machine whose log the bytes were read from
+- log_bytes: bytes read from the log, starting at the start of a line
+- merged_seq: sequence number of the last operation of the log already merged, or -1 if none were; earlier ones are skipped
+- RETURN: tuple of (number of bytes of complete lines, list of (ordering key, operation) tuples)
+"""
+def _parse_ops(machine_id, log_bytes, merged_seq):
+    complete_bytes = log_bytes[:log_bytes.rfind(b"\n") + 1]
+    ops = []
+    for line in complete_bytes.decode("utf-8").splitlines():
+        try:
+            op = json.loads(line)
+            key = (op[_OP_KEY_TIMESTAMP], machine_id, op[_OP_KEY_SEQUENCE])
+        except (ValueError, KeyError, TypeError):
+            continue
+        if key[2] > merged_seq:
+            ops.append((key, op))
+    return (len(complete_bytes), ops)
+
+"""
+Applies one operation to a merged view
+- view: dict of resource names -> normalized resource entries, modified in place
+- op: operation dict read from a log
+"""
+def _apply(view, op):
+    kind = op[_OP_KEY_KIND]
+    resource_name = op[_OP_KEY_RESOURCE]
+    resource_info = view.get(resource_name)
+    if kind == _OP_CREATE:
+        if resource_info is None:
+            view[resource_name] = {
+                unbox_records._RSRC_INFO_KEY_PARENT_DIRNAME : op[_OP_KEY_VALUE],
+                unbox_records._RSRC_INFO_KEY_VERSIONS_INFO : dict(),
+                unbox_records._RSRC_INFO_KEY_CURRENT_VERSION : None
+            }
+    elif resource_info is None:
+        return
+    elif op.get(_OP_KEY_PARENT, resource_info[unbox_records._RSRC_INFO_KEY_PARENT_DIRNAME]) != resource_info[unbox_records._RSRC_INFO_KEY_PARENT_DIRNAME]:
+        # The operation is for a different resource another machine created under the same name, whose create lost
+        return
+    elif kind == _OP_DELETE:
+        del view[resource_name]
+    elif kind == _OP_PUT_VERSION:
+        resource_info[unbox_records._RSRC_INFO_KEY_VERSIONS_INFO][op[_OP_KEY_VERSION]] = op[_OP_KEY_VALUE]
+    elif kind == _OP_DELETE_VERSION:
+        resource_info[unbox_records._RSRC_INFO_KEY_VERSIONS_INFO].pop(op[_OP_KEY_VERSION], None)
+    elif kind == _OP_CURRENT:
+        if op[_OP_KEY_VERSION] in resource_info[unbox_records._RSRC_INFO_KEY_VERSIONS_INFO]:
+            resource_info[unbox_records._RSRC_INFO_KEY_CURRENT_VERSION] = op[_OP_KEY_VERSION]
+    elif kind == _OP_TEMPLATE:
+        if op[_OP_KEY_VALUE]:
+            resource_info[unbox_records._RSRC_INFO_KEY_TEMPLATE] = True
+        else:
+            resource_info.pop(unbox_records._RSRC_INFO_KEY_TEMPLATE, None)
+
+"""
+Gets the index entry a merged view entry stands for
+NOTE: Merges can leave a resource without versions, or with a deleted current version; the former aren't listed, and
+the latter fall back to their highest version. The view itself is left alone, so later merges give the same result
+- resource_info: normalized resource entry from a merged view
+- RETURN: resource entry, or None if the resource has no versions
+"""
+def _materialize(resource_info):
+    versions_info = resource_info[unbox_records._RSRC_INFO_KEY_VERSIONS_INFO]
+    if len(versions_info) == 0:
+        return None
+    if resource_info[unbox_records._RSRC_INFO_KEY_CURRENT_VERSION] not in versions_info:
+        resource_info = dict(resource_info)
+        resource_info[unbox_records._RSRC_INFO_KEY_CURRENT_VERSION] = max(versions_info, key=unbox_search.version_key)
+    return resource_info
+
+"""
+Gets the operations turning one normalized resource entry into another
+- resource_name: name of resource
+- old_info: normalized resource entry, or None if the resource didn't exist
+- new_info: normalized resource entry, or None if the resource was deleted
+- RETURN: list of operations, without sequence numbers or timestamps
+"""
+def _diff(resource_name, old_info, new_info):
+    if old_info == new_info:
+        return []
+    ops = []
+    if new_info is None or (old_info is not None and old_info[unbox_records._RSRC_INFO_KEY_PARENT_DIRNAME]
+            != new_info[unbox_records._RSRC_INFO_KEY_PARENT_DIRNAME]):
+        ops.append({ _OP_KEY_KIND : _OP_DELETE, _OP_KEY_RESOURCE : resource_name, _OP_KEY_PARENT : old_info[unbox_records._RSRC_INFO_KEY_PARENT_DIRNAME] })
+        old_info = None
+    if new_info is None:
+        return ops
+    parent_dirname = new_info[unbox_records._RSRC_INFO_KEY_PARENT_DIRNAME]
+    if old_info is None:
+        ops.append({ _OP_KEY_KIND : _OP_CREATE, _OP_KEY_RESOURCE : resource_name, _OP_KEY_VALUE : new_info[unbox_records._RSRC_INFO_KEY_PARENT_DIRNAME] })
+        old_info = { unbox_records._RSRC_INFO_KEY_VERSIONS_INFO : dict(), unbox_records._RSRC_INFO_KEY_CURRENT_VERSION : None }
+
+    # Add versions before pointing at them, and only delete versions once they are no longer current
+    old_versions = old_info[unbox_records._RSRC_INFO_KEY_VERSIONS_INFO]
+    new_versions = new_info[unbox_records._RSRC_INFO_KEY_VERSIONS_INFO]
+    for version in sorted(new_versions):
+        if old_versions.get(version) != new_versions[version]:
+            ops.append({ _OP_KEY_KIND : _OP_PUT_VERSION, _OP_KEY_RESOURCE : resource_name, _OP_KEY_PARENT : parent_dirname,
+                    _OP_KEY_VERSION : version, _OP_KEY_VALUE : new_versions[version] })
+    if old_info[unbox_records._RSRC_INFO_KEY_CURRENT_VERSION] != new_info[unbox_records._RSRC_INFO_KEY_CURRENT_VERSION]:
+        ops.append({ _OP_KEY_KIND : _OP_CURRENT, _OP_KEY_RESOURCE : resource_name, _OP_KEY_PARENT : parent_dirname,
+                _OP_KEY_VERSION : new_info[unbox_records._RSRC_INFO_KEY_CURRENT_VERSION] })
+    for version in sorted(set(old_versions) - set(new_versions)):
+        ops.append({ _OP_KEY_KIND : _OP_DELETE_VERSION, _OP_KEY_RESOURCE : resource_name, _OP_KEY_PARENT : parent_dirname, _OP_KEY_VERSION : version })
+    new_template = new_info.get(unbox_records._RSRC_INFO_KEY_TEMPLATE, False)
+    if old_info.get(unbox_records._RSRC_INFO_KEY_TEMPLATE, False) != new_template:
+        ops.append({ _OP_KEY_KIND : _OP_TEMPLATE, _OP_KEY_RESOURCE : resource_name, _OP_KEY_PARENT : parent_dirname, _OP_KEY_VALUE : new_template })
+    return ops
+
+"""
+Merges one writer's change to a resource into a resource entry another writer committed since, version by version, as
+merging operation logs would
+NOTE: Changes to a resource the other writer deleted, or replaced with a different resource of the same name, are dropped,
+so a stale entry can't bring it back or graft its versions onto another resource
+- resource_name: name of resource
+- base_info: serialized resource info the change was made from, or None if the resource didn't exist
+- new_info: serialized resource info after the change, or None if the change deleted the resource
+- committed_info: serialized resource info committed by the other writer, or None if it doesn't have the resource
+- RETURN: merged serialized resource info, or None if the merged resource doesn't exist
+"""
+def merge_entry(resource_name, base_info, new_info, committed_info):
+    view = dict()
+    if committed_info is not None:
+        view[resource_name] = _normalize(committed_info)
+    for op in _diff(resource_name, _normalize(base_info) if base_info is not None else None, _normalize(new_info) if new_info is not None else None):
+        _apply(view, op)
+    if resource_name not in view:
+        return None
+    return _materialize(view[resource_name])
+
+class OpLog(object):
+    """Per-machine operation logs standing in for a shared index file, merged into a cached view
+    NOTE: Each machine only ever appends to its own log, so Dropbox never has to reconcile concurrent writes to one file.
+    Operations are merged in (timestamp, machine id, sequence number) order, with each machine's clock kept past every
+    operation it has merged; merging the same logs on top of the same base index always gives the same view, whichever
+    machine does it. Logs grow by a line per changed version, current version or template flag until a machine folds every
+    operation it merged into a new base index, recording the last operation of each log it folded; machines then skip
+    those, and each machine starts its own log over once a base index holds all of it. A machine that hadn't merged the
+    operations in a log started over picks them up from the new base index on its next load
+    """
+
+    def __init__(self, log_dirpath, machine_id, view_filepath=None, backend=None):
+        """Instantiates an operation log
+
+        Keyword Args:
+        log_dirpath -- path to the directory holding every machine's log, created if it doesn't exist
+        machine_id -- name of this machine's log, unique among the machines sharing the directory
+        view_filepath -- path to the file caching this machine's merge of every log, which belongs on this machine rather
+        than in the synced log directory (default: None, to merge every log from the start on each load)
+        backend -- unbox_backend filesystem backend to read and write the logs through (default: the real filesystem)
+        """
+        if machine_id is None or len(machine_id.strip()) == 0 or os.sep in machine_id or machine_id.startswith("."):
+            raise ValueError("Cannot use operation log; machine id '" + str(machine_id) + "' is not a valid filename")
+        self._log_dirpath = log_dirpath
+        self._machine_id = machine_id
+        self._view_filepath = view_filepath
+        self._backend = backend or unbox_backend.OS_BACKEND
+
+        # Index the logs apply on top of, and its generation
+        self._base_generation = None
+        self._base_index = dict()
+        # Maps machine id -> sequence number of the last operation of its log folded into the base index
+        self._folded_seqs = dict()
+
+        # Merged view of the base index and every operation read so far
+        # Maps resource name -> normalized resource entry
+        self._view = dict()
+        # Maps machine id -> number of bytes of its log read so far
+        self._offsets = dict()
+        # Maps machine id -> sequence number of the last operation of its log merged, including those folded into the base index
+        self._merged_seqs = dict()
+        # Ordering key of the last operation merged, or None if none were
+        self._last_key = None
+        # Number of operations merged, and sequence number of this machine's next operation
+        self._num_ops = 0
+        self._next_seq = 0
+        # Number of operations merged since the view was last cached
+        self._unsaved_ops = 0
+
+    def _log_filepath(self, machine_id):
+        """Gets the path to a machine's log"""
+        return os.path.join(self._log_dirpath, machine_id + _LOG_SUFFIX)
+
+    def load(self, base_generation, base_index, folded_seqs=None):
+        """Restores the cached view, or starts over from the base index if it changed, then merges operations logged since
+
+        Keyword Args:
+        base_generation -- generation of the index file the logs apply on top of
+        base_index -- dict of resource names -> serialized resource info read from the index file
+        folded_seqs -- dict of machine id -> sequence number of the last operation of its log folded into the index file
+            (default: none were)
+
+        Return:
+        Tuple of (generation of merged index, dict of resource names -> serialized resource info)
+        """
+        if not self._backend.isdir(self._log_dirpath):
+            self._backend.makedirs(self._log_dirpath)
+        cached_state = None
+        view_filepath = self._view_filepath
+        if view_filepath is not None and self._backend.isfile(view_filepath):
+            view_fp = self._backend.open(view_filepath, "rb")
+            try:
+                cached_state = pickle.load(view_fp)
+            except Exception:
+                cached_state = None
+            finally:
+                view_fp.close()
+        self._base_generation = base_generation
+        self._base_index = base_index
+        self._folded_seqs = dict(folded_seqs or dict())
+        if cached_state is not None and cached_state.get("base generation") == base_generation and "merged seqs" in cached_state:
+            self._view = cached_state["view"]
+            self._offsets = cached_state["offsets"]
+            self._merged_seqs = cached_state["merged seqs"]
+            self._last_key = cached_state["last key"]
+            self._num_ops = cached_state["num ops"]
+            self._next_seq = cached_state["next seq"]
+        else:
+            cached_state = None
+            self._replay([])
+        self._next_seq = max(self._next_seq, self._folded_seqs.get(self._machine_id, -1) + 1)
+        self.refresh()
+        if cached_state is None and self._unsaved_ops > 0:
+            self._save_view()
+        return (self.generation(), self.index())
+
+    def _read_log(self, machine_id, offset, merged_seq):
+        """Reads the operations appended to a machine's log after an offset
+        NOTE: If the machine started its log over since the offset was read, which shows as the log being shorter than the
+        offset or its operations not following on from the last one merged, the log is read from the start instead
+
+        Keyword Args:
+        machine_id -- id of machine whose log to read
+        offset -- number of bytes already read
+        merged_seq -- sequence number of the last operation of the log already merged, or -1 if none were
+
+        Return:
+        Tuple of (new offset, list of (ordering key, operation) tuples)
+        """
+        log_fp = self._backend.open(self._log_filepath(machine_id), "rb")
+        try:
+            log_fp.seek(0, os.SEEK_END)
+            if log_fp.tell() < offset:
+                offset = 0
+            log_fp.seek(offset)
+            num_bytes, ops = _parse_ops(machine_id, log_fp.read(), merged_seq)
+            if offset > 0 and len(ops) > 0 and ops[0][0][2] != merged_seq + 1:
+                offset = 0
+                log_fp.seek(offset)
+                num_bytes, ops = _parse_ops(machine_id, log_fp.read(), merged_seq)
+        finally:
+            log_fp.close()
+        return (offset + num_bytes, ops)
+
+    def _read_new_ops(self, offsets, merged_seqs):
+        """Reads operations appended to every log after the given offsets
+
+        Keyword Args:
+        offsets -- dict of machine id -> number of bytes already read
+        merged_seqs -- dict of machine id -> sequence number of the last operation of its log already merged
+
+        Return:
+        Tuple of (list of (ordering key, operation) tuples, dict of machine id -> new offset)
+        """
+        new_ops = []
+        new_offsets = dict(offsets)
+        for filename in self._backend.listdir(self._log_dirpath):
+            if not filename.endswith(_LOG_SUFFIX) or filename.startswith("."):
+                continue
+            machine_id = filename[:-len(_LOG_SUFFIX)]
+            new_offsets[machine_id], log_ops = self._read_log(machine_id, offsets.get(machine_id, 0), merged_seqs.get(machine_id, -1))
+            new_ops.extend(log_ops)
+            if machine_id == self._machine_id and len(log_ops) > 0:
+                self._next_seq = max(self._next_seq, log_ops[-1][0][2] + 1)
+        return (new_ops, new_offsets)
+
+    def _merge_seqs(self, ops):
+        """Records the operations given as merged, by their machines' sequence numbers"""
+        for (_, machine_id, seq), _ in ops:
+            self._merged_seqs[machine_id] = max(self._merged_seqs.get(machine_id, -1), seq)
+
+    def _replay(self, ops):
+        """Rebuilds the view from the base index and the given operations, which must be sorted"""
+        self._view = copy.deepcopy(dict([(resource_name, _normalize(resource_info)) for resource_name, resource_info in self._base_index.items()]))
+        for _, op in ops:
+            _apply(self._view, op)
+        self._merged_seqs = dict(self._folded_seqs)
+        self._merge_seqs(ops)
+        self._num_ops = len(ops)
+        self._last_key = ops[-1][0] if len(ops) > 0 else None
+        self._unsaved_ops += len(ops)
+
+    def refresh(self):
+        """Merges operations appended to any log since the last merge
+        NOTE: Operations normally sort after everything merged before, so they are applied on top of the view; if one
+        sorts earlier, e.g. because it was logged offline, every log is replayed from the base index instead. The view is
+        cached after a replay, or once enough operations were merged since it was last cached
+
+        Return:
+        Number of operations merged
+        """
+        new_ops, new_offsets = self._read_new_ops(self._offsets, self._merged_seqs)
+        if len(new_ops) == 0:
+            return 0
+        new_ops.sort()
+        replayed = self._last_key is not None and new_ops[0][0] <= self._last_key
+        if replayed:
+            all_ops, new_offsets = self._read_new_ops(dict(), self._folded_seqs)
+            all_ops.sort()
+            self._replay(all_ops)
+        else:
+            for _, op in new_ops:
+                _apply(self._view, op)
+            self._merge_seqs(new_ops)
+            self._num_ops += len(new_ops)
+            self._last_key = new_ops[-1][0]
+            self._unsaved_ops += len(new_ops)
+        self._offsets = new_offsets
+        if replayed or self._unsaved_ops >= _VIEW_SAVE_INTERVAL:
+            self._save_view()
+        return len(new_ops)
+
+    def _save_view(self):
+        """Caches the merged view so the next load only reads operations logged since
+        NOTE: The base index isn't cached, since every load reads it from the index file anyway
+        """
+        self._unsaved_ops = 0
+        if self._view_filepath is None:
+            return
+        view_dirpath = os.path.dirname(self._view_filepath)
+        if not self._backend.isdir(view_dirpath):
+            self._backend.makedirs(view_dirpath)
+        cached_state = {
+            "base generation" : self._base_generation,
+            "view" : self._view,
+            "offsets" : self._offsets,
+            "merged seqs" : self._merged_seqs,
+            "last key" : self._last_key,
+            "num ops" : self._num_ops,
+            "next seq" : self._next_seq
+        }
+        # Pickled in memory first, since pickling straight to a file object writes it in many small chunks
+        self._backend.atomic_write(self._view_filepath, lambda view_fp: view_fp.write(pickle.dumps(cached_state, pickle.HIGHEST_PROTOCOL)))
+
+    def rebase(self, base_generation, base_index, folded_seqs):
+        """Applies the logs on top of a new base index holding every operation merged so far, as written when compacting them
+
+        Keyword Args:
+        base_generation -- generation of the new base index, which must be this view's generation
+        base_index -- dict of resource names -> serialized resource info in the new base index
+        folded_seqs -- dict of machine id -> sequence number of the last operation of its log folded into the new base index
+        """
+        self._base_generation = base_generation
+        self._base_index = base_index
+        self._folded_seqs = dict(folded_seqs)
+        self._replay([])
+        self._save_view()
+
+    def base_generation(self):
+        """Gets the generation of the index file the logs apply on top of"""
+        return self._base_generation
+
+    def num_unfolded_ops(self):
+        """Gets the number of operations merged on top of the base index"""
+        return self._num_ops
+
+    def merged_seqs(self):
+        """Gets the sequence number of the last operation of each machine's log merged
+
+        Return:
+        Dict of machine id -> sequence number
+        """
+        return dict(self._merged_seqs)
+
+    def diff(self, resource_name, resource_info):
+        """Gets the operations turning a resource's merged entry into the given one
+
+        Keyword Args:
+        resource_name -- name of resource
+        resource_info -- serialized resource info, or None if the resource was deleted
+
+        Return:
+        List of operations, without sequence numbers or timestamps
+        """
+        return _diff(resource_name, self._view.get(resource_name), _normalize(resource_info) if resource_info is not None else None)
+
+    def append(self, ops):
+        """Appends operations to this machine's log and merges them, along with anything other logs gained
+
+        Keyword Args:
+        ops -- list of operations from diff
+
+        Return:
+        Tuple of (number of operations merged from elsewhere, number of bytes appended)
+        """
+        log_filepath = self._log_filepath(self._machine_id)
+        with self._backend.exclusive_lock(log_filepath):
+            num_merged = self.refresh()
+            if len(ops) == 0:
+                return (num_merged, 0)
+            # Start this machine's log over once the base index holds every operation in it
+            if self._folded_seqs.get(self._machine_id, -1) >= self._next_seq - 1 and self._backend.isfile(log_filepath):
+                self._backend.remove(log_filepath)
+                self._offsets[self._machine_id] = 0
+            timestamp = time.time()
+            if self._last_key is not None and timestamp < self._last_key[0] + _MIN_CLOCK_STEP:
+                timestamp = self._last_key[0] + _MIN_CLOCK_STEP
+            lines = []
+            for op in ops:
+                op = dict(op)
+                op[_OP_KEY_SEQUENCE] = self._next_seq
+                op[_OP_KEY_TIMESTAMP] = timestamp
+                self._next_seq += 1
+                lines.append(json.dumps(op, sort_keys=True) + "\n")
+            log_bytes = "".join(lines).encode("utf-8")
+            self._backend.append(log_filepath, log_bytes)
+            self.refresh()
+        return (num_merged, len(log_bytes))
+
+    def parent_dirname(self, resource_name):
+        """Gets the parent directory of the resource a name stands for in the merged view
+
+        Keyword Args:
+        resource_name -- name of resource
+
+        Return:
+        Name of the resource's parent directory, or None if the view has no resource of that name
+        """
+        resource_info = self._view.get(resource_name)
+        return resource_info[unbox_records._RSRC_INFO_KEY_PARENT_DIRNAME] if resource_info is not None else None
+
+    def matches(self, resource_name, resource_info):
+        """Checks if a resource's merged index entry equals the given one
+
+        Keyword Args:
+        resource_name -- name of resource
+        resource_info -- serialized resource info, or None for a deleted resource
+        """
+        merged_info = self._view.get(resource_name)
+        merged_info = _materialize(merged_info) if merged_info is not None else None
+        return merged_info == (_normalize(resource_info) if resource_info is not None else None)
+
+    def generation(self):
+        """Gets the generation of the merged index, which increases with every operation merged"""
+        return self._base_generation + self._num_ops
+
+    def index(self):
+        """Gets the merged index
+
+        Return:
+        Dict of resource names -> serialized resource info, sharing nothing with the view
+        """
+        index = dict()
+        for resource_name, resource_info in self._view.items():
+            resource_info = _materialize(resource_info)
+            if resource_info is not None:
+                index[resource_name] = copy.deepcopy(resource_info)
+        return index
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import socket
+
+import unbox_links
+import unbox_lock
+
+# Keys in a profile's settings in the 'profiles' section of config.json
+_PROFILE_KEY_HOSTS = "hosts"                    # Hostnames the profile is selected on by default
+_PROFILE_KEY_ROLES = "roles"                    # Names of other profiles whose settings this one builds on
+_PROFILE_KEY_RESOURCES = "resources"            # Glob patterns of resources to link
+_PROFILE_KEY_LINKS = "links"                    # Mapping of resource names -> link paths, overriding the link directory
+_PROFILE_KEY_LINK_DIRECTORY = "link directory"  # Directory to link resources into under their own names
+_PROFILE_KEY_STRATEGY = "strategy"              # How to materialize the links; one of the unbox_links.STRATEGY_* constants
+
+# Directory links are placed in when no profile along the role chain names one
+_DEFAULT_LINK_DIRECTORY = "~"
+
+# Keys in a cached link plan file
+_PLAN_KEY_GENERATION = "generation"
+_PLAN_KEY_FINGERPRINT = "fingerprint"
+_PLAN_KEY_LINKS = "links"
+
+"""
+Picks the profile to use on this machine
+- profiles: mapping of profile names -> profile settings
+- profile_name: name of profile to use, or None to pick the one listing this machine's hostname
+- hostname: hostname to match against, or None for this machine's hostname
+- RETURN: name of the selected profile
+"""
+def select_profile(profiles, profile_name=None, hostname=None):
+    if profile_name is not None:
+        if profile_name not in profiles:
+            raise ValueError("Cannot select profile; no profile named '" + profile_name + "'")
+        return profile_name
+    if hostname is None:
+        hostname = socket.gethostname()
+    matches = [name for name, settings in sorted(profiles.items()) if hostname in settings.get(_PROFILE_KEY_HOSTS, [])]
+    if len(matches) != 1:
+        raise ValueError("Cannot select profile; " + str(len(matches)) + " profiles list host '" + hostname + "'")
+    return matches[0]
+
+"""
+Flattens a profile and the roles it builds on into a single set of settings
+NOTE: Roles are applied in order before the profile itself, so later settings override earlier ones
+- profiles: mapping of profile names -> profile settings
+- profile_name: name of profile to resolve
+- RETURN: dict of resolved settings with every profile key present
+"""
+def resolve_profile(profiles, profile_name, _resolving=()):
+    if profile_name not in profiles:
+        raise ValueError("Cannot resolve profile; no profile named '" + profile_name + "'")
+    if profile_name in _resolving:
+        raise ValueError("Cannot resolve profile; roles of '" + profile_name + "' form a cycle")
+    resolved = {
+        _PROFILE_KEY_RESOURCES : [],
+        _PROFILE_KEY_LINKS : dict(),
+        _PROFILE_KEY_LINK_DIRECTORY : _DEFAULT_LINK_DIRECTORY,
+        _PROFILE_KEY_STRATEGY : unbox_links.STRATEGY_SYMLINK
+    }
+    settings = profiles[profile_name]
+    for role_name in settings.get(_PROFILE_KEY_ROLES, []):
+        _merge_settings(resolved, resolve_profile(profiles, role_name, _resolving + (profile_name,)))
+    _merge_settings(resolved, settings)
+    if resolved[_PROFILE_KEY_STRATEGY] not in unbox_links.STRATEGIES:
+        raise ValueError("Cannot resolve profile; unknown link strategy '" + str(resolved[_PROFILE_KEY_STRATEGY]) + "'")
+    return resolved
+
+"""
+Layers profile settings over already-resolved settings
+- resolved: resolved settings to update
+- settings: profile settings to layer on top
+"""
+def _merge_settings(resolved, settings):
+    for pattern in settings.get(_PROFILE_KEY_RESOURCES, []):
+        if pattern not in resolved[_PROFILE_KEY_RESOURCES]:
+            resolved[_PROFILE_KEY_RESOURCES].append(pattern)
+    resolved[_PROFILE_KEY_LINKS].update(settings.get(_PROFILE_KEY_LINKS, dict()))
+    for key in (_PROFILE_KEY_LINK_DIRECTORY, _PROFILE_KEY_STRATEGY):
+        if key in settings:
+            resolved[key] = settings[key]
+
+"""
+Gets a fingerprint of resolved profile settings, so a cached plan is dropped when the profile is edited
+- resolved: resolved profile settings
+- RETURN: hex digest string
+"""
+def profile_fingerprint(resolved):
+    return hashlib.sha256(json.dumps(resolved, sort_keys=True).encode("utf-8")).hexdigest()
+
+"""
+Works out which links a profile wants from the resources currently in Dropbox
+- dropbox_module: DropboxModule to look resources up in
+- resolved: resolved profile settings
+- RETURN: list of (resource name, absolute link path, strategy) tuples sorted by resource name
+"""
+def compile_link_plan(dropbox_module, resolved):
+    resource_names = set()
+    for pattern in resolved[_PROFILE_KEY_RESOURCES]:
+        resource_names.update(dropbox_module.find_resources(pattern))
+    resource_names.update([resource_name for resource_name in resolved[_PROFILE_KEY_LINKS] if dropbox_module.resource_exists(resource_name)])
+    link_dirpath = resolved[_PROFILE_KEY_LINK_DIRECTORY]
+    plan = []
+    for resource_name in sorted(resource_names):
+        link_path = resolved[_PROFILE_KEY_LINKS].get(resource_name, os.path.join(link_dirpath, resource_name))
+        plan.append((resource_name, os.path.abspath(os.path.expanduser(link_path)), resolved[_PROFILE_KEY_STRATEGY]))
+    return plan
+
+"""
+Reads a cached link plan if it was compiled from the same index generation and profile settings
+- plan_filepath: path to the cached plan file
+- generation: current generation of the Dropbox index
+- fingerprint: fingerprint of the current resolved profile settings
+- RETURN: list of (resource name, link path, strategy) tuples, or None if there is no usable cached plan
+"""
+def load_link_plan(plan_filepath, generation, fingerprint):
+    if not os.path.isfile(plan_filepath):
+        return None
+    plan_fp = open(plan_filepath)
+    try:
+        cached_plan = json.load(plan_fp)
+    except ValueError:
+        return None
+    finally:
+        plan_fp.close()
+    if cached_plan.get(_PLAN_KEY_GENERATION) != generation or cached_plan.get(_PLAN_KEY_FINGERPRINT) != fingerprint:
+        return None
+    return [tuple(link) for link in cached_plan[_PLAN_KEY_LINKS]]
+
+"""
+Caches a compiled link plan
+- plan_filepath: path to the cached plan file
+- generation: generation of the Dropbox index the plan was compiled from
+- fingerprint: fingerprint of the resolved profile settings the plan was compiled from
+- plan: list of (resource name, link path, strategy) tuples
+"""
+def save_link_plan(plan_filepath, generation, fingerprint, plan):
+    cached_plan = {
+        _PLAN_KEY_GENERATION : generation,
+        _PLAN_KEY_FINGERPRINT : fingerprint,
+        _PLAN_KEY_LINKS : [list(link) for link in plan]
+    }
+    plan_dirpath = os.path.dirname(plan_filepath)
+    if not os.path.isdir(plan_dirpath):
+        os.makedirs(plan_dirpath)
+    unbox_lock.atomic_write(plan_filepath, lambda plan_fp: plan_fp.write(json.dumps(cached_plan, indent=4).encode("utf-8")))
@@ -0,0 +1,218 @@
+import os
+import sys
+
+import unbox_links
+
+# Keys used when serializing resource records into the Dropbox index
+_RSRC_INFO_KEY_PARENT_DIRNAME = "parent_dirname"
+_RSRC_INFO_KEY_VERSIONS_INFO = "versions_info"
+_RSRC_INFO_KEY_CURRENT_VERSION = "current_version"
+_RSRC_INFO_KEY_TEMPLATE = "template"
+
+# Keys used when serializing version records into the Dropbox index
+_VERSION_INFO_KEY_DEPENDENCIES = "dependencies"
+_VERSION_INFO_KEY_CHECKSUMS = "checksums"
+
+# Keys used when serializing link records into the local index
+_LINK_INFO_KEY_LINKTARGET = "link_target"
+_LINK_INFO_KEY_NAME = "resource_name"
+_LINK_INFO_KEY_VERSION = "resource_version"
+_LINK_INFO_KEY_IGNORENEW = "ignore_new_versions"
+_LINK_INFO_KEY_STRATEGY = "strategy"
+_LINK_INFO_KEY_CONTENT_HASH = "content_hash"
+_LINK_INFO_KEY_CONTENT_STATS = "content_stats"
+
+# Keys used when serializing backup records with checksums into the backup index
+_BACKUP_INFO_KEY_DIRNAME = "dirname"
+_BACKUP_INFO_KEY_CHECKSUMS = "checksums"
+
+"""
+Interns a name or path component so that repeated values share a single string object
+- value: string to intern
+- RETURN: interned string, or the value itself if it cannot be interned (e.g. non-ASCII unicode under Python 2)
+"""
+def intern_string(value):
+    if sys.version_info[0] < 3 and isinstance(value, unicode):
+        try:
+            value = value.encode("ascii")
+        except UnicodeError:
+            return value
+    try:
+        return intern(value) if sys.version_info[0] < 3 else sys.intern(value)
+    except TypeError:
+        return value
+
+class VersionRecord(object):
+    """In-memory record of a single resource version"""
+
+    __slots__ = ("dependencies", "checksums")
+
+    def __init__(self, dependencies=None, checksums=None):
+        """Instantiates a version record
+
+        Keyword Args:
+        dependencies -- set of dependencies the version needs (default: none)
+        checksums -- dict of file paths relative to the version directory -> scrub checksum entries (default: not yet recorded)
+        """
+        self.dependencies = set([intern_string(dependency) for dependency in dependencies]) if dependencies else set()
+        self.checksums = checksums
+
+    def serialize(self):
+        """Gets the version's index entry in the nested-dict index format
+        NOTE: Versions never scrubbed leave out the checksums, so their entries match the older index format
+        """
+        version_info = {
+            _VERSION_INFO_KEY_DEPENDENCIES : set(self.dependencies)
+        }
+        if self.checksums is not None:
+            version_info[_VERSION_INFO_KEY_CHECKSUMS] = self.checksums
+        return version_info
+
+    @classmethod
+    def deserialize(cls, version_info):
+        """Builds a version record from its nested-dict index entry"""
+        return cls(version_info[_VERSION_INFO_KEY_DEPENDENCIES], version_info.get(_VERSION_INFO_KEY_CHECKSUMS))
+
+class ResourceRecord(object):
+    """In-memory record of a resource stored in Dropbox"""
+
+    __slots__ = ("parent_dirname", "current_version", "versions", "template")
+
+    def __init__(self, parent_dirname, current_version, versions=None, template=False):
+        """Instantiates a resource record
+
+        Keyword Args:
+        parent_dirname -- name of directory containing all versions of the resource
+        current_version -- version the 'current' symlink points to
+        versions -- dict of version names -> VersionRecord (default: empty)
+        template -- whether links get the resource rendered with each machine's template variables (default: False)
+        """
+        self.parent_dirname = intern_string(parent_dirname)
+        self.current_version = intern_string(current_version)
+        self.versions = dict()
+        for version, version_record in (versions or dict()).items():
+            self.versions[intern_string(version)] = version_record
+        self.template = template
+
+    def serialize(self):
+        """Gets the resource's index entry in the nested-dict index format
+        NOTE: Only templates carry the template flag, so other entries match the older index format
+        """
+        resource_info = {
+            _RSRC_INFO_KEY_PARENT_DIRNAME : self.parent_dirname,
+            _RSRC_INFO_KEY_VERSIONS_INFO : dict([(version, version_record.serialize()) for version, version_record in self.versions.items()]),
+            _RSRC_INFO_KEY_CURRENT_VERSION : self.current_version
+        }
+        if self.template:
+            resource_info[_RSRC_INFO_KEY_TEMPLATE] = True
+        return resource_info
+
+    @classmethod
+    def deserialize(cls, resource_info):
+        """Builds a resource record from its nested-dict index entry"""
+        versions = dict([(version, VersionRecord.deserialize(version_info))
+                for version, version_info in resource_info[_RSRC_INFO_KEY_VERSIONS_INFO].items()])
+        return cls(resource_info[_RSRC_INFO_KEY_PARENT_DIRNAME], resource_info[_RSRC_INFO_KEY_CURRENT_VERSION], versions,
+                resource_info.get(_RSRC_INFO_KEY_TEMPLATE, False))
+
+class LinkRecord(object):
+    """In-memory record of a local link to a resource
+    NOTE: The link target is stored as an interned directory plus basename, since many targets share directories
+    """
+
+    __slots__ = ("_target_dirpath", "_target_basename", "resource_name", "resource_version", "ignore_new", "strategy", "content_hash", "content_stats")
+
+    def __init__(self, link_target, resource_name, resource_version, ignore_new, strategy=unbox_links.STRATEGY_SYMLINK, content_hash=None,
+            content_stats=None):
+        """Instantiates a link record
+
+        Keyword Args:
+        link_target -- path the link points to
+        resource_name -- name of resource the link points to
+        resource_version -- version of resource the link points to
+        ignore_new -- whether the link ignores new resource versions
+        strategy -- how the resource is materialized at the link path (default: symlink)
+        content_hash -- hash of the resource content last materialized, for non-symlink strategies (default: none)
+        content_stats -- [link path, link target] stat signatures taken when the content was last materialized, which the
+            content hash still holds for while they match (default: none, so the content must be hashed)
+        """
+        self.link_target = link_target
+        self.resource_name = intern_string(resource_name)
+        self.resource_version = intern_string(resource_version)
+        self.ignore_new = ignore_new
+        self.strategy = intern_string(strategy)
+        self.content_hash = content_hash
+        self.content_stats = content_stats
+
+    def _get_link_target(self):
+        return os.path.join(self._target_dirpath, self._target_basename)
+
+    def _set_link_target(self, link_target):
+        target_dirpath, target_basename = os.path.split(link_target)
+        self._target_dirpath = intern_string(target_dirpath)
+        self._target_basename = intern_string(target_basename)
+
+    # Path the link points to
+    link_target = property(_get_link_target, _set_link_target)
+
+    def serialize(self):
+        """Gets the link's entry in the local index file format
+        NOTE: Symlinks leave out the strategy and content hash, so their entries match the older index format
+        """
+        link_info = {
+            _LINK_INFO_KEY_LINKTARGET : self.link_target,
+            _LINK_INFO_KEY_NAME : self.resource_name,
+            _LINK_INFO_KEY_VERSION : self.resource_version,
+            _LINK_INFO_KEY_IGNORENEW : self.ignore_new
+        }
+        if self.strategy != unbox_links.STRATEGY_SYMLINK:
+            link_info[_LINK_INFO_KEY_STRATEGY] = self.strategy
+            link_info[_LINK_INFO_KEY_CONTENT_HASH] = self.content_hash
+            if self.content_stats is not None:
+                link_info[_LINK_INFO_KEY_CONTENT_STATS] = self.content_stats
+        return link_info
+
+    @classmethod
+    def deserialize(cls, link_info):
+        """Builds a link record from its local index file entry"""
+        return cls(
+                link_info[_LINK_INFO_KEY_LINKTARGET],
+                link_info[_LINK_INFO_KEY_NAME],
+                link_info[_LINK_INFO_KEY_VERSION],
+                link_info[_LINK_INFO_KEY_IGNORENEW],
+                link_info.get(_LINK_INFO_KEY_STRATEGY, unbox_links.STRATEGY_SYMLINK),
+                link_info.get(_LINK_INFO_KEY_CONTENT_HASH),
+                link_info.get(_LINK_INFO_KEY_CONTENT_STATS))
+
+class BackupRecord(object):
+    """In-memory record of a file object moved into the backup system"""
+
+    __slots__ = ("dirname", "checksums")
+
+    def __init__(self, dirname, checksums=None):
+        """Instantiates a backup record
+
+        Keyword Args:
+        dirname -- name of the directory in the backup directory holding the file object
+        checksums -- dict of file paths relative to that directory -> scrub checksum entries (default: not yet recorded)
+        """
+        self.dirname = intern_string(dirname)
+        self.checksums = checksums
+
+    def serialize(self):
+        """Gets the backup's entry in the backup index file format
+        NOTE: Backups never scrubbed are stored as the bare directory name, as in the older index format
+        """
+        if self.checksums is None:
+            return self.dirname
+        return {
+            _BACKUP_INFO_KEY_DIRNAME : self.dirname,
+            _BACKUP_INFO_KEY_CHECKSUMS : self.checksums
+        }
+
+    @classmethod
+    def deserialize(cls, backup_info):
+        """Builds a backup record from its backup index file entry"""
+        if isinstance(backup_info, dict):
+            return cls(backup_info[_BACKUP_INFO_KEY_DIRNAME], backup_info[_BACKUP_INFO_KEY_CHECKSUMS])
+        return cls(backup_info)
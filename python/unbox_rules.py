@@ -0,0 +1,186 @@
+import fnmatch
+import hashlib
+import json
+import os
+import re
+
+import unbox_lock
+
+# Separator between a rule's pattern and its link destination template, as in .dropconfig files
+_RULE_SEPARATOR = "=>"
+
+# Prefix marking a rule's pattern as a regular expression rather than a glob
+_REGEX_PREFIX = "re:"
+
+# Most groups a single combined expression may hold; Python 2's re module refuses patterns with 100 or more
+_MAX_GROUPS_PER_CHUNK = 99
+
+# Keys in the mapping cache file
+_CACHE_KEY_RULES_HASH = "rules hash"
+_CACHE_KEY_MAPPINGS = "mappings"
+
+# Maps rule file hash -> LinkRules compiled from it, so each rule file is only compiled once per process
+_compiled_rules = dict()
+
+class LinkRules(object):
+    """Ordered rules mapping resource names to link destinations, compiled into a few combined regular expressions
+    NOTE: Like a shell 'case' statement, the first rule matching a name wins
+    """
+
+    def __init__(self, rules):
+        """Compiles rules into combined matchers
+
+        Keyword Args:
+        rules -- list of (compiled pattern, link destination template) tuples in priority order
+        """
+        self._templates = [template for _, template in rules]
+
+        # List of (combined pattern, dict of outer group index -> (rule index, number of the rule's own groups))
+        self._chunks = []
+        chunk_alternatives = []
+        chunk_group_names = set()
+        chunk_rules = dict()
+        for rule_idx, (pattern, _) in enumerate(rules):
+            chunk_groups = sum([num_groups + 1 for _, num_groups in chunk_rules.values()])
+            if len(chunk_alternatives) > 0 and (chunk_groups + pattern.groups + 1 > _MAX_GROUPS_PER_CHUNK
+                    or len(chunk_group_names.intersection(pattern.groupindex)) > 0):
+                self._chunks.append((re.compile("|".join(chunk_alternatives)), chunk_rules))
+                chunk_alternatives = []
+                chunk_group_names = set()
+                chunk_rules = dict()
+                chunk_groups = 0
+            chunk_alternatives.append("((?:" + pattern.pattern + ")\\Z)")
+            chunk_group_names.update(pattern.groupindex)
+            chunk_rules[chunk_groups + 1] = (rule_idx, pattern.groups)
+        if len(chunk_alternatives) > 0:
+            self._chunks.append((re.compile("|".join(chunk_alternatives)), chunk_rules))
+
+    def match(self, resource_name):
+        """Finds the link destination of the first rule matching a resource name
+
+        Keyword Args:
+        resource_name -- name of resource
+
+        Return:
+        Link destination with the rule's template filled in, or None if no rule matches
+        """
+        for combined_pattern, chunk_rules in self._chunks:
+            match = combined_pattern.match(resource_name)
+            if match is None:
+                continue
+
+            # The outer group of the matching rule closes last, so it is the match's last group
+            rule_idx, num_groups = chunk_rules[match.lastindex]
+            groups = [group or "" for group in match.groups()[match.lastindex:match.lastindex + num_groups]]
+            named_groups = dict([(group_name, value or "") for group_name, value in match.groupdict().items()
+                    if match.lastindex < combined_pattern.groupindex[group_name] <= match.lastindex + num_groups])
+            named_groups.setdefault("name", resource_name)
+            template = self._templates[rule_idx]
+            try:
+                return template.format(resource_name, *groups, **named_groups)
+            except (IndexError, KeyError) as e:
+                raise ValueError("Cannot map resource '" + resource_name + "'; template '" + template + "' refers to missing group " + str(e))
+        return None
+
+    def map_names(self, resource_names):
+        """Matches many resource names in a single pass
+
+        Keyword Args:
+        resource_names -- iterable of resource names
+
+        Return:
+        Dict of resource name -> link destination, or None for names no rule matches
+        """
+        match = self.match
+        return dict([(resource_name, match(resource_name)) for resource_name in resource_names])
+
+"""
+Converts a glob pattern to a regular expression without anchors or inline flags, so it can be combined with others
+- glob: glob pattern
+- RETURN: regular expression string
+"""
+def _glob_to_regex(glob):
+    translated = fnmatch.translate(glob)
+    if translated.endswith("\\Z(?ms)"):
+        return translated[:-len("\\Z(?ms)")]
+    return translated[:-len("\\Z")]
+
+"""
+Compiles the text of a rule file
+NOTE: Each non-blank line not starting with '#' is a rule '<pattern> => <link destination template>'. Patterns are globs,
+or regular expressions when prefixed with 're:'; these must not use numbered backreferences or inline flags like '(?i)',
+which would apply to every rule they are combined with. Templates are filled in with
+str.format, where {name} and {0} are the resource name and {1}, {2}... and named groups are the regular expression's groups
+- rules_text: contents of the rule file
+- RETURN: LinkRules
+"""
+def parse_rules(rules_text):
+    rules = []
+    for line_number, line in enumerate(rules_text.splitlines(), 1):
+        line = line.strip()
+        if len(line) == 0 or line.startswith("#"):
+            continue
+        if _RULE_SEPARATOR not in line:
+            raise ValueError("Cannot compile link rules; line " + str(line_number) + " has no '" + _RULE_SEPARATOR + "'")
+        pattern_text, template = [part.strip() for part in line.split(_RULE_SEPARATOR, 1)]
+        if pattern_text.startswith(_REGEX_PREFIX):
+            pattern_text = pattern_text[len(_REGEX_PREFIX):]
+        else:
+            pattern_text = _glob_to_regex(pattern_text)
+        try:
+            pattern = re.compile(pattern_text)
+        except re.error as e:
+            raise ValueError("Cannot compile link rules; line " + str(line_number) + " has an invalid pattern: " + str(e))
+        if pattern.flags != re.compile(pattern_text[:0]).flags:
+            raise ValueError("Cannot compile link rules; line " + str(line_number) + " sets an inline flag, which would apply to other rules")
+        if pattern.groups + 1 > _MAX_GROUPS_PER_CHUNK:
+            raise ValueError("Cannot compile link rules; line " + str(line_number) + " has too many groups")
+        rules.append((pattern, template))
+    return LinkRules(rules)
+
+"""
+Reads and compiles a rule file, reusing the compiled rules if a file with the same contents was loaded before
+- rules_filepath: path to the rule file
+- RETURN: tuple of (hex digest of the rule file's contents, LinkRules)
+"""
+def load_rules(rules_filepath):
+    rules_fp = open(rules_filepath, "rb")
+    rules_bytes = rules_fp.read()
+    rules_fp.close()
+    rules_hash = hashlib.sha256(rules_bytes).hexdigest()
+    if rules_hash not in _compiled_rules:
+        _compiled_rules[rules_hash] = parse_rules(rules_bytes.decode("utf-8"))
+    return (rules_hash, _compiled_rules[rules_hash])
+
+"""
+Maps resource names to link destinations with a rule file, only matching names the cached mapping doesn't already cover
+NOTE: The cache is dropped whenever the rule file's contents change, and only keeps the names of the latest call
+- rules_filepath: path to the rule file
+- resource_names: iterable of resource names
+- cache_filepath: path to the file caching the mapping
+- RETURN: dict of resource name -> link destination, or None for names no rule matches
+"""
+def map_resources(rules_filepath, resource_names, cache_filepath):
+    rules_hash, rules = load_rules(rules_filepath)
+    resource_names = set(resource_names)
+
+    cached_mappings = dict()
+    with unbox_lock.shared_lock(cache_filepath):
+        if os.path.isfile(cache_filepath):
+            cache_fp = open(cache_filepath)
+            try:
+                cache = json.load(cache_fp)
+            except ValueError:
+                cache = dict()
+            finally:
+                cache_fp.close()
+            if cache.get(_CACHE_KEY_RULES_HASH) == rules_hash:
+                cached_mappings = cache[_CACHE_KEY_MAPPINGS]
+
+    mappings = dict([(resource_name, cached_mappings[resource_name]) for resource_name in resource_names if resource_name in cached_mappings])
+    mappings.update(rules.map_names([resource_name for resource_name in resource_names if resource_name not in mappings]))
+    if set(cached_mappings) != resource_names:
+        cache = { _CACHE_KEY_RULES_HASH : rules_hash, _CACHE_KEY_MAPPINGS : mappings }
+        with unbox_lock.exclusive_lock(cache_filepath):
+            unbox_lock.atomic_write(cache_filepath, lambda cache_fp: cache_fp.write(json.dumps(cache, sort_keys=True).encode("utf-8")))
+    return mappings
@@ -0,0 +1,208 @@
+import bisect
+import hashlib
+import json
+import os
+import stat
+import time
+
+import unbox_lock
+
+# Outcomes of scrubbing a stored version or backup, from least to most serious
+SCRUB_OK = "ok"                 # Every file matches its recorded checksum
+SCRUB_RECORDED = "recorded"     # No checksums were recorded yet, so the current contents were recorded
+SCRUB_MODIFIED = "modified"     # Files of an editable item were added or edited through their links, changing size or mtime; their new checksums were recorded
+SCRUB_MISSING = "missing"       # Files, or the whole directory, disappeared
+SCRUB_CORRUPT = "corrupt"       # File contents changed without their size or mtime changing, or changed at all in an item nothing should edit
+_SCRUB_OUTCOMES = (SCRUB_OK, SCRUB_RECORDED, SCRUB_MODIFIED, SCRUB_MISSING, SCRUB_CORRUPT)
+
+# Size of the chunks files are hashed in, and of each throttled read
+_HASH_CHUNK_SIZE = 1 << 20
+
+# Keys in the scrub state file
+_STATE_KEY_CURSOR = "cursor"
+_STATE_KEY_PASSES = "passes"
+_STATE_KEY_RESULTS = "results"
+
+class Throttle(object):
+    """Limits the rate of I/O to a bandwidth budget by sleeping between reads"""
+
+    def __init__(self, bytes_per_second=None, clock=time.time, sleep=time.sleep):
+        """Instantiates a throttle
+
+        Keyword Args:
+        bytes_per_second -- bandwidth budget, or None for no limit
+        clock -- function returning the current time in seconds (default: time.time)
+        sleep -- function sleeping for a number of seconds (default: time.sleep)
+        """
+        self.bytes_per_second = bytes_per_second
+        self._clock = clock
+        self._sleep = sleep
+
+        # Time at which the bytes consumed so far are paid for under the budget
+        self._paid_until = None
+
+    def consume(self, num_bytes):
+        """Accounts for bytes read, sleeping as long as needed to stay within the budget
+        NOTE: Idle time isn't saved up, so reads after a pause can't burst above the budget
+
+        Keyword Args:
+        num_bytes -- number of bytes read
+        """
+        if not self.bytes_per_second:
+            return
+        now = self._clock()
+        self._paid_until = max(self._paid_until or now, now) + num_bytes / float(self.bytes_per_second)
+        if self._paid_until > now:
+            self._sleep(self._paid_until - now)
+
+"""
+Hashes a file with buffered reads, one chunk at a time
+NOTE: Files are read rather than memory-mapped, since files edited through links may be truncated while they are hashed,
+which would kill the process with SIGBUS when touching a mapped page past the new end
+- filepath: path of regular file to hash
+- throttle: Throttle to account reads to, or None for no limit
+- RETURN: hex digest string
+"""
+def file_hash(filepath, throttle=None):
+    digest = hashlib.sha256()
+    file_fp = open(filepath, "rb")
+    try:
+        chunk = file_fp.read(_HASH_CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            if throttle is not None:
+                throttle.consume(len(chunk))
+            chunk = file_fp.read(_HASH_CHUNK_SIZE)
+    finally:
+        file_fp.close()
+    return digest.hexdigest()
+
+"""
+Hashes every regular file in a directory and compares the results with recorded checksums
+NOTE: A changed file whose size and whole-second mtime are unchanged is corruption. Otherwise, in an editable item it was
+edited through a link and its new checksum is recorded, while in any other item it is corruption too. Corrupt files keep
+their recorded checksums, and unexpected files aren't recorded, so they are reported until repaired
+- dirpath: path of directory to scrub
+- recorded: dict of relative file paths -> [hex digest, size, whole-second mtime] from the last scrub, or None if never scrubbed
+- throttle: Throttle to account reads to, or None for no limit
+- editable: whether the files may be edited through links, as for a resource's current version; backups and other versions aren't
+- RETURN: tuple of (outcome, dict of checksums to record, list of (outcome, relative path) tuples for files that aren't SCRUB_OK)
+"""
+def scrub_tree(dirpath, recorded, throttle=None, editable=False):
+    if not os.path.isdir(dirpath):
+        return (SCRUB_MISSING, recorded, [(SCRUB_MISSING, "")])
+    checksums = dict()
+    problems = []
+    for walk_dirpath, dirnames, filenames in os.walk(dirpath):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            filepath = os.path.join(walk_dirpath, filename)
+            file_stat = os.lstat(filepath)
+            if not stat.S_ISREG(file_stat.st_mode):
+                continue
+            relative_path = os.path.relpath(filepath, dirpath)
+            entry = [file_hash(filepath, throttle), file_stat.st_size, int(file_stat.st_mtime)]
+            recorded_entry = recorded.get(relative_path) if recorded is not None else None
+            checksums[relative_path] = entry
+            if recorded_entry is None:
+                if recorded is not None and editable:
+                    problems.append((SCRUB_MODIFIED, relative_path))
+                elif recorded is not None:
+                    problems.append((SCRUB_CORRUPT, relative_path))
+                    del checksums[relative_path]
+            elif recorded_entry[0] != entry[0]:
+                if recorded_entry[1:] != entry[1:] and editable:
+                    problems.append((SCRUB_MODIFIED, relative_path))
+                else:
+                    problems.append((SCRUB_CORRUPT, relative_path))
+                    checksums[relative_path] = recorded_entry
+    for relative_path in sorted(set(recorded or dict()) - set(checksums)):
+        problems.append((SCRUB_MISSING, relative_path))
+
+    if recorded is None:
+        return (SCRUB_RECORDED, checksums, problems)
+    outcome = max([SCRUB_OK] + [problem_outcome for problem_outcome, _ in problems], key=_SCRUB_OUTCOMES.index)
+    return (outcome, checksums, problems)
+
+"""
+Reads the scrub state, holding the resumable cursor and the latest result for each scrubbed item
+- state_filepath: path to the scrub state file
+- RETURN: dict of scrub state
+"""
+def load_state(state_filepath):
+    state = { _STATE_KEY_CURSOR : None, _STATE_KEY_PASSES : 0, _STATE_KEY_RESULTS : dict() }
+    with unbox_lock.shared_lock(state_filepath):
+        if os.path.isfile(state_filepath):
+            state_fp = open(state_filepath)
+            try:
+                state.update(json.load(state_fp))
+            except ValueError:
+                pass
+            finally:
+                state_fp.close()
+    return state
+
+"""
+Writes the scrub state
+- state_filepath: path to the scrub state file
+- state: dict of scrub state from load_state
+"""
+def save_state(state_filepath, state):
+    with unbox_lock.exclusive_lock(state_filepath):
+        unbox_lock.atomic_write(state_filepath, lambda state_fp: state_fp.write(json.dumps(state, sort_keys=True).encode("utf-8")))
+
+"""
+Labels a scrub target for the stored results
+- target: tuple identifying the target, e.g. ("version", resource name, version)
+- RETURN: string label
+"""
+def target_label(target):
+    return ":".join(target)
+
+"""
+Scrubs targets in order, resuming after the last target scrubbed by an earlier run and wrapping around after a full pass
+NOTE: The cursor and results are saved at checkpoints, so an interrupted run loses at most one checkpoint interval of work
+- state_filepath: path to the scrub state file
+- targets: sorted list of tuples identifying everything there is to scrub
+- scrub_target: function taking a target and returning a tuple of (outcome, list of (outcome, relative path) problems)
+- commit: function saving checksums recorded by scrub_target since the last call, called before each checkpoint
+- max_seconds: stop starting new targets after this long, or None to finish the pass
+- checkpoint_seconds: how often to save progress
+- RETURN: list of (target, outcome, problems) tuples for the targets scrubbed in this run
+"""
+def run(state_filepath, targets, scrub_target, commit, max_seconds=None, checkpoint_seconds=30):
+    state = load_state(state_filepath)
+    cursor = state[_STATE_KEY_CURSOR]
+    start_idx = 0 if cursor is None else bisect.bisect_right(targets, tuple(cursor))
+    start_time = last_checkpoint_time = time.time()
+    scrubbed = []
+    for target in targets[start_idx:]:
+        if max_seconds is not None and time.time() - start_time >= max_seconds:
+            break
+        outcome, problems = scrub_target(target)
+        scrubbed.append((target, outcome, problems))
+        state[_STATE_KEY_RESULTS][target_label(target)] = [outcome, int(time.time()), problems]
+        state[_STATE_KEY_CURSOR] = list(target)
+        if time.time() - last_checkpoint_time >= checkpoint_seconds:
+            commit()
+            save_state(state_filepath, state)
+            last_checkpoint_time = time.time()
+    else:
+        # Finished a full pass; forget results for targets that no longer exist and start over next time
+        labels = set([target_label(target) for target in targets])
+        state[_STATE_KEY_RESULTS] = dict([(label, result) for label, result in state[_STATE_KEY_RESULTS].items() if label in labels])
+        state[_STATE_KEY_CURSOR] = None
+        state[_STATE_KEY_PASSES] += 1
+    commit()
+    save_state(state_filepath, state)
+    return scrubbed
+
+"""
+Gets the stored result of the latest scrub of every target
+- state_filepath: path to the scrub state file
+- RETURN: tuple of (number of completed passes, sorted list of (target label, outcome, unix time, problems) tuples)
+"""
+def results(state_filepath):
+    state = load_state(state_filepath)
+    return (state[_STATE_KEY_PASSES], sorted([(label, outcome, scrub_time, [tuple(problem) for problem in problems])
+            for label, (outcome, scrub_time, problems) in state[_STATE_KEY_RESULTS].items()]))
@@ -0,0 +1,217 @@
+import bisect
+import fnmatch
+
+# Characters that start a wildcard in a glob pattern
+_GLOB_WILDCARDS = "*?["
+
+# Version components that mean "any value" in a version query
+_VERSION_WILDCARDS = ("x", "X", "*")
+
+# Sort key component greater than any real version component; used as an upper bound for prefix queries
+_VERSION_COMPONENT_MAX = (2,)
+
+"""
+Gets the sort key for a single dot-separated version component
+- component: version component string
+- RETURN: key ordering numeric components numerically and before alphanumeric ones
+"""
+def _version_component_key(component):
+    if component.isdigit():
+        return (0, int(component), "")
+    return (1, 0, component)
+
+"""
+Gets a semantic-version-aware sort key for a version name, so that "1.10" sorts after "1.9" and "2.0-rc1" sorts before "2.0"
+- version: version name
+- RETURN: sort key for the version
+"""
+def version_key(version):
+    main, _, prerelease = version.partition("-")
+    main_key = tuple(_version_component_key(component) for component in main.split("."))
+    if prerelease:
+        prerelease_key = (0, tuple(_version_component_key(component) for component in prerelease.split(".")))
+    else:
+        prerelease_key = (1, ())
+    return (main_key, prerelease_key)
+
+"""
+Sorts version names in semantic-version order
+- versions: iterable of version names
+- RETURN: list of version names, oldest first
+"""
+def sort_versions(versions):
+    return sorted(versions, key=version_key)
+
+class ResourceSearchIndex:
+    """Sorted indexes over resource names and versions for prefix, range, glob and version queries
+
+    Kept up to date incrementally by the owning module instead of being rebuilt per query
+    """
+
+    def __init__(self, resources=()):
+        """Instantiates a search index, sorting the initial resources once rather than inserting them one at a time
+
+        Keyword Args:
+        resources -- iterable of (resource name, iterable of version names) tuples to index (default: none)
+        """
+        names = set()
+        versions = set()
+        for resource_name, resource_versions in resources:
+            names.add(resource_name)
+            for version in resource_versions:
+                versions.add((version_key(version), version, resource_name))
+
+        # Sorted list of resource names
+        self._names = sorted(names)
+
+        # Sorted list of (version sort key, version name, resource name)
+        self._versions = sorted(versions)
+
+
+
+    """ ======= Maintenance Methods ======= """
+    def add_resource(self, resource_name, versions):
+        """Adds a resource and its versions to the index
+
+        Keyword Args:
+        resource_name -- name of resource
+        versions -- iterable of the resource's version names
+        """
+        idx = bisect.bisect_left(self._names, resource_name)
+        if idx == len(self._names) or self._names[idx] != resource_name:
+            self._names.insert(idx, resource_name)
+        for version in versions:
+            self.add_version(resource_name, version)
+
+    def remove_resource(self, resource_name, versions):
+        """Removes a resource and its versions from the index
+
+        Keyword Args:
+        resource_name -- name of resource
+        versions -- iterable of the resource's version names
+        """
+        idx = bisect.bisect_left(self._names, resource_name)
+        if idx < len(self._names) and self._names[idx] == resource_name:
+            del self._names[idx]
+        for version in versions:
+            self.remove_version(resource_name, version)
+
+    def add_version(self, resource_name, version):
+        """Adds a resource version to the index
+
+        Keyword Args:
+        resource_name -- name of resource
+        version -- name of version
+        """
+        entry = (version_key(version), version, resource_name)
+        idx = bisect.bisect_left(self._versions, entry)
+        if idx == len(self._versions) or self._versions[idx] != entry:
+            self._versions.insert(idx, entry)
+
+    def remove_version(self, resource_name, version):
+        """Removes a resource version from the index
+
+        Keyword Args:
+        resource_name -- name of resource
+        version -- name of version
+        """
+        entry = (version_key(version), version, resource_name)
+        idx = bisect.bisect_left(self._versions, entry)
+        if idx < len(self._versions) and self._versions[idx] == entry:
+            del self._versions[idx]
+
+
+
+    """ ======= Query Methods ======= """
+    def names_with_prefix(self, prefix):
+        """Gets resource names starting with the given prefix
+
+        Keyword Args:
+        prefix -- prefix to match
+
+        Return:
+        Sorted list of matching resource names
+        """
+        start = bisect.bisect_left(self._names, prefix)
+        end = start
+        while end < len(self._names) and self._names[end].startswith(prefix):
+            end += 1
+        return self._names[start:end]
+
+    def names_in_range(self, start=None, end=None):
+        """Gets resource names in the half-open range [start, end)
+
+        Keyword Args:
+        start -- lowest name to include (default: no lower bound)
+        end -- name to stop before (default: no upper bound)
+
+        Return:
+        Sorted list of resource names in the range
+        """
+        start_idx = 0 if start is None else bisect.bisect_left(self._names, start)
+        end_idx = len(self._names) if end is None else bisect.bisect_left(self._names, end)
+        return self._names[start_idx:end_idx]
+
+    def names_matching(self, pattern):
+        """Gets resource names matching a glob pattern
+        NOTE: Only names sharing the pattern's literal prefix are tested against the pattern, and a pattern that is a literal
+        prefix followed by '*' is answered by slicing the sorted names without testing any
+
+        Keyword Args:
+        pattern -- glob pattern to match (e.g. ".vim*")
+
+        Return:
+        Sorted list of matching resource names
+        """
+        if pattern.endswith("*") and not any([wildcard in pattern[:-1] for wildcard in _GLOB_WILDCARDS]):
+            return self.names_with_prefix(pattern[:-1])
+        return list(self.iter_names(pattern))
+
+    def iter_names(self, pattern=None):
+        """Lazily yields resource names, optionally only those matching a glob pattern
+        NOTE: Only names sharing the pattern's literal prefix are visited; the index must not change during iteration
+
+        Keyword Args:
+        pattern -- glob pattern to match (default: all resources)
+
+        Return:
+        Generator of resource names in sorted order
+        """
+        if pattern is None:
+            for name in self._names:
+                yield name
+            return
+        prefix_len = len(pattern)
+        for wildcard in _GLOB_WILDCARDS:
+            wildcard_idx = pattern.find(wildcard)
+            if wildcard_idx != -1:
+                prefix_len = min(prefix_len, wildcard_idx)
+        prefix = pattern[:prefix_len]
+        idx = bisect.bisect_left(self._names, prefix)
+        while idx < len(self._names) and self._names[idx].startswith(prefix):
+            name = self._names[idx]
+            if (prefix_len == len(pattern) and name == pattern) or (prefix_len < len(pattern) and fnmatch.fnmatchcase(name, pattern)):
+                yield name
+            idx += 1
+
+    def versions_matching(self, spec):
+        """Gets resource versions matching a version query
+        NOTE: The query is a version prefix, optionally ending in an 'x' or '*' component (e.g. "2", "2.x", "2.1.*")
+
+        Keyword Args:
+        spec -- version query
+
+        Return:
+        List of (resource name, version name) tuples in semantic-version order
+        """
+        if spec == None or len(spec.strip()) == 0:
+            raise ValueError("Cannot query versions; version query is empty")
+        components = []
+        for component in spec.strip().split("."):
+            if component in _VERSION_WILDCARDS:
+                break
+            components.append(_version_component_key(component))
+        prefix = tuple(components)
+        start_idx = bisect.bisect_left(self._versions, ((prefix,),))
+        end_idx = bisect.bisect_left(self._versions, ((prefix + (_VERSION_COMPONENT_MAX,),),))
+        return [(resource_name, version) for _, version, resource_name in self._versions[start_idx:end_idx]]
@@ -0,0 +1,187 @@
+import io
+import json
+import os
+import tarfile
+import time
+
+import unbox_links
+import unbox_metrics
+
+# Name of the archive member describing the snapshot; always the first member
+_MANIFEST_MEMBER_NAME = "manifest.json"
+
+# Directory in the archive holding each resource's data, under its resource name
+_RESOURCES_MEMBER_DIRNAME = "resources"
+
+# Keys in the snapshot manifest
+_MANIFEST_KEY_RESOURCES = "resources"
+_MANIFEST_KEY_LINKS = "links"
+_RSRC_KEY_VERSION = "version"
+_RSRC_KEY_DEPENDENCIES = "dependencies"
+_RSRC_KEY_TEMPLATE = "template"
+_LINK_KEY_LINK_PATH = "link_path"
+_LINK_KEY_RESOURCE_NAME = "resource_name"
+_LINK_KEY_IGNORENEW = "ignore_new"
+_LINK_KEY_STRATEGY = "strategy"
+
+"""
+Replaces the user's home directory at the start of a path with '~' so the path is portable between machines
+- path: absolute path
+- RETURN: path with the home directory contracted
+"""
+def _contract_home(path):
+    home_dirpath = os.path.expanduser("~")
+    if path == home_dirpath or path.startswith(home_dirpath + os.sep):
+        return "~" + path[len(home_dirpath):]
+    return path
+
+"""
+Streams a tar archive of the current version of each selected resource, their index entries and a plan of their links
+NOTE: Resource data is read straight from the Dropbox Unbox directory into the stream; nothing is copied to disk first
+- dropbox_module: DropboxModule to export resources from
+- local_module: LocalModule whose links make up the link plan
+- out_fp: binary file object to write the archive to; may be a pipe
+- resource_names: names of resources to export, or None for every resource
+- RETURN: sorted list of names of exported resources
+"""
+@unbox_metrics.timed("export_snapshot")
+def export_snapshot(dropbox_module, local_module, out_fp, resource_names=None):
+    if resource_names is None:
+        resource_names = dropbox_module.resources_set()
+    resource_names = sorted(set(resource_names))
+    for resource_name in resource_names:
+        if not dropbox_module.resource_exists(resource_name):
+            raise ValueError("Cannot export snapshot; cannot find resource '" + resource_name + "'")
+
+    # Build the manifest of index entries and links
+    manifest_resources = dict()
+    manifest_links = []
+    for resource_name in resource_names:
+        _, current_version, _ = dropbox_module.resource_info(resource_name)
+        manifest_resources[resource_name] = {
+            _RSRC_KEY_VERSION : current_version,
+            _RSRC_KEY_DEPENDENCIES : sorted(dropbox_module.version_info(resource_name, current_version))
+        }
+        if dropbox_module.is_template(resource_name):
+            manifest_resources[resource_name][_RSRC_KEY_TEMPLATE] = True
+        for link_path in sorted(local_module.dependent_links(resource_name)):
+            _, _, _, ignore_new = local_module.link_info(link_path)
+            strategy, _ = local_module.link_strategy(link_path)
+            manifest_links.append({
+                _LINK_KEY_LINK_PATH : _contract_home(link_path),
+                _LINK_KEY_RESOURCE_NAME : resource_name,
+                _LINK_KEY_IGNORENEW : ignore_new,
+                _LINK_KEY_STRATEGY : strategy
+            })
+    manifest = {
+        _MANIFEST_KEY_RESOURCES : manifest_resources,
+        _MANIFEST_KEY_LINKS : manifest_links
+    }
+    manifest_data = json.dumps(manifest, indent=4, sort_keys=True).encode("utf-8")
+
+    # Stream the manifest followed by each resource's data
+    snapshot_tar = tarfile.open(fileobj=out_fp, mode="w|")
+    manifest_tarinfo = tarfile.TarInfo(_MANIFEST_MEMBER_NAME)
+    manifest_tarinfo.size = len(manifest_data)
+    manifest_tarinfo.mtime = int(time.time())
+    snapshot_tar.addfile(manifest_tarinfo, io.BytesIO(manifest_data))
+    resource_paths = dropbox_module.resource_paths([(resource_name, manifest_resources[resource_name][_RSRC_KEY_VERSION])
+            for resource_name in resource_names])
+    for resource_name, resource_path in zip(resource_names, resource_paths):
+        snapshot_tar.add(resource_path, arcname=_RESOURCES_MEMBER_DIRNAME + "/" + resource_name)
+    snapshot_tar.close()
+    return resource_names
+
+"""
+Checks that extracting an archive member can't write outside its version directory
+NOTE: Symlinks must stay inside the version directory, and no member may be written through a symlink extracted before it
+- member: tarfile.TarInfo whose name is relative to the version directory
+- version_dirpath: path to the version directory the member is extracted into
+"""
+def _check_member_path(member, version_dirpath):
+    member_path_components = member.name.split("/")
+    for num_components in range(1, len(member_path_components)):
+        if os.path.islink(os.path.join(version_dirpath, *member_path_components[:num_components])):
+            raise ValueError("Cannot import snapshot; archive member " + member.name + " is inside a symlink")
+    if member.issym():
+        link_target = os.path.normpath(os.path.join(os.path.dirname(member.name), member.linkname))
+        if os.path.isabs(member.linkname) or link_target == os.pardir or link_target.startswith(os.pardir + os.sep):
+            raise ValueError("Cannot import snapshot; symlink " + member.name + " points outside its resource")
+
+"""
+Extracts a snapshot archive straight into the Dropbox Unbox directory and forges its planned links, in one sequential read
+NOTE: Files already sitting at a planned link path are moved into the backup system
+- dropbox_module: DropboxModule to add resources to
+- local_module: LocalModule to create links with
+- in_fp: binary file object to read the archive from; may be a pipe
+- create_links: whether to forge the links in the snapshot's link plan
+- link_target: function taking a resource name and returning the path links to its current version should point at, e.g. a
+template's render, or None to link straight to the resource in Dropbox
+- RETURN: tuple of (sorted list of imported resource names, sorted list of created link paths)
+"""
+@unbox_metrics.timed("import_snapshot")
+def import_snapshot(dropbox_module, local_module, in_fp, create_links=True, link_target=None):
+    if link_target is None:
+        link_target = dropbox_module.resource_path
+    snapshot_tar = tarfile.open(fileobj=in_fp, mode="r|")
+    manifest = None
+    version_dirpaths = dict()
+    try:
+        for member in snapshot_tar:
+            # The manifest comes first and says which resources and versions to expect
+            if manifest is None:
+                if member.name != _MANIFEST_MEMBER_NAME:
+                    raise ValueError("Cannot import snapshot; archive does not start with a manifest")
+                manifest = json.loads(snapshot_tar.extractfile(member).read().decode("utf-8"))
+                continue
+
+            # Extract resource data directly into the resource's new version directory
+            member_path_components = member.name.split("/")
+            if (member.name.startswith("/") or ".." in member_path_components or len(member_path_components) < 2
+                    or member_path_components[0] != _RESOURCES_MEMBER_DIRNAME):
+                raise ValueError("Cannot import snapshot; unexpected archive member " + member.name)
+            if not (member.isfile() or member.isdir() or member.issym()):
+                raise ValueError("Cannot import snapshot; unsupported archive member type for " + member.name)
+            resource_name = member_path_components[1]
+            if resource_name not in manifest[_MANIFEST_KEY_RESOURCES]:
+                raise ValueError("Cannot import snapshot; resource '" + resource_name + "' is not in the manifest")
+            if resource_name not in version_dirpaths:
+                resource_version = manifest[_MANIFEST_KEY_RESOURCES][resource_name][_RSRC_KEY_VERSION]
+                version_dirpaths[resource_name] = dropbox_module.stage_resource(resource_name, resource_version)
+            member.name = "/".join(member_path_components[1:])
+            _check_member_path(member, version_dirpaths[resource_name])
+            snapshot_tar.extract(member, version_dirpaths[resource_name])
+            if member.isfile():
+                unbox_metrics.BYTES_COPIED.inc(member.size)
+    except:
+        dropbox_module.abort_staged_resources()
+        raise
+    finally:
+        snapshot_tar.close()
+    if manifest is None:
+        raise ValueError("Cannot import snapshot; archive is empty")
+
+    # Register every resource with a single index write
+    dependencies = dict([(resource_name, resource_info[_RSRC_KEY_DEPENDENCIES])
+            for resource_name, resource_info in manifest[_MANIFEST_KEY_RESOURCES].items()])
+    templates = set([resource_name for resource_name, resource_info in manifest[_MANIFEST_KEY_RESOURCES].items()
+            if resource_info.get(_RSRC_KEY_TEMPLATE, False)])
+    imported = sorted(dropbox_module.commit_staged_resources(dependencies, templates))
+
+    # Forge the planned links
+    created_links = []
+    if create_links:
+        for link_plan in manifest[_MANIFEST_KEY_LINKS]:
+            resource_name = link_plan[_LINK_KEY_RESOURCE_NAME]
+            if resource_name not in version_dirpaths:
+                continue
+            link_path = os.path.abspath(os.path.expanduser(link_plan[_LINK_KEY_LINK_PATH]))
+            if os.path.islink(link_path) and not os.path.exists(link_path):
+                os.remove(link_path)
+            elif os.path.lexists(link_path):
+                local_module.backup_add(link_path)
+            resource_version = manifest[_MANIFEST_KEY_RESOURCES][resource_name][_RSRC_KEY_VERSION]
+            local_module.add_link(link_path, link_target(resource_name), resource_name, resource_version,
+                    link_plan[_LINK_KEY_IGNORENEW], link_plan.get(_LINK_KEY_STRATEGY, unbox_links.STRATEGY_SYMLINK))
+            created_links.append(link_path)
+    return (imported, sorted(created_links))
@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import shutil
+import socket
+import stat
+import string
+import uuid
+
+import unbox_links
+import unbox_lock
+
+# Key in the 'template variables' setting holding the variables every host gets, before its own are applied
+DEFAULT_VARIABLES_KEY = "*"
+
+# Name of file in the render cache mapping template paths to their stat signatures and content hashes
+_HASHES_FILENAME = "hashes.json"
+
+# Prefix of directories renders are written into before being moved into place
+_TEMPORARY_PREFIX = ".render-"
+
+"""
+Gets the template variables for a host
+NOTE: Every host gets 'hostname' and 'home', which the settings can override
+- template_variables: dict of hostname or DEFAULT_VARIABLES_KEY -> dict of variable names -> values, as in the 'template variables' setting
+- hostname: name of the host, or None for this machine
+- RETURN: dict of variable names -> values
+"""
+def host_variables(template_variables, hostname=None):
+    hostname = hostname or socket.gethostname()
+    variables = { "hostname" : hostname, "home" : os.path.expanduser("~") }
+    variables.update(template_variables.get(DEFAULT_VARIABLES_KEY, dict()))
+    variables.update(template_variables.get(hostname, dict()))
+    return variables
+
+"""
+Hashes a set of template variables, independently of their order
+- variables: dict of variable names -> values
+- RETURN: hex digest string
+"""
+def variables_hash(variables):
+    return hashlib.sha256(json.dumps(variables, sort_keys=True).encode("utf-8")).hexdigest()
+
+"""
+Fills in a template's $name and ${name} placeholders; '$$' stands for a literal '$'
+- template_text: text of template
+- variables: dict of variable names -> values
+- RETURN: rendered text
+"""
+def render_text(template_text, variables):
+    try:
+        return string.Template(template_text).substitute(variables)
+    except KeyError as e:
+        raise ValueError("Cannot render template; no value for variable " + str(e))
+    except ValueError as e:
+        raise ValueError("Cannot render template; " + str(e))
+
+"""
+Renders a template file or directory tree to a new path, copying files that aren't UTF-8 text and symlinks as they are
+- template_path: path of template file or directory
+- dest_path: path to write the render to, which must not exist
+- variables: dict of variable names -> values
+"""
+def render_tree(template_path, dest_path, variables):
+    if os.path.islink(template_path):
+        os.symlink(os.readlink(template_path), dest_path)
+    elif os.path.isdir(template_path):
+        os.mkdir(dest_path)
+        for name in sorted(os.listdir(template_path)):
+            render_tree(os.path.join(template_path, name), os.path.join(dest_path, name), variables)
+        shutil.copymode(template_path, dest_path)
+    else:
+        template_fp = open(template_path, "rb")
+        template_bytes = template_fp.read()
+        template_fp.close()
+        try:
+            rendered_bytes = render_text(template_bytes.decode("utf-8"), variables).encode("utf-8")
+        except UnicodeError:
+            rendered_bytes = template_bytes
+        dest_fp = open(dest_path, "wb")
+        dest_fp.write(rendered_bytes)
+        dest_fp.close()
+        shutil.copymode(template_path, dest_path)
+
+"""
+Gets a cheap signature of a file object's metadata, which changes whenever its contents are likely to have
+- path: path to file or directory tree
+- RETURN: list of values for a file, or hex digest string of every entry's metadata for a directory
+"""
+def _stat_signature(path):
+    path_stat = os.lstat(path)
+    if not stat.S_ISDIR(path_stat.st_mode):
+        return [path_stat.st_size, path_stat.st_mtime, path_stat.st_ino]
+    digest = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            entry_path = os.path.join(dirpath, name)
+            entry_stat = os.lstat(entry_path)
+            digest.update(json.dumps([os.path.relpath(entry_path, path), entry_stat.st_mode, entry_stat.st_size,
+                    entry_stat.st_mtime, entry_stat.st_ino]).encode("utf-8"))
+    return digest.hexdigest()
+
+class RenderCache(object):
+    """Local cache of rendered templates, keyed by (template content hash, variables hash)
+    NOTE: A template is only read again when its metadata changes, and only re-rendered when its content or the variables do
+    """
+
+    def __init__(self, cache_dirpath):
+        """Instantiates a render cache
+
+        Keyword Args:
+        cache_dirpath -- path to the directory holding renders, created on first render
+        """
+        self._cache_dirpath = cache_dirpath
+
+        # Maps template path -> [stat signature, content hash], read on first use
+        self._hashes = None
+        self._hashes_changed = False
+
+    def _hashes_filepath(self):
+        """Gets the path to the file holding template content hashes"""
+        return os.path.join(self._cache_dirpath, _HASHES_FILENAME)
+
+    def _content_hash(self, template_path):
+        """Gets a template's content hash, only reading the template if its metadata changed since it was last hashed"""
+        if self._hashes is None:
+            self._hashes = dict()
+            hashes_filepath = self._hashes_filepath()
+            if os.path.isfile(hashes_filepath):
+                with unbox_lock.shared_lock(hashes_filepath):
+                    hashes_fp = open(hashes_filepath)
+                    try:
+                        self._hashes = json.load(hashes_fp)
+                    except ValueError:
+                        pass
+                    finally:
+                        hashes_fp.close()
+        signature = _stat_signature(template_path)
+        cached = self._hashes.get(template_path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        content_hash = unbox_links.content_hash(template_path)
+        self._hashes[template_path] = [signature, content_hash]
+        self._hashes_changed = True
+        return content_hash
+
+    def render(self, template_path, variables):
+        """Gets the render of a template with the given variables, rendering it only if it isn't cached yet
+
+        Keyword Args:
+        template_path -- path of template file or directory
+        variables -- dict of variable names -> values
+
+        Return:
+        Tuple of (path of rendered file or directory, True if it was rendered by this call)
+        """
+        template_path = os.path.abspath(template_path)
+        render_key = hashlib.sha256((self._content_hash(template_path) + ":" + variables_hash(variables)).encode("utf-8")).hexdigest()
+        render_dirpath = os.path.join(self._cache_dirpath, render_key)
+        rendered_path = os.path.join(render_dirpath, os.path.basename(template_path))
+        if os.path.isdir(render_dirpath):
+            return (rendered_path, False)
+
+        # Render next to the cache entry, then move it into place so readers never see a partial render
+        if not os.path.isdir(self._cache_dirpath):
+            os.makedirs(self._cache_dirpath)
+        temporary_dirpath = os.path.join(self._cache_dirpath, _TEMPORARY_PREFIX + uuid.uuid4().hex)
+        os.mkdir(temporary_dirpath)
+        try:
+            render_tree(template_path, os.path.join(temporary_dirpath, os.path.basename(template_path)), variables)
+            os.rename(temporary_dirpath, render_dirpath)
+        except OSError:
+            if not os.path.isdir(render_dirpath):
+                raise
+        finally:
+            if os.path.isdir(temporary_dirpath):
+                shutil.rmtree(temporary_dirpath)
+        return (rendered_path, True)
+
+    def prune(self, keep_paths):
+        """Removes renders no longer in use, and content hashes of templates that no longer exist
+
+        Keyword Args:
+        keep_paths -- iterable of paths returned by render to keep
+
+        Return:
+        Number of renders removed
+        """
+        if not os.path.isdir(self._cache_dirpath):
+            return 0
+        keep_keys = set([os.path.basename(os.path.dirname(path)) for path in keep_paths])
+        removed = 0
+        for name in os.listdir(self._cache_dirpath):
+            # Leave the hashes file with its lock, and files and renders other processes are still writing
+            if name.startswith(_HASHES_FILENAME) or name.startswith(".") or name in keep_keys:
+                continue
+            shutil.rmtree(os.path.join(self._cache_dirpath, name))
+            removed += 1
+        if self._hashes is not None:
+            for template_path in [template_path for template_path in self._hashes if not os.path.exists(template_path)]:
+                del self._hashes[template_path]
+                self._hashes_changed = True
+        return removed
+
+    def save(self):
+        """Writes template content hashes learned since the cache was loaded"""
+        if not self._hashes_changed:
+            return
+        if not os.path.isdir(self._cache_dirpath):
+            os.makedirs(self._cache_dirpath)
+        hashes_filepath = self._hashes_filepath()
+        with unbox_lock.exclusive_lock(hashes_filepath):
+            unbox_lock.atomic_write(hashes_filepath, lambda hashes_fp: hashes_fp.write(json.dumps(self._hashes, sort_keys=True).encode("utf-8")))
+        self._hashes_changed = False